@@ -0,0 +1,105 @@
+# benchmark_startup.py
+"""
+Measures how long it takes to import fastapi_server (cold start and every --reload pay this)
+and, optionally, how long the lifespan hook takes to build its clients.
+
+Each run uses a fresh interpreter. Importing must not open network connections; any
+attempt is counted and fails the benchmark.
+
+    python scripts/benchmark_startup.py                      # 5 runs, prints median/max
+    python scripts/benchmark_startup.py --max-import-seconds 1.5   # exit 1 on regression (for CI)
+    python scripts/benchmark_startup.py --lifespan           # also time client initialization (uses real credentials)
+    python scripts/benchmark_startup.py --importtime         # slowest modules from python -X importtime
+
+tests/test_startup.py checks the no-network and no-client guarantees on every test run.
+"""
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+_CHILD_CODE = r"""
+import json, socket, sys, time, asyncio
+connections = []
+_original_connect = socket.socket.connect
+def _recording_connect(self, address):
+    connections.append(str(address))
+    return _original_connect(self, address)
+socket.socket.connect = _recording_connect
+
+start = time.perf_counter()
+import fastapi_server
+import_seconds = time.perf_counter() - start
+result = {"import_seconds": import_seconds, "import_connections": list(connections)}
+
+if RUN_LIFESPAN:
+    async def _run():
+        start = time.perf_counter()
+        async with fastapi_server.app.router.lifespan_context(fastapi_server.app):
+            return time.perf_counter() - start
+    result["lifespan_seconds"] = asyncio.run(_run())
+    result["lifespan_timings"] = fastapi_server.startup_timings
+print("BENCHMARK_RESULT " + json.dumps(result))
+"""
+
+
+def _run_once(run_lifespan: bool) -> dict:
+    code = _CHILD_CODE.replace("RUN_LIFESPAN", "True" if run_lifespan else "False")
+    completed = subprocess.run([sys.executable, "-c", code], cwd=SRC_DIR, capture_output=True, text=True)
+    for line in completed.stdout.splitlines():
+        if line.startswith("BENCHMARK_RESULT "):
+            return json.loads(line[len("BENCHMARK_RESULT "):])
+    raise RuntimeError(f"Benchmark run failed (exit {completed.returncode}):\n{completed.stderr[-4000:]}")
+
+
+def _slowest_imports(limit: int = 20):
+    completed = subprocess.run([sys.executable, "-X", "importtime", "-c", "import fastapi_server"],
+                               cwd=SRC_DIR, capture_output=True, text=True)
+    rows = []
+    for line in completed.stderr.splitlines():
+        # "import time:  self [us] | cumulative | imported package"
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, module = line[len("import time:"):].split("|", 2)
+        rows.append((int(cumulative_us), int(self_us), module.rstrip()))
+    return sorted(rows, reverse=True)[:limit]
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmark fastapi_server startup time.")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--lifespan", action="store_true", help="Also run the lifespan hook (initializes real clients).")
+    parser.add_argument("--max-import-seconds", type=float, default=None, help="Fail if the median import time exceeds this.")
+    parser.add_argument("--importtime", action="store_true", help="Print the slowest imports.")
+    args = parser.parse_args()
+
+    results = [_run_once(args.lifespan) for _ in range(args.runs)]
+    import_times = [r["import_seconds"] for r in results]
+    print(f"import fastapi_server: median {statistics.median(import_times):.3f}s, "
+          f"min {min(import_times):.3f}s, max {max(import_times):.3f}s over {args.runs} runs")
+    if args.lifespan:
+        lifespan_times = [r["lifespan_seconds"] for r in results]
+        print(f"lifespan startup: median {statistics.median(lifespan_times):.3f}s; last run per client: {results[-1]['lifespan_timings']}")
+
+    if args.importtime:
+        print(f"{'cumulative (ms)':>16} {'self (ms)':>10}  module")
+        for cumulative_us, self_us, module in _slowest_imports():
+            print(f"{cumulative_us / 1000:16.1f} {self_us / 1000:10.1f}  {module}")
+
+    failed = False
+    connections = sorted({c for r in results for c in r["import_connections"]})
+    if connections:
+        print(f"FAIL: importing fastapi_server opened network connections: {connections}")
+        failed = True
+    if args.max_import_seconds is not None and statistics.median(import_times) > args.max_import_seconds:
+        print(f"FAIL: median import time exceeds {args.max_import_seconds:.3f}s")
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,202 @@
+# admission_control.py
+import os
+import time
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_INTERACTIVE = "interactive"
+PRIORITY_BULK = "bulk"
+
+
+class RequestShedError(Exception):
+    """Raised when a request is refused admission; callers answer 429 with Retry-After."""
+
+    def __init__(self, priority: str, reason: str, retry_after_seconds: int):
+        self.priority = priority
+        self.reason = reason
+        self.retry_after_seconds = retry_after_seconds
+        super().__init__(f"Server is busy; {priority} request shed ({reason}). Retry after {retry_after_seconds}s.")
+
+
+class PriorityClass:
+    """Limits for one priority class. Lower `rank` means higher priority."""
+
+    def __init__(self, name: str, rank: int, max_concurrent: int, max_queue: int,
+                 queue_timeout_seconds: float, retry_after_seconds: int):
+        self.name = name
+        self.rank = rank
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout_seconds = queue_timeout_seconds
+        self.retry_after_seconds = retry_after_seconds
+        self.active = 0
+        self.queued = 0
+        self.peak_queued = 0
+        self.admitted = 0
+        self.shed = {"queue_full": 0, "queue_timeout": 0, "higher_priority_waiting": 0}
+        self.total_wait_seconds = 0.0
+
+    def snapshot(self) -> dict:
+        return {
+            "rank": self.rank,
+            "active": self.active,
+            "queued": self.queued,
+            "peak_queued": self.peak_queued,
+            "max_concurrent": self.max_concurrent,
+            "max_queue": self.max_queue,
+            "admitted": self.admitted,
+            "shed": dict(self.shed),
+            "shed_total": sum(self.shed.values()),
+            "avg_wait_seconds": round(self.total_wait_seconds / self.admitted, 4) if self.admitted else 0.0,
+        }
+
+
+class AdmissionController:
+    """
+    Admits requests by priority class. Every class has its own concurrency cap and bounded
+    queue, and all classes share `capacity` slots. A class is only admitted while no
+    higher-priority request is queued, and lower-priority requests that arrive while one is
+    queued are shed at once instead of waiting, so bulk traffic backs off before interactive
+    requests start to queue behind it. Requests that find their queue full, or wait longer
+    than the class's queue timeout, are shed too.
+    """
+
+    def __init__(self, classes: List[PriorityClass], capacity: int, default_class: str = PRIORITY_INTERACTIVE,
+                 api_keys: Optional[Dict[str, str]] = None, batch_id_is_bulk: bool = False):
+        self.classes = {c.name: c for c in sorted(classes, key=lambda c: c.rank)}
+        self.capacity = capacity
+        self.default_class = default_class
+        self.api_keys = api_keys or {}
+        self.batch_id_is_bulk = batch_id_is_bulk
+        self._condition = None
+        self.active = 0
+
+    def _get_condition(self) -> asyncio.Condition:
+        # Created lazily so it binds to the running event loop.
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        return self._condition
+
+    def classify(self, headers) -> str:
+        """
+        An API key mapped to a class decides; otherwise `X-Priority` may pick a class no higher
+        than the default. An `X-Batch-ID` only groups usage for cost accounting and leaves the
+        class alone, unless batch_id_is_bulk opts in to treating it as bulk.
+        """
+        api_key = headers.get("x-api-key")
+        if api_key and api_key in self.api_keys:
+            return self.api_keys[api_key]
+        default = self.classes[self.default_class]
+        requested = (headers.get("x-priority") or "").strip().lower()
+        if requested in self.classes and self.classes[requested].rank >= default.rank:
+            return requested
+        if self.batch_id_is_bulk and headers.get("x-batch-id") and PRIORITY_BULK in self.classes:
+            return PRIORITY_BULK
+        return self.default_class
+
+    def _higher_priority_waiting(self, priority_class: PriorityClass) -> bool:
+        return any(c.queued for c in self.classes.values() if c.rank < priority_class.rank)
+
+    def _can_run(self, priority_class: PriorityClass) -> bool:
+        return (priority_class.active < priority_class.max_concurrent and self.active < self.capacity
+                and not self._higher_priority_waiting(priority_class))
+
+    def _shed(self, priority_class: PriorityClass, reason: str) -> RequestShedError:
+        priority_class.shed[reason] += 1
+        logger.warning("Admission Control: Shed %s request (%s); %s active, %s queued.",
+                       priority_class.name, reason, priority_class.active, priority_class.queued)
+        return RequestShedError(priority_class.name, reason, priority_class.retry_after_seconds)
+
+    async def acquire(self, priority: str) -> PriorityClass:
+        """Takes a slot of `priority`, queueing if allowed. Raises RequestShedError."""
+        priority_class = self.classes[priority]
+        condition = self._get_condition()
+        start = time.monotonic()
+        async with condition:
+            if not self._can_run(priority_class):
+                if self._higher_priority_waiting(priority_class):
+                    raise self._shed(priority_class, "higher_priority_waiting")
+                if priority_class.queued >= priority_class.max_queue:
+                    raise self._shed(priority_class, "queue_full")
+                priority_class.queued += 1
+                priority_class.peak_queued = max(priority_class.peak_queued, priority_class.queued)
+                try:
+                    await asyncio.wait_for(condition.wait_for(lambda: self._can_run(priority_class)),
+                                           priority_class.queue_timeout_seconds)
+                except asyncio.TimeoutError:
+                    raise self._shed(priority_class, "queue_timeout")
+                finally:
+                    priority_class.queued -= 1
+                    # Lower classes may have been held back only by this waiter.
+                    condition.notify_all()
+            priority_class.active += 1
+            self.active += 1
+            priority_class.admitted += 1
+            priority_class.total_wait_seconds += time.monotonic() - start
+        return priority_class
+
+    async def release(self, priority_class: PriorityClass):
+        # Give the slot back before awaiting the lock, so a release that is itself cancelled can't leak it.
+        priority_class.active -= 1
+        self.active -= 1
+        condition = self._get_condition()
+        async with condition:
+            condition.notify_all()
+
+    @asynccontextmanager
+    async def admit(self, priority: str):
+        priority_class = await self.acquire(priority)
+        try:
+            yield priority_class
+        finally:
+            await self.release(priority_class)
+
+    def snapshot(self) -> dict:
+        return {
+            "capacity": self.capacity,
+            "active": self.active,
+            "default_class": self.default_class,
+            "classes": {name: c.snapshot() for name, c in self.classes.items()},
+        }
+
+
+def _parse_api_keys(value: str) -> Dict[str, str]:
+    """ADMISSION_API_KEYS format: "key1=bulk,key2=interactive"."""
+    keys = {}
+    for entry in value.split(","):
+        key, _, priority = entry.strip().partition("=")
+        if key and priority:
+            keys[key.strip()] = priority.strip().lower()
+    return keys
+
+
+def create_admission_controller() -> AdmissionController:
+    """Builds the controller from ADMISSION_* environment variables."""
+    capacity = int(os.getenv("ADMISSION_CAPACITY", "16"))
+    classes = [
+        PriorityClass(
+            PRIORITY_INTERACTIVE, rank=0,
+            max_concurrent=int(os.getenv("ADMISSION_INTERACTIVE_CONCURRENCY", str(capacity))),
+            max_queue=int(os.getenv("ADMISSION_INTERACTIVE_QUEUE", "64")),
+            queue_timeout_seconds=float(os.getenv("ADMISSION_INTERACTIVE_QUEUE_TIMEOUT_SECONDS", "30")),
+            retry_after_seconds=int(os.getenv("ADMISSION_INTERACTIVE_RETRY_AFTER_SECONDS", "2")),
+        ),
+        PriorityClass(
+            PRIORITY_BULK, rank=1,
+            max_concurrent=int(os.getenv("ADMISSION_BULK_CONCURRENCY", str(max(1, capacity // 4)))),
+            max_queue=int(os.getenv("ADMISSION_BULK_QUEUE", "16")),
+            queue_timeout_seconds=float(os.getenv("ADMISSION_BULK_QUEUE_TIMEOUT_SECONDS", "5")),
+            retry_after_seconds=int(os.getenv("ADMISSION_BULK_RETRY_AFTER_SECONDS", "15")),
+        ),
+    ]
+    api_keys = _parse_api_keys(os.getenv("ADMISSION_API_KEYS", ""))
+    unknown = {p for p in api_keys.values() if p not in (PRIORITY_INTERACTIVE, PRIORITY_BULK)}
+    if unknown:
+        logger.warning("Admission Control: Ignoring API keys mapped to unknown classes: %s", sorted(unknown))
+        api_keys = {k: p for k, p in api_keys.items() if p not in unknown}
+    batch_id_is_bulk = os.getenv("ADMISSION_BATCH_ID_IS_BULK", "false").lower() in ("1", "true", "yes")
+    return AdmissionController(classes, capacity, api_keys=api_keys, batch_id_is_bulk=batch_id_is_bulk)
@@ -0,0 +1,267 @@
+# backfill.py
+import os
+import json
+import time
+import sqlite3
+import asyncio
+import logging
+import threading
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, List, Optional
+
+from circuit_breaker import CircuitOpenError
+from inflight_budget import BudgetExhaustedError
+
+logger = logging.getLogger(__name__)
+
+BACKFILL_RATE_PER_MINUTE = float(os.getenv("BACKFILL_RATE_PER_MINUTE", "10"))
+BACKFILL_BUSY_POLL_SECONDS = float(os.getenv("BACKFILL_BUSY_POLL_SECONDS", "2"))
+BACKFILL_BATCH_SIZE = int(os.getenv("BACKFILL_BATCH_SIZE", "50"))
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def _split_keywords(keywords: Optional[str]) -> List[str]:
+    return [k.strip() for k in (keywords or "").split(",") if k.strip()]
+
+
+class BackfillScheduler:
+    """
+    Re-extracts stored results whose tagging version (model cascade + prompt hash) differs from
+    the current one, at most `rate_per_minute` files a minute and only while no interactive
+    extraction is running. Run state and the per-file keyword diffs live in SQLite, and the run
+    keeps a filename cursor, so a paused or interrupted run continues where it stopped.
+
+    `extract(filename, batch_id)` must return the extraction response dict, or None when the
+    file no longer exists. `is_busy()` reports interactive traffic; `wait_seconds()` returns how
+    long to hold off (e.g. a daily budget is exhausted) or None.
+    """
+
+    def __init__(self, db_path: str, results, extract: Callable[[str, str], Awaitable[Optional[dict]]],
+                 current_version: Callable[[], str], is_busy: Callable[[], bool],
+                 wait_seconds: Callable[[], Optional[float]] = lambda: None):
+        self.results = results
+        self._extract = extract
+        self._current_version = current_version
+        self._is_busy = is_busy
+        self._wait_seconds = wait_seconds
+        self._task: Optional[asyncio.Task] = None
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS backfill_runs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                target_version TEXT NOT NULL,
+                status TEXT NOT NULL,
+                rate_per_minute REAL NOT NULL,
+                cursor TEXT NOT NULL DEFAULT '',
+                stale_at_start INTEGER NOT NULL DEFAULT 0,
+                processed INTEGER NOT NULL DEFAULT 0,
+                changed INTEGER NOT NULL DEFAULT 0,
+                failed INTEGER NOT NULL DEFAULT 0,
+                missing INTEGER NOT NULL DEFAULT 0,
+                last_error TEXT,
+                started_at TEXT NOT NULL,
+                updated_at TEXT NOT NULL,
+                finished_at TEXT
+            );
+            CREATE TABLE IF NOT EXISTS backfill_diffs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                run_id INTEGER NOT NULL,
+                filename TEXT NOT NULL,
+                old_version TEXT,
+                new_version TEXT,
+                added TEXT NOT NULL,
+                removed TEXT NOT NULL,
+                description_changed INTEGER NOT NULL,
+                processed_at TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_backfill_diffs_run ON backfill_diffs (run_id, id);
+        """)
+        self._conn.commit()
+
+    # --- Run state ---
+
+    _RUN_COLUMNS = ["id", "target_version", "status", "rate_per_minute", "cursor", "stale_at_start", "processed",
+                    "changed", "failed", "missing", "last_error", "started_at", "updated_at", "finished_at"]
+
+    def _run(self, where: str, params: tuple = ()) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute(f"SELECT {', '.join(self._RUN_COLUMNS)} FROM backfill_runs {where} "
+                                     f"ORDER BY id DESC LIMIT 1", params).fetchone()
+        return dict(zip(self._RUN_COLUMNS, row)) if row else None
+
+    def latest_run(self) -> Optional[dict]:
+        return self._run("")
+
+    def _update_run(self, run_id: int, **fields):
+        fields["updated_at"] = _now()
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        with self._lock:
+            self._conn.execute(f"UPDATE backfill_runs SET {assignments} WHERE id = ?", (*fields.values(), run_id))
+            self._conn.commit()
+
+    def _increment(self, run_id: int, cursor: str, **counters):
+        increments = ", ".join(f"{name} = {name} + ?" for name in counters)
+        with self._lock:
+            self._conn.execute(f"UPDATE backfill_runs SET {increments}, cursor = ?, updated_at = ? WHERE id = ?",
+                               (*counters.values(), cursor, _now(), run_id))
+            self._conn.commit()
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self, rate_per_minute: Optional[float] = None) -> dict:
+        """Starts a new run against the current version. Raises RuntimeError if one is active."""
+        if self.running:
+            raise RuntimeError("A backfill run is already in progress.")
+        version = self._current_version()
+        now = _now()
+        with self._lock:
+            self._conn.execute("UPDATE backfill_runs SET status = 'superseded', updated_at = ? "
+                               "WHERE status IN ('running', 'paused')", (now,))
+            cursor = self._conn.execute("""
+                INSERT INTO backfill_runs (target_version, status, rate_per_minute, stale_at_start, started_at, updated_at)
+                VALUES (?, 'running', ?, ?, ?, ?)
+            """, (version, rate_per_minute or BACKFILL_RATE_PER_MINUTE, self.results.count_stale(version), now, now))
+            self._conn.commit()
+            run_id = cursor.lastrowid
+        logger.info("Backfill: Started run %s for version '%s'.", run_id, version)
+        self._spawn(run_id)
+        return self.latest_run()
+
+    def pause(self) -> Optional[dict]:
+        run = self._run("WHERE status = 'running'")
+        if run:
+            self._update_run(run["id"], status="paused")
+            logger.info("Backfill: Pausing run %s at cursor '%s'.", run["id"], run["cursor"])
+        return self.latest_run()
+
+    def resume(self) -> Optional[dict]:
+        """Continues the latest paused or interrupted run from its cursor."""
+        run = self._run("WHERE status IN ('running', 'paused')")
+        if run is None:
+            return self.latest_run()
+        if run["target_version"] != self._current_version():
+            # The prompt or model changed since this run started; its cursor no longer means anything.
+            self._update_run(run["id"], status="superseded")
+            logger.info("Backfill: Run %s targeted '%s', which is no longer current.", run["id"], run["target_version"])
+            return self.latest_run()
+        self._update_run(run["id"], status="running")
+        logger.info("Backfill: Resuming run %s from cursor '%s'.", run["id"], run["cursor"])
+        if not self.running:  # a worker that was paused mid-sleep simply carries on
+            self._spawn(run["id"])
+        return self.latest_run()
+
+    def _spawn(self, run_id: int):
+        self._task = asyncio.create_task(self._process(run_id))
+
+    async def stop(self):
+        """Stops the worker without changing the run's status, so it resumes on the next start-up."""
+        if self.running:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    # --- Worker ---
+
+    async def _process(self, run_id: int):
+        try:
+            while True:
+                run = self._run("WHERE id = ?", (run_id,))
+                if run is None or run["status"] != "running":
+                    return
+                batch = await asyncio.to_thread(self.results.stale_filenames, run["target_version"], run["cursor"], BACKFILL_BATCH_SIZE)
+                if not batch:
+                    self._update_run(run_id, status="completed", finished_at=_now())
+                    logger.info("Backfill: Run %s completed.", run_id)
+                    return
+                for filename in batch:
+                    if self._run("WHERE id = ? AND status = 'running'", (run_id,)) is None:
+                        return
+                    started = time.monotonic()
+                    await self._wait_for_capacity()
+                    await self._process_file(run_id, run["target_version"], filename)
+                    # Rate limit; the rate is re-read so it can be changed on a live run.
+                    rate = (self._run("WHERE id = ?", (run_id,)) or run)["rate_per_minute"]
+                    await asyncio.sleep(max(0.0, 60.0 / max(rate, 0.001) - (time.monotonic() - started)))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error("Backfill: Run %s stopped on an unexpected error: %s", run_id, e, exc_info=True)
+            self._update_run(run_id, status="paused", last_error=str(e))
+
+    async def _wait_for_capacity(self):
+        """Interactive extractions always go first; budgets and breakers hold the run back."""
+        while True:
+            delay = self._wait_seconds()
+            if delay:
+                await asyncio.sleep(min(delay, 300))
+            elif self._is_busy():
+                await asyncio.sleep(BACKFILL_BUSY_POLL_SECONDS)
+            else:
+                return
+
+    async def _process_file(self, run_id: int, target_version: str, filename: str):
+        old = await asyncio.to_thread(self.results.get, filename)
+        while True:
+            try:
+                content = await self._extract(filename, f"backfill-{run_id}")
+                break
+            except (CircuitOpenError, BudgetExhaustedError) as e:
+                logger.warning("Backfill: %s Retrying %s in %ss.", e, filename, e.retry_after_seconds)
+                await asyncio.sleep(max(1, e.retry_after_seconds))
+        if content is None:
+            self._increment(run_id, filename, missing=1)
+            return
+        if content.get("status") != "success":
+            self._increment(run_id, filename, processed=1, failed=1)
+            self._update_run(run_id, last_error=f"{filename}: {content.get('error')}")
+            return
+
+        old_keywords = _split_keywords(old["keywords"]) if old else []
+        new_keywords = content.get("keywords") or []
+        added = [k for k in new_keywords if k not in set(old_keywords)]
+        removed = [k for k in old_keywords if k not in set(new_keywords)]
+        description_changed = bool(old) and (old["description"] or "") != (content.get("description") or "")
+        with self._lock:
+            self._conn.execute("""
+                INSERT INTO backfill_diffs (run_id, filename, old_version, new_version, added, removed, description_changed, processed_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, (run_id, filename, old["tagging_version"] if old else None, content.get("tagging_version", target_version),
+                  json.dumps(added, ensure_ascii=False), json.dumps(removed, ensure_ascii=False), int(description_changed), _now()))
+            self._conn.commit()
+        changed = bool(added or removed or description_changed)
+        self._increment(run_id, filename, processed=1, changed=int(changed))
+
+    # --- Observability ---
+
+    def recent_diffs(self, run_id: int, limit: int = 50) -> List[dict]:
+        with self._lock:
+            rows = self._conn.execute("""
+                SELECT filename, old_version, new_version, added, removed, description_changed, processed_at
+                FROM backfill_diffs WHERE run_id = ? ORDER BY id DESC LIMIT ?
+            """, (run_id, limit)).fetchall()
+        return [{"filename": f, "old_version": ov, "new_version": nv, "added": json.loads(a), "removed": json.loads(r),
+                 "description_changed": bool(d), "processed_at": at} for f, ov, nv, a, r, d, at in rows]
+
+    def status(self, diff_limit: int = 20) -> dict:
+        version = self._current_version()
+        run = self.latest_run()
+        if run:
+            run["worker_active"] = self.running and run["status"] == "running"
+            done = run["processed"] + run["missing"]
+            run["progress_percent"] = round(100.0 * done / run["stale_at_start"], 1) if run["stale_at_start"] else None
+        return {
+            "current_version": version,
+            "stale_results": self.results.count_stale(version),
+            "results_by_version": self.results.version_counts(),
+            "run": run,
+            "recent_diffs": self.recent_diffs(run["id"], diff_limit) if run else [],
+        }
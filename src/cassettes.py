@@ -0,0 +1,211 @@
+# cassettes.py
+import os
+import json
+import time
+import zlib
+import sqlite3
+import hashlib
+import logging
+import threading
+from datetime import datetime, timezone
+from typing import Any, Callable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Record/replay of external API traffic (Gemini generate/count_tokens, Vertex image embeddings,
+# Google Sheets) for regression tests and offline benchmarks. CASSETTE_MODE=record stores every
+# response; CASSETTE_MODE=replay serves them back without touching the network, after the
+# recorded latency or at once (CASSETTE_REPLAY_LATENCY=recorded | zero).
+CASSETTE_MODE = os.getenv("CASSETTE_MODE", "off").lower()  # off | record | replay
+CASSETTE_PATH = os.getenv("CASSETTE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "cassettes.sqlite3"))
+CASSETTE_REPLAY_LATENCY = os.getenv("CASSETTE_REPLAY_LATENCY", "recorded").lower()  # recorded | zero
+
+
+class CassetteMissError(Exception):
+    """Raised in replay mode when nothing was recorded for a request."""
+
+    def __init__(self, namespace: str, key: str):
+        self.namespace = namespace
+        self.key = key
+        super().__init__(f"No recorded '{namespace}' response for request {key[:16]}.")
+
+
+class ReplayedError(Exception):
+    """Stands in for an exception that was recorded; str() gives the original message."""
+
+    def __init__(self, error_type: str, message: str):
+        self.error_type = error_type
+        super().__init__(message)
+
+
+def request_key(*parts) -> str:
+    """Stable hash of the parts that identify a request."""
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def digest(data) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def _pack(value) -> bytes:
+    return zlib.compress(json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+
+
+def _unpack(blob: bytes):
+    return json.loads(zlib.decompress(blob).decode("utf-8"))
+
+
+class CassetteStore:
+    """
+    SQLite file of recorded responses, one zlib-compressed JSON payload per call, keyed by
+    (namespace, request hash, occurrence). A request seen several times is recorded each
+    time and replayed in the same order; once the recordings run out the last one repeats.
+    The database is opened on first use, so importing this module has no side effects.
+    """
+
+    def __init__(self, path: str = CASSETTE_PATH, mode: str = CASSETTE_MODE, replay_latency: str = CASSETTE_REPLAY_LATENCY):
+        if mode not in ("off", "record", "replay"):
+            raise ValueError(f"Unknown cassette mode '{mode}'.")
+        self.path = path
+        self.mode = mode
+        self.replay_latency = replay_latency
+        self._conn = None
+        self._lock = threading.Lock()
+        self._recorded_counts = {}  # (namespace, key) -> occurrences stored so far
+        self._replay_positions = {}  # (namespace, key) -> next occurrence to serve
+        self.recorded = 0
+        self.replayed = 0
+        self.misses = 0
+
+    @property
+    def recording(self) -> bool:
+        return self.mode == "record"
+
+    @property
+    def replaying(self) -> bool:
+        return self.mode == "replay"
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS cassette_entries (
+                    namespace TEXT NOT NULL,
+                    request_key TEXT NOT NULL,
+                    occurrence INTEGER NOT NULL,
+                    latency_seconds REAL NOT NULL,
+                    payload BLOB,
+                    error BLOB,
+                    recorded_at TEXT NOT NULL,
+                    PRIMARY KEY (namespace, request_key, occurrence)
+                )
+            """)
+            self._conn.commit()
+            logger.info("Cassettes: %s mode using '%s'.", self.mode, self.path)
+        return self._conn
+
+    def call(self, namespace: str, key: str, func: Optional[Callable[[], Any]],
+             serialize: Callable[[Any], Any] = lambda value: value,
+             deserialize: Callable[[Any], Any] = lambda value: value,
+             serialize_error: Callable[[Exception], Optional[dict]] = lambda e: {"type": type(e).__name__, "message": str(e)},
+             raise_error: Callable[[dict], Exception] = lambda e: ReplayedError(e["type"], e["message"])) -> Tuple[Any, float]:
+        """
+        Runs `func` (off/record) or serves the recording (replay). Returns (result, latency_seconds),
+        where the latency is the measured one, or the recorded one when replaying, so replayed
+        outputs match the recorded run exactly. `serialize` must return JSON-serializable data;
+        `serialize_error` may return None for local errors that shouldn't be recorded.
+        """
+        if self.replaying:
+            return self._replay(namespace, key, deserialize, raise_error)
+        start = time.monotonic()
+        try:
+            result = func()
+        except Exception as e:
+            if self.recording:
+                error = serialize_error(e)
+                if error is not None:
+                    self._record(namespace, key, time.monotonic() - start, None, error)
+            raise
+        latency = time.monotonic() - start
+        if self.recording:
+            self._record(namespace, key, latency, serialize(result), None)
+        return result, latency
+
+    def _record(self, namespace: str, key: str, latency: float, payload, error: Optional[dict]):
+        with self._lock:
+            conn = self._connection()
+            counter_key = (namespace, key)
+            if counter_key not in self._recorded_counts:
+                # Continue after whatever an earlier recording session stored for this request.
+                self._recorded_counts[counter_key] = conn.execute(
+                    "SELECT COUNT(*) FROM cassette_entries WHERE namespace = ? AND request_key = ?", counter_key).fetchone()[0]
+            occurrence = self._recorded_counts[counter_key]
+            self._recorded_counts[counter_key] += 1
+            conn.execute("""
+                INSERT OR REPLACE INTO cassette_entries (namespace, request_key, occurrence, latency_seconds, payload, error, recorded_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, (namespace, key, occurrence, latency, None if payload is None else _pack(payload),
+                  None if error is None else _pack(error), datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")))
+            conn.commit()
+            self.recorded += 1
+
+    def _replay(self, namespace: str, key: str, deserialize, raise_error) -> Tuple[Any, float]:
+        with self._lock:
+            conn = self._connection()
+            position = self._replay_positions.get((namespace, key), 0)
+            row = conn.execute("""
+                SELECT occurrence, latency_seconds, payload, error FROM cassette_entries
+                WHERE namespace = ? AND request_key = ? AND occurrence <= ?
+                ORDER BY occurrence DESC LIMIT 1
+            """, (namespace, key, position)).fetchone()
+            if row is None:
+                self.misses += 1
+                raise CassetteMissError(namespace, key)
+            self._replay_positions[(namespace, key)] = position + 1
+            self.replayed += 1
+        _, latency, payload, error = row
+        if self.replay_latency == "recorded":
+            time.sleep(latency)
+        if error is not None:
+            raise raise_error(_unpack(error))
+        return deserialize(_unpack(payload)), latency
+
+    def snapshot(self) -> dict:
+        return {"mode": self.mode, "path": self.path if self.mode != "off" else None, "replay_latency": self.replay_latency,
+                "recorded": self.recorded, "replayed": self.replayed, "misses": self.misses}
+
+
+store = CassetteStore()
+
+
+def sheets_request_builder(cassette_store: CassetteStore = store):
+    """
+    Returns a googleapiclient HttpRequest subclass for build(requestBuilder=...) that routes
+    every execute() of the service through the cassette store, keyed on method, URI and body.
+    HttpErrors are recorded with their status and content and raised again on replay.
+    """
+    import httplib2
+    from googleapiclient.http import HttpRequest
+    from googleapiclient.errors import HttpError
+
+    def serialize_error(e: Exception) -> dict:
+        if isinstance(e, HttpError):
+            content = e.content.decode("utf-8", "replace") if isinstance(e.content, bytes) else str(e.content)
+            return {"type": "HttpError", "status": e.resp.status, "content": content, "uri": e.uri}
+        return {"type": type(e).__name__, "message": str(e)}
+
+    def raise_error(error: dict) -> Exception:
+        if error["type"] == "HttpError":
+            return HttpError(httplib2.Response({"status": error["status"]}), error["content"].encode("utf-8"), uri=error["uri"])
+        return ReplayedError(error["type"], error["message"])
+
+    class CassetteHttpRequest(HttpRequest):
+        def execute(self, http=None, num_retries=0):
+            key = request_key("sheets", self.method, self.uri, self.body)
+            result, _ = cassette_store.call(
+                "sheets", key, lambda: super(CassetteHttpRequest, self).execute(http=http, num_retries=num_retries),
+                serialize_error=serialize_error, raise_error=raise_error)
+            return result
+
+    return CassetteHttpRequest
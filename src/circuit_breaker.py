@@ -0,0 +1,159 @@
+# circuit_breaker.py
+import time
+import logging
+import threading
+from collections import deque
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half_open"
+
+# Errors that say the dependency itself is unhealthy (5xx, quota, timeouts, connection
+# failures). Anything else, e.g. InvalidArgument for a corrupt image or a content-policy
+# rejection, is about the request and must not open the circuit for everyone.
+TRANSIENT_ERROR_NAMES = frozenset({
+    "ServerError", "InternalServerError", "ServiceUnavailable", "GatewayTimeout", "DeadlineExceeded",
+    "ResourceExhausted", "TooManyRequests", "TimeoutError", "ConnectionError", "CircuitOpenError",
+})
+
+
+def is_transient_error(error: BaseException) -> bool:
+    """Matches class names along the MRO, so google-api-core needn't be importable here."""
+    return any(cls.__name__ in TRANSIENT_ERROR_NAMES for cls in type(error).__mro__)
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a dependency while its circuit is open."""
+
+    def __init__(self, name: str, retry_after_seconds: float):
+        self.name = name
+        self.retry_after_seconds = max(1, int(round(retry_after_seconds)))
+        super().__init__(f"Circuit '{name}' is open. Retry after {self.retry_after_seconds}s.")
+
+
+class CircuitBreaker:
+    """
+    Rolling-window circuit breaker.
+    Opens when, over the last `window_size` calls (and at least `min_calls`), the error
+    rate reaches `error_rate_threshold` or the share of calls slower than
+    `slow_call_seconds` reaches `slow_call_rate_threshold`. After `open_seconds` it
+    goes half-open and lets up to `half_open_max_probes` concurrent probe calls through;
+    `half_open_successes` successful probes close it again, any failed probe re-opens it.
+    Only exceptions for which `is_failure` is true count as failures; other exceptions
+    pass through without being recorded.
+    """
+
+    def __init__(self, name: str, error_rate_threshold: float = 0.5, slow_call_seconds: float = 30.0,
+                 slow_call_rate_threshold: float = 0.8, window_size: int = 20, min_calls: int = 10,
+                 open_seconds: float = 30.0, half_open_max_probes: int = 1, half_open_successes: int = 2,
+                 is_failure: Callable[[BaseException], bool] = is_transient_error):
+        self.name = name
+        self.error_rate_threshold = error_rate_threshold
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_call_rate_threshold = slow_call_rate_threshold
+        self.min_calls = min_calls
+        self.open_seconds = open_seconds
+        self.half_open_max_probes = half_open_max_probes
+        self.half_open_successes = half_open_successes
+        self.is_failure = is_failure
+
+        self._lock = threading.Lock()
+        self._outcomes = deque(maxlen=window_size)  # (failed, slow)
+        self._state = STATE_CLOSED
+        self._opened_at = 0.0
+        self._probes_in_flight = 0
+        self._probe_successes = 0
+        self._times_opened = 0
+        self._rejected = 0
+        self._ignored = 0
+
+    def _transition(self, state: str):
+        if state == self._state:
+            return
+        logger.warning(f"Circuit Breaker '{self.name}': {self._state} -> {state}")
+        self._state = state
+        if state == STATE_OPEN:
+            self._opened_at = time.monotonic()
+            self._times_opened += 1
+        elif state == STATE_HALF_OPEN:
+            self._probes_in_flight = 0
+            self._probe_successes = 0
+        elif state == STATE_CLOSED:
+            self._outcomes.clear()
+
+    def before_call(self):
+        """Reserves permission to call the dependency, or raises CircuitOpenError."""
+        with self._lock:
+            if self._state == STATE_OPEN:
+                remaining = self.open_seconds - (time.monotonic() - self._opened_at)
+                if remaining > 0:
+                    self._rejected += 1
+                    raise CircuitOpenError(self.name, remaining)
+                self._transition(STATE_HALF_OPEN)
+            if self._state == STATE_HALF_OPEN:
+                if self._probes_in_flight >= self.half_open_max_probes:
+                    self._rejected += 1
+                    raise CircuitOpenError(self.name, 1)
+                self._probes_in_flight += 1
+
+    def after_call(self, failed: bool, latency_seconds: float):
+        slow = latency_seconds >= self.slow_call_seconds
+        with self._lock:
+            if self._state == STATE_HALF_OPEN:
+                self._probes_in_flight = max(0, self._probes_in_flight - 1)
+                if failed or slow:
+                    self._transition(STATE_OPEN)
+                else:
+                    self._probe_successes += 1
+                    if self._probe_successes >= self.half_open_successes:
+                        self._transition(STATE_CLOSED)
+                return
+            self._outcomes.append((failed, slow))
+            if self._state == STATE_CLOSED and len(self._outcomes) >= self.min_calls:
+                error_rate = sum(1 for f, _ in self._outcomes if f) / len(self._outcomes)
+                slow_rate = sum(1 for _, s in self._outcomes if s) / len(self._outcomes)
+                if error_rate >= self.error_rate_threshold or slow_rate >= self.slow_call_rate_threshold:
+                    self._transition(STATE_OPEN)
+
+    def release_call(self):
+        """Ends a call admitted by before_call() without recording an outcome (e.g. a client error)."""
+        with self._lock:
+            self._ignored += 1
+            if self._state == STATE_HALF_OPEN:
+                self._probes_in_flight = max(0, self._probes_in_flight - 1)
+
+    def call(self, func, *args, **kwargs):
+        self.before_call()
+        start = time.monotonic()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            if self.is_failure(e):
+                self.after_call(True, time.monotonic() - start)
+            else:
+                self.release_call()
+            raise
+        self.after_call(False, time.monotonic() - start)
+        return result
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            state = self._state
+            retry_after = None
+            if state == STATE_OPEN:
+                retry_after = max(0.0, self.open_seconds - (time.monotonic() - self._opened_at))
+            outcomes = list(self._outcomes)
+            return {
+                "name": self.name,
+                "state": state,
+                "retry_after_seconds": round(retry_after, 1) if retry_after is not None else None,
+                "window_calls": len(outcomes),
+                "window_error_rate": round(sum(1 for f, _ in outcomes if f) / len(outcomes), 3) if outcomes else 0.0,
+                "window_slow_rate": round(sum(1 for _, s in outcomes if s) / len(outcomes), 3) if outcomes else 0.0,
+                "times_opened": self._times_opened,
+                "rejected_calls": self._rejected,
+                "ignored_errors": self._ignored,
+            }
@@ -0,0 +1,218 @@
+# embedding_index.py
+import os
+import hashlib
+import logging
+import threading
+from typing import Optional, List, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_DIMENSION = int(os.getenv("EMBEDDING_DIMENSION", "256"))
+SEARCH_CHUNK_ROWS = int(os.getenv("EMBEDDING_SEARCH_CHUNK_ROWS", "4096"))
+# Queries score a resident float32 copy of the matrix (4 bytes x dims per image, ~1 GB at
+# 1M x 256) in one BLAS call. Set to false on small hosts to score the float16 file through
+# the memory map instead, converting it chunk by chunk (~2.5x slower, page cache only).
+RESIDENT_FLOAT32 = os.getenv("EMBEDDING_RESIDENT_FLOAT32", "true").lower() in ("1", "true", "yes")
+
+VECTORS_FILENAME = "embeddings.f16"
+IDS_FILENAME = "embeddings.ids"
+
+
+# --- Embedding backends ---
+
+class EmbeddingBackend:
+    """
+    Turns image bytes into a fixed-size vector. Subclasses implement embed(); billed backends
+    fill `call_info` with calls, latency_seconds and estimated_cost_usd for the usage ledger.
+    """
+    name = "base"
+    billed = False
+
+    def __init__(self, dimension: int = EMBEDDING_DIMENSION):
+        self.dimension = dimension
+
+    def embed(self, image_bytes: bytes, mime_type: str, call_info: Optional[dict] = None) -> np.ndarray:
+        raise NotImplementedError
+
+
+class LocalHashEmbeddingBackend(EmbeddingBackend):
+    """
+    Deterministic, dependency-free backend for tests and offline runs: a byte histogram
+    projected through a fixed seeded random matrix. Identical bytes give identical vectors;
+    it says nothing about visual content.
+    """
+    name = "local"
+
+    def __init__(self, dimension: int = EMBEDDING_DIMENSION, seed: int = 1234):
+        super().__init__(dimension)
+        self._projection = np.random.default_rng(seed).standard_normal((256, dimension)).astype(np.float32)
+
+    def embed(self, image_bytes: bytes, mime_type: str, call_info: Optional[dict] = None) -> np.ndarray:
+        histogram = np.bincount(np.frombuffer(image_bytes, dtype=np.uint8), minlength=256).astype(np.float32)
+        histogram /= max(1.0, float(histogram.sum()))
+        digest = np.frombuffer(hashlib.sha256(image_bytes).digest(), dtype=np.uint8).astype(np.float32)
+        histogram[:32] += digest / 255.0 * 1e-3  # keeps different files with equal histograms apart
+        return histogram @ self._projection
+
+
+class VertexMultimodalEmbeddingBackend(EmbeddingBackend):
+    """
+    Vertex AI multimodal embeddings (multimodalembedding@001). Supports 128/256/512/1408 dims.
+    Each embed() is a paid call, sent through the extractor's endpoint pool, circuit breaker
+    and cassette store like the Gemini calls.
+    """
+    name = "vertex"
+    billed = True
+
+    def __init__(self, dimension: int = EMBEDDING_DIMENSION, model_name: str = "multimodalembedding@001"):
+        super().__init__(dimension)
+        self.model_name = model_name
+
+    def embed(self, image_bytes: bytes, mime_type: str, call_info: Optional[dict] = None) -> np.ndarray:
+        import gemini_keyword_extractor
+        vector = gemini_keyword_extractor.generate_image_embedding(image_bytes, self.model_name, self.dimension, call_info)
+        return np.asarray(vector, dtype=np.float32)
+
+
+EMBEDDING_BACKENDS = {
+    LocalHashEmbeddingBackend.name: LocalHashEmbeddingBackend,
+    VertexMultimodalEmbeddingBackend.name: VertexMultimodalEmbeddingBackend,
+}
+
+
+def create_backend(name: str, dimension: int = EMBEDDING_DIMENSION) -> Optional[EmbeddingBackend]:
+    if not name or name == "none":
+        return None
+    if name not in EMBEDDING_BACKENDS:
+        raise ValueError(f"Unknown embedding backend '{name}'. Choose from: {', '.join(EMBEDDING_BACKENDS)}.")
+    return EMBEDDING_BACKENDS[name](dimension)
+
+
+# --- Append-only memory-mapped index ---
+
+class EmbeddingIndex:
+    """
+    Append-only float16 matrix on disk (one L2-normalized row per image) plus a
+    parallel file of filenames. New vectors are appended without rewriting the
+    matrix; queries score a resident float32 copy that grows with it (or the
+    memory-mapped file in chunks, see RESIDENT_FLOAT32) with NumPy dot products
+    and an argpartition top-k, so there are no Python loops over rows.
+    Re-embedding a filename appends a new row and masks the old one.
+    """
+
+    def __init__(self, directory: str, dimension: int = EMBEDDING_DIMENSION):
+        self.directory = directory
+        self.dimension = dimension
+        self.vectors_path = os.path.join(directory, VECTORS_FILENAME)
+        self.ids_path = os.path.join(directory, IDS_FILENAME)
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+        self._ids: List[str] = []
+        if os.path.exists(self.ids_path):
+            with open(self.ids_path, "r", encoding="utf-8") as f:
+                self._ids = [line.rstrip("\n") for line in f]
+        row_bytes = 2 * dimension
+        vector_rows = os.path.getsize(self.vectors_path) // row_bytes if os.path.exists(self.vectors_path) else 0
+        # A crash between the two appends leaves one file longer; trust the shorter one.
+        rows = min(vector_rows, len(self._ids))
+        if vector_rows != rows:
+            with open(self.vectors_path, "r+b") as f:
+                f.truncate(rows * row_bytes)
+        if len(self._ids) != rows:
+            self._ids = self._ids[:rows]
+            with open(self.ids_path, "w", encoding="utf-8") as f:
+                f.writelines(f"{name}\n" for name in self._ids)
+
+        self._latest_row = {name: row for row, name in enumerate(self._ids)}
+        self._live = np.zeros(rows, dtype=bool)
+        if rows:
+            self._live[list(self._latest_row.values())] = True
+        self._matrix = None
+        self._matrix_rows = 0
+        self._resident = None
+        if RESIDENT_FLOAT32:
+            self._mapped_matrix()  # pay the float16 -> float32 load at start-up, not on the first query
+        logger.info(f"Embedding Index: Loaded {len(self._latest_row)} images ({rows} rows) from {directory}.")
+
+    def __len__(self) -> int:
+        return len(self._latest_row)
+
+    def add(self, filename: str, vector: np.ndarray):
+        vector = np.asarray(vector, dtype=np.float32).reshape(-1)
+        if vector.shape[0] != self.dimension:
+            raise ValueError(f"Embedding has {vector.shape[0]} dimensions, index expects {self.dimension}.")
+        norm = float(np.linalg.norm(vector))
+        if norm == 0.0:
+            raise ValueError("Cannot index a zero vector.")
+        row_bytes = (vector / norm).astype(np.float16).tobytes()
+        with self._lock:
+            with open(self.vectors_path, "ab") as f:
+                f.write(row_bytes)
+            with open(self.ids_path, "a", encoding="utf-8") as f:
+                f.write(f"{filename}\n")
+            row = len(self._ids)
+            self._ids.append(filename)
+            previous = self._latest_row.get(filename)
+            self._latest_row[filename] = row
+            if row >= len(self._live):
+                grown = np.zeros(max(1024, 2 * len(self._live)), dtype=bool)
+                grown[:len(self._live)] = self._live
+                self._live = grown
+            self._live[row] = True
+            if previous is not None:
+                self._live[previous] = False
+
+    def _mapped_matrix(self) -> Tuple[np.ndarray, np.ndarray]:
+        with self._lock:
+            rows = len(self._ids)
+            if self._matrix_rows != rows:
+                mapped = np.memmap(self.vectors_path, dtype=np.float16, mode="r", shape=(rows, self.dimension)) if rows else None
+                if RESIDENT_FLOAT32 and mapped is not None:
+                    if self._resident is None or self._resident.shape[0] < rows:
+                        grown = np.empty((max(1024, 2 * rows), self.dimension), dtype=np.float32)
+                        grown[:self._matrix_rows] = self._resident[:self._matrix_rows] if self._resident is not None else 0
+                        self._resident = grown
+                    self._resident[self._matrix_rows:rows] = mapped[self._matrix_rows:rows]
+                    self._matrix = self._resident[:rows]
+                else:
+                    self._matrix = mapped
+                self._matrix_rows = rows
+            return self._matrix, self._live[:rows]
+
+    def get_vector(self, filename: str) -> Optional[np.ndarray]:
+        row = self._latest_row.get(filename)
+        if row is None:
+            return None
+        matrix, _ = self._mapped_matrix()
+        return np.asarray(matrix[row], dtype=np.float32)
+
+    def search(self, query: np.ndarray, k: int = 10, exclude: Optional[str] = None) -> List[Tuple[str, float]]:
+        """Returns up to k (filename, cosine_similarity) pairs, most similar first."""
+        matrix, live = self._mapped_matrix()
+        if matrix is None or k <= 0:
+            return []
+        query = np.asarray(query, dtype=np.float32).reshape(-1)
+        query = query / max(float(np.linalg.norm(query)), 1e-12)
+        exclude_row = self._latest_row.get(exclude) if exclude else None
+
+        # A resident float32 matrix is scored in one pass; float16 is converted chunk by chunk.
+        chunk_rows = matrix.shape[0] if matrix.dtype == np.float32 else SEARCH_CHUNK_ROWS
+        best_scores = np.empty(0, dtype=np.float32)
+        best_rows = np.empty(0, dtype=np.int64)
+        for start in range(0, matrix.shape[0], chunk_rows):
+            chunk = matrix[start:start + chunk_rows]
+            if chunk.dtype != np.float32:
+                chunk = chunk.astype(np.float32)
+            scores = chunk @ query
+            np.putmask(scores, ~live[start:start + chunk_rows], -np.inf)
+            if exclude_row is not None and start <= exclude_row < start + len(scores):
+                scores[exclude_row - start] = -np.inf
+            take = min(k, len(scores))
+            top = np.argpartition(-scores, take - 1)[:take]
+            best_scores = np.concatenate([best_scores, scores[top]])
+            best_rows = np.concatenate([best_rows, top + start])
+        order = np.argsort(-best_scores)[:k]
+        return [(self._ids[best_rows[i]], float(best_scores[i])) for i in order if np.isfinite(best_scores[i])]
@@ -0,0 +1,219 @@
+# endpoint_pool.py
+import os
+import time
+import random
+import logging
+import threading
+from collections import deque
+from typing import Any, Callable, List, Optional, Tuple
+
+from circuit_breaker import CircuitBreaker, CircuitOpenError, STATE_OPEN, is_transient_error
+
+logger = logging.getLogger(__name__)
+
+POOL_LATENCY_ALPHA = float(os.getenv("VERTEX_POOL_LATENCY_ALPHA", "0.2"))  # weight of the newest sample in the EWMA
+POOL_EXPLORE_RATE = float(os.getenv("VERTEX_POOL_EXPLORE_RATE", "0.05"))  # share of calls sent to a random endpoint
+POOL_QUOTA_COOLDOWN_SECONDS = float(os.getenv("VERTEX_POOL_QUOTA_COOLDOWN_SECONDS", "60"))
+POOL_FAILOVER = os.getenv("VERTEX_POOL_FAILOVER", "true").lower() in ("1", "true", "yes")
+
+# Transient errors (circuit_breaker.is_transient_error) say "this endpoint, right now" rather
+# than "this request": they count against the endpoint and are worth retrying elsewhere.
+_QUOTA_ERRORS = ("ResourceExhausted", "TooManyRequests")
+
+
+def _error_name(error: Exception) -> str:
+    return type(error).__name__
+
+
+class Endpoint:
+    """
+    One project/location pair. Tracks an EWMA of call latency, calls started in the last
+    minute against an optional requests-per-minute quota, and has its own circuit breaker,
+    so a failing endpoint drops out of rotation and is probed back in once it recovers.
+    """
+
+    def __init__(self, project: str, location: str, requests_per_minute: Optional[int] = None):
+        self.project = project
+        self.location = location
+        self.name = f"{project}/{location}"
+        self.requests_per_minute = requests_per_minute
+        self.breaker = CircuitBreaker(
+            f"vertex:{self.name}",
+            error_rate_threshold=float(os.getenv("VERTEX_ENDPOINT_BREAKER_ERROR_RATE", "0.5")),
+            window_size=int(os.getenv("VERTEX_ENDPOINT_BREAKER_WINDOW", "20")),
+            min_calls=int(os.getenv("VERTEX_ENDPOINT_BREAKER_MIN_CALLS", "5")),
+            open_seconds=float(os.getenv("VERTEX_ENDPOINT_BREAKER_OPEN_SECONDS", "30")),
+        )
+        self._lock = threading.Lock()
+        self._recent_starts = deque()
+        self.latency_ewma: Optional[float] = None
+        self.in_flight = 0
+        self.calls = 0
+        self.errors = 0
+        self.quota_errors = 0
+        self.throttled_until = 0.0
+        self.last_error: Optional[str] = None
+
+    def _prune(self, now: float):
+        while self._recent_starts and now - self._recent_starts[0] > 60:
+            self._recent_starts.popleft()
+
+    def headroom(self) -> float:
+        """Fraction of the per-minute quota left (1.0 without a quota, 0.0 while throttled)."""
+        now = time.monotonic()
+        with self._lock:
+            if now < self.throttled_until:
+                return 0.0
+            if not self.requests_per_minute:
+                return 1.0
+            self._prune(now)
+            return max(0.0, 1.0 - len(self._recent_starts) / self.requests_per_minute)
+
+    def available(self) -> bool:
+        snapshot = self.breaker.snapshot()
+        return not (snapshot["state"] == STATE_OPEN and snapshot["retry_after_seconds"])
+
+    def score(self) -> float:
+        """Expected cost of sending the next call here; lower is better. Unmeasured endpoints go first."""
+        headroom = self.headroom()
+        if headroom <= 0:
+            return float("inf")  # throttled or out of quota: only used when nothing else is left
+        latency = self.latency_ewma or 0.0
+        return latency * (1 + self.in_flight) / max(headroom, 0.05)
+
+    def run(self, func: Callable[["Endpoint"], Any]) -> Any:
+        """Runs func(endpoint) through the endpoint's breaker (which must already have admitted the call)."""
+        now = time.monotonic()
+        with self._lock:
+            self._prune(now)
+            self._recent_starts.append(now)
+            self.in_flight += 1
+            self.calls += 1
+        failed = errored = False
+        try:
+            return func(self)
+        except Exception as e:
+            # Request-specific errors (a rejected image, a bad argument) don't mark the endpoint unhealthy.
+            errored, failed = True, is_transient_error(e)
+            with self._lock:
+                self.errors += 1
+                self.last_error = f"{_error_name(e)}: {e}"[:300]
+                if _error_name(e) in _QUOTA_ERRORS:
+                    self.quota_errors += 1
+                    self.throttled_until = time.monotonic() + POOL_QUOTA_COOLDOWN_SECONDS
+            raise
+        finally:
+            latency = time.monotonic() - now
+            with self._lock:
+                self.in_flight -= 1
+                if not errored:
+                    self.latency_ewma = latency if self.latency_ewma is None else \
+                        POOL_LATENCY_ALPHA * latency + (1 - POOL_LATENCY_ALPHA) * self.latency_ewma
+            if errored and not failed:
+                self.breaker.release_call()
+            else:
+                self.breaker.after_call(failed, latency)
+
+    def snapshot(self) -> dict:
+        headroom = self.headroom()
+        with self._lock:
+            self._prune(time.monotonic())
+            return {
+                "project": self.project,
+                "location": self.location,
+                "available": self.available(),
+                "latency_ewma_seconds": round(self.latency_ewma, 3) if self.latency_ewma is not None else None,
+                "in_flight": self.in_flight,
+                "requests_last_minute": len(self._recent_starts),
+                "requests_per_minute_quota": self.requests_per_minute,
+                "quota_headroom": round(headroom, 3),
+                "calls": self.calls,
+                "errors": self.errors,
+                "quota_errors": self.quota_errors,
+                "last_error": self.last_error,
+                "circuit_breaker": self.breaker.snapshot(),
+            }
+
+
+class EndpointPool:
+    """
+    Routes each call to the available endpoint with the lowest latency-and-quota score, sending
+    a small share to a random endpoint so recovered or idle endpoints get fresh measurements.
+    On a quota or availability error the call is retried once on the next-best endpoint.
+    The pool knows nothing about the Vertex SDK: `func(endpoint)` does the actual call, so
+    stand-in endpoints and functions can be used to exercise routing locally.
+    """
+
+    def __init__(self, endpoints: List[Endpoint], explore_rate: float = POOL_EXPLORE_RATE, failover: bool = POOL_FAILOVER):
+        if not endpoints:
+            raise ValueError("An endpoint pool needs at least one endpoint.")
+        self.endpoints = endpoints
+        self.explore_rate = explore_rate
+        self.failover = failover
+        self.failovers = 0
+        self.explored = 0
+
+    @property
+    def default(self) -> Endpoint:
+        return self.endpoints[0]
+
+    def _ranked(self, exclude: Tuple[Endpoint, ...] = ()) -> List[Endpoint]:
+        scored = sorted(((e.score(), e) for e in self.endpoints if e not in exclude and e.available()), key=lambda item: item[0])
+        candidates = [e for _, e in scored]
+        explorable = sum(1 for score, _ in scored if score != float("inf"))
+        if explorable > 1 and random.random() < self.explore_rate:
+            self.explored += 1
+            candidates.insert(0, candidates.pop(random.randrange(1, explorable)))
+        return candidates
+
+    def _admit(self, exclude: Tuple[Endpoint, ...] = ()) -> Endpoint:
+        """The best endpoint whose breaker admits a call; CircuitOpenError if none does."""
+        for endpoint in self._ranked(exclude):
+            try:
+                endpoint.breaker.before_call()
+                return endpoint
+            except CircuitOpenError:
+                continue
+        retry_after = min((e.breaker.snapshot()["retry_after_seconds"] or 1 for e in self.endpoints), default=1)
+        raise CircuitOpenError("vertex_endpoint_pool", retry_after)
+
+    def call(self, func: Callable[[Endpoint], Any]) -> Tuple[Any, Endpoint]:
+        """Returns (func(endpoint), endpoint) for the endpoint that served the call."""
+        endpoint = self._admit()
+        try:
+            return endpoint.run(func), endpoint
+        except Exception as e:
+            if not self.failover or not is_transient_error(e) or len(self.endpoints) < 2:
+                raise
+            try:
+                fallback = self._admit(exclude=(endpoint,))
+            except CircuitOpenError:
+                raise e
+            self.failovers += 1
+            logger.warning("Vertex Endpoint Pool: %s failed with %s; retrying on %s.", endpoint.name, _error_name(e), fallback.name)
+            return fallback.run(func), fallback
+
+    def snapshot(self) -> dict:
+        return {
+            "failovers": self.failovers,
+            "explored": self.explored,
+            "endpoints": {e.name: e.snapshot() for e in self.endpoints},
+        }
+
+
+def parse_endpoints(spec: str) -> List[Endpoint]:
+    """
+    Parses "project/location[@requests_per_minute],..." e.g.
+    "omi-photos/us-central1@300,omi-photos/europe-west4@300,omi-photos-b/us-east4".
+    """
+    endpoints = []
+    for entry in spec.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        address, _, quota = entry.partition("@")
+        project, _, location = address.partition("/")
+        if not project or not location:
+            raise ValueError(f"Invalid Vertex endpoint '{entry}'; expected project/location[@requests_per_minute].")
+        endpoints.append(Endpoint(project.strip(), location.strip(), int(quota) if quota.strip() else None))
+    return endpoints
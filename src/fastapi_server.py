@@ -1,28 +1,54 @@
 # fastapi_server.py
 import os
 import shutil
+import asyncio
 import logging
 import mimetypes
+import mmap
+import time
+import hmac
+from collections import Counter
+from datetime import datetime, timezone
+from contextlib import asynccontextmanager
+from typing import Optional
 
-# --- Environment Variable Loading ---
+# --- Environment Variable Loading (once, before any module reads its configuration) ---
 from dotenv import load_dotenv
 load_dotenv() 
 logger = logging.getLogger(__name__) 
-logger.info("FastAPI Server: Attempted to load .env file.")
 
+# JSON lines through a non-blocking queue; see structured_logging.py (LOG_FORMAT, LOG_LEVEL, LOG_DEBUG_SAMPLE_RATE).
+# Configured in the lifespan hook, so importing this module leaves logging untouched.
+import structured_logging
+from structured_logging import truncate
+import tracing
+from tracing import span
 
-from fastapi import FastAPI, File, UploadFile, HTTPException
-from fastapi.responses import JSONResponse, FileResponse
+
+from fastapi import FastAPI, File, UploadFile, HTTPException, Header, Query
+from fastapi.responses import JSONResponse, StreamingResponse
 
 import gemini_keyword_extractor # Your updated module
+import image_metadata
+import usage_ledger as usage_ledger_module
+import results_store as results_store_module
+import backfill
+from circuit_breaker import CircuitOpenError
+import keyword_normalizer
+from inflight_budget import InflightBytesBudget, BudgetExhaustedError
+from request_coalescing import SingleFlight, IdempotencyCache
+import admission_control
+import cassettes
+import media_expansion
+import image_validation
+import storage_backends
+from concurrent.futures import ProcessPoolExecutor
 
 # --- Google Sheets Imports ---
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
+# Only the lightweight error type is imported here; the discovery client and credentials
+# are imported when the service is built in the lifespan hook.
 from googleapiclient.errors import HttpError
 
-logging.basicConfig(level=logging.INFO) 
-
 # --- Configuration for Google Sheets ---
 SERVICE_ACCOUNT_FILE = os.getenv('GOOGLE_APPLICATION_CREDENTIALS')
 logger.info(f"FastAPI Server: GOOGLE_APPLICATION_CREDENTIALS read as: {SERVICE_ACCOUNT_FILE}")
@@ -34,45 +60,270 @@ logger.info(f"FastAPI Server: GOOGLE_SHEETS_ID read as: {SPREADSHEET_ID}")
 SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
 SHEET_NAME_FOR_KEYWORDS = 'Photos' 
 # --- MODIFIED HEADERS: Removed "Prompt Used" ---
-SHEET_HEADERS = ["Filename", "Keywords", "Description"] 
+SHEET_HEADERS = ["Filename", "Keywords", "Description", "Model Version", "Prompt Version"] 
 
-# --- Initialize Google Sheets Service ---
+# --- Google Sheets Service (built in the lifespan hook) ---
 sheets_service = None
-try:
-    if not SERVICE_ACCOUNT_FILE:
-        logger.error("FastAPI Server: GOOGLE_APPLICATION_CREDENTIALS environment variable is not set OR was not loaded from .env. Google Sheets integration will be disabled.")
-    elif not os.path.exists(SERVICE_ACCOUNT_FILE):
-        logger.error(f"FastAPI Server: Service account key file NOT FOUND at path specified by GOOGLE_APPLICATION_CREDENTIALS: {SERVICE_ACCOUNT_FILE}. Google Sheets integration will be disabled.")
-    elif not SPREADSHEET_ID:
-        logger.error("FastAPI Server: GOOGLE_SHEETS_ID environment variable is not set OR was not loaded from .env. Google Sheets integration will be disabled.")
-    else:
-        creds = service_account.Credentials.from_service_account_file(
-            SERVICE_ACCOUNT_FILE, scopes=SCOPES)
-        sheets_service = build('sheets', 'v4', credentials=creds)
-        logger.info(f"FastAPI Server: Google Sheets service initialized successfully for SPREADSHEET_ID: {SPREADSHEET_ID}.")
-except Exception as e:
-    logger.error(f"FastAPI Server: Failed to initialize Google Sheets service: {e}", exc_info=True)
-    sheets_service = None
+
+def _initialize_sheets_service():
+    global sheets_service
+    try:
+        if cassettes.store.replaying and SPREADSHEET_ID:
+            # Offline: requests are built as usual and answered from the cassette store.
+            from google.auth.credentials import AnonymousCredentials
+            from googleapiclient.discovery import build
+            sheets_service = build('sheets', 'v4', credentials=AnonymousCredentials(), static_discovery=True,
+                                   cache_discovery=False, requestBuilder=cassettes.sheets_request_builder())
+            logger.info(f"FastAPI Server: Google Sheets service replaying from cassettes for SPREADSHEET_ID: {SPREADSHEET_ID}.")
+            ensure_sheet_with_headers(sheets_service, SPREADSHEET_ID, SHEET_NAME_FOR_KEYWORDS, SHEET_HEADERS)
+        elif not SERVICE_ACCOUNT_FILE:
+            logger.error("FastAPI Server: GOOGLE_APPLICATION_CREDENTIALS environment variable is not set OR was not loaded from .env. Google Sheets integration will be disabled.")
+        elif not os.path.exists(SERVICE_ACCOUNT_FILE):
+            logger.error(f"FastAPI Server: Service account key file NOT FOUND at path specified by GOOGLE_APPLICATION_CREDENTIALS: {SERVICE_ACCOUNT_FILE}. Google Sheets integration will be disabled.")
+        elif not SPREADSHEET_ID:
+            logger.error("FastAPI Server: GOOGLE_SHEETS_ID environment variable is not set OR was not loaded from .env. Google Sheets integration will be disabled.")
+        else:
+            from google.oauth2 import service_account
+            from googleapiclient.discovery import build
+            creds = service_account.Credentials.from_service_account_file(
+                SERVICE_ACCOUNT_FILE, scopes=SCOPES)
+            # static_discovery uses the discovery document bundled with the client library,
+            # so no network round trip is made at startup.
+            build_options = {"requestBuilder": cassettes.sheets_request_builder()} if cassettes.store.recording else {}
+            sheets_service = build('sheets', 'v4', credentials=creds, static_discovery=True, cache_discovery=False, **build_options)
+            logger.info(f"FastAPI Server: Google Sheets service initialized successfully for SPREADSHEET_ID: {SPREADSHEET_ID}.")
+            if not ensure_sheet_with_headers(sheets_service, SPREADSHEET_ID, SHEET_NAME_FOR_KEYWORDS, SHEET_HEADERS):
+                logger.error(f"FastAPI Server: Failed to ensure '{SHEET_NAME_FOR_KEYWORDS}' sheet is ready on startup. Check permissions and SPREADSHEET_ID.")
+    except Exception as e:
+        logger.error(f"FastAPI Server: Failed to initialize Google Sheets service: {e}", exc_info=True)
+        sheets_service = None
+
+# --- Embedded image metadata (IPTC/XMP) ---
+EMBED_IMAGE_METADATA = os.getenv('EMBED_IMAGE_METADATA', 'true').lower() in ('1', 'true', 'yes')
+SKIP_ALREADY_TAGGED = os.getenv('SKIP_ALREADY_TAGGED', 'true').lower() in ('1', 'true', 'yes')
 
 # --- UPLOAD_DIRECTORY setup ---
 UPLOAD_DIR_NAME = "uploaded_files_backend"
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
-UPLOAD_DIRECTORY = os.path.join(SCRIPT_DIR, UPLOAD_DIR_NAME)
-if not os.path.exists(UPLOAD_DIRECTORY):
+UPLOAD_DIRECTORY = os.path.join(SCRIPT_DIR, UPLOAD_DIR_NAME)  # created by the local storage backend
+
+# --- Similar-image search ---
+# Off by default: 'vertex' makes a second paid Vertex call per extraction (counted in the usage
+# ledger and held back by its budgets); 'local' is a deterministic stand-in for tests.
+EMBEDDING_BACKEND = os.getenv('EMBEDDING_BACKEND', 'none')
+EMBEDDING_INDEX_DIRECTORY = os.getenv('EMBEDDING_INDEX_DIRECTORY', os.path.join(SCRIPT_DIR, "embeddings_index"))
+embedding_backend = None
+image_index = None
+
+def _initialize_embedding_index():
+    global embedding_backend, image_index
     try:
-        os.makedirs(UPLOAD_DIRECTORY)
-        logger.info(f"FastAPI Server: Created upload directory at: {UPLOAD_DIRECTORY}")
-    except OSError as e:
-        logger.error(f"FastAPI Server: Could not create upload directory at {UPLOAD_DIRECTORY}: {e}")
-else:
-    logger.info(f"FastAPI Server: Upload directory already exists at: {UPLOAD_DIRECTORY}")
+        import embedding_index  # numpy is only needed once the index is in use
+        embedding_backend = embedding_index.create_backend(EMBEDDING_BACKEND)
+        if embedding_backend:
+            image_index = embedding_index.EmbeddingIndex(EMBEDDING_INDEX_DIRECTORY, embedding_backend.dimension)
+            logger.info(f"FastAPI Server: Similar-image search enabled with '{EMBEDDING_BACKEND}' embeddings at {EMBEDDING_INDEX_DIRECTORY}.")
+    except Exception as e:
+        logger.error(f"FastAPI Server: Failed to set up the embedding index: {e}", exc_info=True)
+        embedding_backend = None
+        image_index = None
+
+# --- In-flight memory budget (shared by uploads and extractions) ---
+INFLIGHT_BYTES_LIMIT = int(os.getenv('INFLIGHT_BYTES_LIMIT', str(256 * 1024 * 1024)))
+INFLIGHT_WAIT_TIMEOUT_SECONDS = float(os.getenv('INFLIGHT_WAIT_TIMEOUT_SECONDS', '10'))
+# Peak bytes per byte of file during an extraction: the mapped file (1x), the bytes copy
+# handed to Part.from_data (1x) and the base64-encoded request body the SDK builds from it
+# (~1.33x) are all alive at once while the request is sent. With hedging on, a hedged
+# duplicate shares the Part but builds its own base64 body (another ~1.33x).
+EXTRACTION_MEMORY_FACTOR = float(os.getenv('EXTRACTION_MEMORY_FACTOR', '4.7' if gemini_keyword_extractor.HEDGING_ENABLED else '3.4'))
+UPLOAD_COPY_CHUNK_BYTES = 1024 * 1024
+inflight_budget = InflightBytesBudget(INFLIGHT_BYTES_LIMIT, INFLIGHT_WAIT_TIMEOUT_SECONDS)
+
+# --- Upload validation (Pillow decoding runs in a process pool, off the GIL and event loop) ---
+IMAGE_VALIDATION_ENABLED = os.getenv('IMAGE_VALIDATION_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+IMAGE_VALIDATION_WORKERS = int(os.getenv('IMAGE_VALIDATION_WORKERS', str(min(4, os.cpu_count() or 1))))
+_validation_pool = None
+
+def _get_validation_pool():
+    global _validation_pool
+    if _validation_pool is None:
+        _validation_pool = ProcessPoolExecutor(max_workers=IMAGE_VALIDATION_WORKERS)
+    return _validation_pool
+
+# --- Token/cost ledger ---
+USAGE_DB_PATH = os.getenv('USAGE_DB_PATH', os.path.join(SCRIPT_DIR, "usage_ledger.sqlite3"))
+usage_ledger = None
+
+def _initialize_usage_ledger():
+    global usage_ledger
+    usage_ledger = usage_ledger_module.UsageLedger(USAGE_DB_PATH)
+DEFERRED_POLL_SECONDS = float(os.getenv('DEFERRED_POLL_SECONDS', '60'))
+
+# --- Local copy of every extraction result (source for /export) ---
+RESULTS_DB_PATH = os.getenv('RESULTS_DB_PATH', os.path.join(SCRIPT_DIR, "extraction_results.sqlite3"))
+EXPORT_PAGE_ROWS = int(os.getenv('EXPORT_PAGE_ROWS', '5000'))
+results_store = None
+
+def _initialize_results_store():
+    global results_store
+    results_store = results_store_module.ResultsStore(RESULTS_DB_PATH)
+
+# --- Re-extraction of results from older model/prompt versions ---
+backfill_scheduler = None
+_interactive_extractions = 0  # /extract-keywords calls in progress; the backfill yields to them
+
+# --- Duplicate-request handling ---
+# Concurrent extractions of the same file content share one run; Idempotency-Key retries
+# within the TTL replay the stored response.
+IDEMPOTENCY_TTL_SECONDS = float(os.getenv('IDEMPOTENCY_TTL_SECONDS', '3600'))
+IDEMPOTENCY_MAX_ENTRIES = int(os.getenv('IDEMPOTENCY_MAX_ENTRIES', '10000'))
+extraction_flights = SingleFlight("extraction")
+idempotency_cache = IdempotencyCache(IDEMPOTENCY_TTL_SECONDS, IDEMPOTENCY_MAX_ENTRIES)
+
+# --- Priority admission control ---
+# Uploads and extractions are classified as interactive (the Streamlit UI, the default) or bulk
+# (X-Priority: bulk, or an API key mapped in ADMISSION_API_KEYS; an X-Batch-ID only with
+# ADMISSION_BATCH_ID_IS_BULK=true); bulk requests are shed with 429 first under overload. See admission_control.py for the ADMISSION_* limits.
+ADMISSION_CONTROL_ENABLED = os.getenv('ADMISSION_CONTROL_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+ADMISSION_PATH_PREFIXES = ("/uploadfile/", "/extract-keywords/")
+admission = admission_control.create_admission_controller()
+
+# --- Bulk keyword re-normalization ---
+RENORMALIZE_CHUNK_ROWS = int(os.getenv('RENORMALIZE_CHUNK_ROWS', '5000'))
+
+# --- Storage backend for original uploads (local disk or object store) ---
+storage = None
+METADATA_PROBE_BYTES = int(os.getenv('METADATA_PROBE_BYTES', str(256 * 1024)))
+
+def _initialize_storage():
+    global storage
+    try:
+        storage = storage_backends.create_storage_backend(UPLOAD_DIRECTORY)
+        logger.info(f"FastAPI Server: Using storage backend: {storage.describe()}")
+    except Exception as e:
+        logger.error(f"FastAPI Server: Failed to initialize storage backend '{storage_backends.STORAGE_BACKEND}': {e}. Falling back to local disk.", exc_info=True)
+        storage = storage_backends.LocalStorageBackend(UPLOAD_DIRECTORY)
+
+# --- Startup / shutdown ---
+startup_timings = {}
+
+async def _timed_init(name, func):
+    start = time.perf_counter()
+    await asyncio.to_thread(func)
+    startup_timings[name] = round(time.perf_counter() - start, 4)
+
+@asynccontextmanager
+async def lifespan(app):
+    """
+    Builds every external client concurrently (each in its own thread, since the SDKs
+    block), then starts background tasks. Nothing here runs at import time.
+    """
+    structured_logging.configure_logging()
+    start = time.perf_counter()
+    await asyncio.gather(
+        _timed_init("vertex_ai", gemini_keyword_extractor.initialize_vertex_ai),
+        _timed_init("sheets", _initialize_sheets_service),
+        _timed_init("storage", _initialize_storage),
+        _timed_init("embedding_index", _initialize_embedding_index),
+        _timed_init("usage_ledger", _initialize_usage_ledger),
+        _timed_init("results_store", _initialize_results_store),
+    )
+    startup_timings["total"] = round(time.perf_counter() - start, 4)
+    logger.info(f"FastAPI Server: Startup finished in {startup_timings['total']}s: {startup_timings}")
+    if not gemini_keyword_extractor._VERTEX_AI_INITIALIZED:
+        logger.warning("FastAPI Server: Vertex AI initialization failed; it will be retried on the first extraction. Check gemini_keyword_extractor logs.")
+    logger.info(f"FastAPI Server: Vertex AI circuit breaker is {gemini_keyword_extractor.vertex_breaker.snapshot()['state']}.")
+    if not sheets_service:
+        logger.error("FastAPI Server: Google Sheets service is NOT initialized. Check GOOGLE_APPLICATION_CREDENTIALS and GOOGLE_SHEETS_ID environment variables and .env file loading.")
+
+    tracing.start_exporter()
+    drain_task = asyncio.create_task(_drain_deferred_extractions())
+    global backfill_scheduler
+    backfill_scheduler = backfill.BackfillScheduler(
+        RESULTS_DB_PATH, results_store, _backfill_extract, gemini_keyword_extractor.get_tagging_version,
+        is_busy=lambda: _interactive_extractions > 0, wait_seconds=_backfill_wait_seconds)
+    backfill_scheduler.resume()  # picks up a run interrupted by a restart
+    try:
+        yield
+    finally:
+        drain_task.cancel()
+        await backfill_scheduler.stop()
+        structured_logging.shutdown_logging()
+        if _validation_pool is not None:
+            _validation_pool.shutdown(wait=False, cancel_futures=True)
 
 app = FastAPI(
     title="File Upload, Serve, and AI Keyword/Description Extraction API",
     description="FastAPI backend to receive files, serve them, extract keywords and descriptions, and log to a specific Google Sheet (without prompt info).",
-    version="1.7.1" # Incremented version
+    version="1.7.1", # Incremented version
+    lifespan=lifespan
 )
 
+REQUEST_ID_HEADER = "X-Request-ID"
+# Admin-only diagnostics (per-request profiling, slow-request traces). Disabled unless ADMIN_TOKEN is set.
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN')
+PROFILE_HEADER = "X-Profile"
+
+def _is_admin(token):
+    return bool(ADMIN_TOKEN and token and hmac.compare_digest(token, ADMIN_TOKEN))
+
+def _require_admin(token):
+    if not _is_admin(token):
+        raise HTTPException(status_code=403, detail="Admin token required.")
+
+@app.middleware("http")
+async def admission_middleware(request, call_next):
+    """Admits uploads and extractions by priority class; shed requests get 429 with Retry-After."""
+    if not ADMISSION_CONTROL_ENABLED or not request.url.path.startswith(ADMISSION_PATH_PREFIXES):
+        return await call_next(request)
+    priority = admission.classify(request.headers)
+    tracing.set_attribute("priority", priority)
+    try:
+        with span("admission.wait", priority=priority):
+            priority_class = await admission.acquire(priority)
+    except admission_control.RequestShedError as e:
+        return JSONResponse(status_code=429, content={"detail": str(e), "priority": e.priority, "reason": e.reason},
+                            headers={"Retry-After": str(e.retry_after_seconds), "X-Priority-Class": priority})
+    try:
+        response = await call_next(request)
+    finally:
+        await admission.release(priority_class)
+    response.headers["X-Priority-Class"] = priority
+    return response
+
+# Registered after admission_middleware, so it wraps it and shed requests are logged and traced too.
+@app.middleware("http")
+async def request_id_middleware(request, call_next):
+    """
+    Binds a request ID (the client's X-Request-ID, or a new one) to every log line of the request,
+    and records the request's trace. Admins can send `X-Profile: true` to sample a CPU profile of
+    the request; it is fetched from /debug/profiles/{X-Profile-ID}.
+    """
+    request_id = request.headers.get(REQUEST_ID_HEADER) or structured_logging.new_request_id()
+    request_id = request_id[:128]
+    token = structured_logging.set_request_id(request_id)
+    profile = request.headers.get(PROFILE_HEADER, "").lower() in ("1", "true", "yes") and _is_admin(request.headers.get("X-Admin-Token"))
+    profiler = None
+    try:
+        with tracing.trace_request(f"{request.method} {request.url.path}", request_id) as trace:
+            if profile and trace is not None:
+                with tracing.SamplingProfiler(trace) as profiler:
+                    response = await call_next(request)
+            else:
+                response = await call_next(request)
+            route = request.scope.get("route")
+            if trace is not None:
+                # Group by route template (/extract-keywords/{filename}) rather than the concrete path.
+                trace.name = f"{request.method} {getattr(route, 'path', request.url.path)}"
+                tracing.set_attribute("http.status_code", response.status_code)
+    finally:
+        structured_logging.reset_request_id(token)
+    if profiler is not None:
+        tracing.profiles.put(request_id, profiler.result())
+        response.headers["X-Profile-ID"] = request_id
+    response.headers[REQUEST_ID_HEADER] = request_id
+    return response
+
 def ensure_sheet_with_headers(service, spreadsheet_id, sheet_name, headers):
     if not service:
         logger.error("FastAPI Server (ensure_sheet): Google Sheets service not available.")
@@ -132,21 +383,6 @@ def ensure_sheet_with_headers(service, spreadsheet_id, sheet_name, headers):
         logger.error(f"FastAPI Server (ensure_sheet): Unexpected error for '{sheet_name}': {e}", exc_info=True)
         return False
 
-@app.on_event("startup")
-async def startup_event():
-    if hasattr(gemini_keyword_extractor, '_VERTEX_AI_INITIALIZED') and gemini_keyword_extractor._VERTEX_AI_INITIALIZED:
-        logger.info("FastAPI Server: Vertex AI initialization in gemini_keyword_extractor was successful.")
-    else:
-        logger.warning("FastAPI Server: Vertex AI initialization in gemini_keyword_extractor may have failed or not yet completed. Check gemini_keyword_extractor logs.")
-
-    if sheets_service:
-        logger.info("FastAPI Server: Attempting to ensure 'Keywords' sheet exists with headers on startup...")
-        if not ensure_sheet_with_headers(sheets_service, SPREADSHEET_ID, SHEET_NAME_FOR_KEYWORDS, SHEET_HEADERS): # Will use new headers
-            logger.error(f"FastAPI Server: Failed to ensure '{SHEET_NAME_FOR_KEYWORDS}' sheet is ready on startup. Check permissions and SPREADSHEET_ID.")
-    else:
-        logger.error("FastAPI Server: Google Sheets service is NOT initialized. Check GOOGLE_APPLICATION_CREDENTIALS and GOOGLE_SHEETS_ID environment variables and .env file loading.")
-
-
 @app.post("/uploadfile/", tags=["File Operations"])
 async def create_upload_file(uploaded_file: UploadFile = File(...)):
     if not uploaded_file:
@@ -156,132 +392,817 @@ async def create_upload_file(uploaded_file: UploadFile = File(...)):
     if not safe_filename: 
         safe_filename = "default_uploaded_file"
 
-    file_location_on_server = os.path.join(UPLOAD_DIRECTORY, safe_filename)
-    counter = 0
-    base, ext = os.path.splitext(file_location_on_server)
-    while os.path.exists(file_location_on_server):
-        counter += 1
-        file_location_on_server = f"{base}_{counter}{ext}"
-        safe_filename = os.path.basename(file_location_on_server)
+    tracing.set_attribute("filename", safe_filename)
 
+    # Starlette has already spooled the body (to disk beyond 1 MB) by the time this runs, so this
+    # reservation covers the staging copy; validation reserves the decoded image size on its own.
+    upload_size = getattr(uploaded_file, 'size', None) or UPLOAD_COPY_CHUNK_BYTES
+    file_location_on_server = None
     try:
-        with open(file_location_on_server, "wb+") as file_object:
-            shutil.copyfileobj(uploaded_file.file, file_object)
-        logger.info(f"FastAPI Server: File '{safe_filename}' saved to '{file_location_on_server}'")
+        with span("upload.inflight_wait"):
+            await inflight_budget.acquire(upload_size)
+        try:
+            # The staging path is reserved atomically, so concurrent uploads of the same name
+            # never share a file; the final unique name is chosen when the file is committed.
+            with span("upload.reserve_staging"):
+                file_location_on_server = await asyncio.to_thread(storage.staging_path, safe_filename)
+            # Stream in fixed-size chunks; the body is never held in memory as one block.
+            with span("upload.write_staging", bytes=upload_size), open(file_location_on_server, "wb+") as file_object:
+                await asyncio.to_thread(shutil.copyfileobj, uploaded_file.file, file_object, UPLOAD_COPY_CHUNK_BYTES)
+            logger.info("FastAPI Server: File '%s' saved to '%s'.", safe_filename, file_location_on_server)
+        finally:
+            await inflight_budget.release(upload_size)
+        validation = await _validate_staged_upload(file_location_on_server, safe_filename, original_filename)
+        if validation and validation["path"] != file_location_on_server:
+            file_location_on_server = validation["path"]
+            safe_filename = os.path.splitext(safe_filename)[0] + os.path.splitext(file_location_on_server)[1]
+            logger.info("FastAPI Server: Normalized upload stored as '%s'.", safe_filename)
+
+        file_size_bytes = os.path.getsize(file_location_on_server)
+        with span("upload.commit", backend=storage.name, bytes=file_size_bytes):
+            safe_filename = await asyncio.to_thread(storage.commit_staged, file_location_on_server, safe_filename)
+
         return JSONResponse(status_code=200, content={
             "message": "File saved successfully.",
             "filename_on_server": safe_filename, 
             "original_filename": original_filename,
             "content_type_at_upload": uploaded_file.content_type,
-            "file_size_bytes": getattr(uploaded_file, 'size', None)
+            "file_size_bytes": file_size_bytes,
+            "detected_mime_type": validation["mime_type"] if validation else None,
+            "normalization": {
+                "converted_from": validation["converted_from"],
+                "orientation_applied": validation["orientation_applied"],
+                "width": validation["width"],
+                "height": validation["height"]
+            } if validation else None
         })
+    except HTTPException:
+        raise
+    except BudgetExhaustedError as e:
+        logger.warning("FastAPI Server: %s Rejecting upload of %s.", e, safe_filename)
+        raise HTTPException(status_code=503, detail="Server is busy. Please retry shortly.",
+                            headers={"Retry-After": str(e.retry_after_seconds)})
     except Exception as e:
-        logger.error(f"FastAPI Server: Error saving file {safe_filename}: {e}", exc_info=True)
+        logger.error("FastAPI Server: Error saving file %s: %s", safe_filename, e, exc_info=True)
+        if file_location_on_server:
+            storage.discard_staged(file_location_on_server)
         raise HTTPException(status_code=500, detail=f"Could not save file: {e}")
     finally:
         if uploaded_file and hasattr(uploaded_file, 'file') and hasattr(uploaded_file.file, 'closed') and not uploaded_file.file.closed:
             uploaded_file.file.close()
 
 
+async def _validate_staged_upload(file_path, safe_filename, original_filename):
+    """Validates/normalizes a staged upload in the process pool. Returns the validation dict, or None if disabled."""
+    if not IMAGE_VALIDATION_ENABLED:
+        return None
+    try:
+        # Signature/size check first: empty and non-image files fail without decoding.
+        with span("upload.quick_check"):
+            image_validation.quick_check(file_path)
+        # Decoding holds the full pixel buffer (far larger than a compressed upload), so reserve
+        # that, estimated from the header, rather than the file size.
+        decoded_bytes = await asyncio.to_thread(image_validation.estimate_decoded_bytes, file_path)
+        loop = asyncio.get_running_loop()
+        with span("upload.validate_and_normalize", bytes=decoded_bytes) as attributes:
+            async with inflight_budget.reserve(decoded_bytes):
+                validation = await loop.run_in_executor(_get_validation_pool(), image_validation.validate_and_normalize, file_path)
+            attributes["converted_from"] = validation["converted_from"]
+        return validation
+    except BudgetExhaustedError:
+        storage.discard_staged(file_path)
+        raise
+    except image_validation.ImageValidationError as e:
+        logger.warning("FastAPI Server: Rejected upload '%s': %s", safe_filename, e)
+        storage.discard_staged(file_path)
+        raise HTTPException(status_code=422, detail=f"Invalid image '{original_filename}': {e}")
+
+
 @app.get("/files/{filename}", tags=["File Operations"])
 async def get_file(filename: str):
     safe_filename = os.path.basename(filename)
-    file_path = os.path.join(UPLOAD_DIRECTORY, safe_filename)
-    if not os.path.isfile(file_path):
+    if not await asyncio.to_thread(storage.exists, safe_filename):
         raise HTTPException(status_code=404, detail="File not found.")
-    media_type, _ = mimetypes.guess_type(file_path)
-    return FileResponse(path=file_path, media_type=media_type or 'application/octet-stream', filename=safe_filename)
+    # Local disk streams the file; object stores redirect to a short-lived signed URL.
+    return await asyncio.to_thread(storage.download_response, safe_filename)
 
 
-@app.post("/extract-keywords/{filename}", tags=["AI Operations"])
-async def trigger_keyword_extraction(filename: str):
-    if not (hasattr(gemini_keyword_extractor, '_VERTEX_AI_INITIALIZED') and gemini_keyword_extractor._VERTEX_AI_INITIALIZED):
-        raise HTTPException(status_code=503, detail="AI service (Vertex AI) is not available.")
+def _sheet_rows_for(safe_filename):
+    """Row numbers of the Photos sheet that hold results for a file (one column read)."""
+    values = sheets_service.spreadsheets().values().get(
+        spreadsheetId=SPREADSHEET_ID,
+        range=f"'{SHEET_NAME_FOR_KEYWORDS}'!A2:A"
+    ).execute().get('values', [])
+    return [offset + 2 for offset, row in enumerate(values) if row and row[0] == safe_filename]
 
-    safe_filename = os.path.basename(filename)
-    file_path = os.path.join(UPLOAD_DIRECTORY, safe_filename)
-    if not os.path.isfile(file_path):
-        logger.error(f"FastAPI Server: Image file not found for extraction: {file_path}")
-        raise HTTPException(status_code=404, detail=f"File '{safe_filename}' not found for extraction.")
 
-    # prompt_to_display = gemini_keyword_extractor.KEYWORD_DESCRIPTION_PROMPT # No longer needed to send to client
+def _log_result_to_sheet(safe_filename, keywords_list, description, model_version=None, prompt_version=None,
+                         replace_existing=False):
+    """
+    Appends a result row to the Photos sheet. With replace_existing (re-extractions by the backfill),
+    the file's existing rows are overwritten instead, so the sheet keeps one current row per file.
+    Returns the sheets_logging_* response fields.
+    """
+    if not sheets_service:
+        logger.warning("FastAPI Server: Google Sheets service not initialized. Skipping sheet logging for %s.", safe_filename)
+        return {"sheets_logging_status": "skipped_not_initialized"}
+    with span("sheets.ensure_headers"):
+        sheet_ready = ensure_sheet_with_headers(sheets_service, SPREADSHEET_ID, SHEET_NAME_FOR_KEYWORDS, SHEET_HEADERS)
+    if not sheet_ready:
+        logger.error("FastAPI Server: Sheet '%s' could not be prepared. Skipping sheet logging for %s.", SHEET_NAME_FOR_KEYWORDS, safe_filename)
+        return {"sheets_logging_status": "skipped_sheet_not_ready"}
+    try:
+        keywords_str = ", ".join(keywords_list) if keywords_list else ""
+        row_to_append = [
+            safe_filename,
+            keywords_str,
+            description if description else "",
+            model_version or "",
+            prompt_version or ""
+        ]
+        value_range_body = {'values': [row_to_append]}
+
+        if replace_existing:
+            with span("sheets.find_rows"):
+                existing_rows = _sheet_rows_for(safe_filename)
+            if existing_rows:
+                with span("sheets.update", rows=len(existing_rows)):
+                    sheets_service.spreadsheets().values().batchUpdate(
+                        spreadsheetId=SPREADSHEET_ID,
+                        body={"valueInputOption": "USER_ENTERED",
+                              "data": [{"range": f"'{SHEET_NAME_FOR_KEYWORDS}'!A{row}:E{row}", "values": [row_to_append]}
+                                       for row in existing_rows]}
+                    ).execute()
+                logger.info("FastAPI Server: Updated %s row(s) for %s in Google Sheet '%s'.", len(existing_rows), safe_filename, SHEET_NAME_FOR_KEYWORDS)
+                return {"sheets_logging_status": "updated"}
+
+        with span("sheets.append"):
+            sheets_service.spreadsheets().values().append(
+                spreadsheetId=SPREADSHEET_ID,
+                range=f"'{SHEET_NAME_FOR_KEYWORDS}'!A1", 
+                valueInputOption='USER_ENTERED',
+                insertDataOption='INSERT_ROWS', 
+                body=value_range_body
+            ).execute()
+        logger.info("FastAPI Server: Successfully appended data for %s to Google Sheet '%s'.", safe_filename, SHEET_NAME_FOR_KEYWORDS)
+        return {"sheets_logging_status": "success"}
+    except HttpError as e_sheet_http:
+        error_details = e_sheet_http.resp.reason if hasattr(e_sheet_http.resp, 'reason') else str(e_sheet_http)
+        if hasattr(e_sheet_http, 'content'):
+             error_details += f" - Details: {e_sheet_http.content.decode() if isinstance(e_sheet_http.content, bytes) else e_sheet_http.content}"
+        logger.error("FastAPI Server: Google API HTTP error appending data to Google Sheet for %s: %s", safe_filename, truncate(error_details, 500))
+        logger.debug("FastAPI Server: Full Google API HTTP error details: %s", e_sheet_http)
+        return {"sheets_logging_status": "error_api", "sheets_logging_error": error_details}
+    except Exception as e_sheet:
+        logger.error("FastAPI Server: Error appending data to Google Sheet for %s: %s", safe_filename, e_sheet, exc_info=True)
+        return {"sheets_logging_status": "error", "sheets_logging_error": str(e_sheet)}
+
 
+def _index_embedding(safe_filename, image_bytes, mime_type, batch_id=None):
+    """
+    Embeds the image and appends it to the similar-image index. Paid embedding calls are
+    recorded in the usage ledger and skipped while a daily budget is exhausted. Returns a status string.
+    """
+    if image_index is None:
+        return "skipped_not_initialized"
+    if embedding_backend.billed and usage_ledger.budget_exhausted_reason():
+        return "skipped_budget_exhausted"
+    call_info = {}
     try:
-        with open(file_path, "rb") as f:
-            image_bytes = f.read()
+        with span("embedding.embed", backend=embedding_backend.name):
+            vector = embedding_backend.embed(image_bytes, mime_type, call_info=call_info)
+        with span("embedding.index_add"):
+            image_index.add(safe_filename, vector)
+        return "success"
+    except CircuitOpenError as e:
+        logger.warning("FastAPI Server: Not embedding %s: %s", safe_filename, e)
+        return "skipped_circuit_open"
+    except Exception as e:
+        logger.error("FastAPI Server: Failed to embed %s: %s", safe_filename, e, exc_info=True)
+        return "error"
+    finally:
+        if call_info.get("calls"):
+            with span("usage_ledger.record"):
+                usage_ledger.record(0, 0, 0, call_info["estimated_cost_usd"], call_info["latency_seconds"], batch_id,
+                                    calls=call_info["calls"])
+
+
+class _EmptyBuffer(bytes):
+    """Stand-in for mmap on zero-byte files (mmap can't map an empty file)."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+def run_extraction(safe_filename, batch_id=None, replace_sheet_row=False):
+    """
+    Runs Gemini extraction for a stored file, records its usage, embeds the result
+    into the file and logs it to the sheet (overwriting the file's row with replace_sheet_row).
+    Returns the response content dict.
+    """
+    # The span covers fetching the local copy and, for remote backends, writing it back.
+    with span("storage.local_copy", backend=storage.name), \
+            storage.local_copy(safe_filename, writeback=EMBED_IMAGE_METADATA) as file_path:
+        return _run_extraction_on_local_file(safe_filename, file_path, batch_id, replace_sheet_row)
+
+
+def _merge_frame_call_infos(frame_infos):
+    """Combines per-frame call details: usage and cost add up, latency is the slowest frame (they run in parallel)."""
+    merged = {key: sum(info.get(key, 0) for info in frame_infos)
+              for key in ("calls", "input_tokens", "output_tokens", "prompt_tokens", "cached_input_tokens",
+                          "prompt_cost_saved_usd", "estimated_cost_usd")}
+    answered = [info for info in frame_infos if info.get("model_id")]
+    merged["latency_seconds"] = max((info.get("latency_seconds", 0.0) for info in frame_infos), default=0.0)
+    merged["prompt_version"] = next((info["prompt_version"] for info in frame_infos if info.get("prompt_version")), None)
+    merged["prompt_cache"] = next((info["prompt_cache"] for info in answered if info.get("prompt_cache")), None)
+    if answered:
+        # The highest tier any frame needed describes the asset's result.
+        top = max(answered, key=lambda info: info.get("tier") or 0)
+        merged.update(model_id=top["model_id"], tier=top.get("tier"))
+        merged["model_version"] = Counter(info.get("model_version") for info in answered).most_common(1)[0][0]
+        merged["endpoint"] = Counter(info.get("endpoint") for info in answered).most_common(1)[0][0]
+    merged["escalations"] = [dict(escalation, frame=info.get("frame")) for info in frame_infos for escalation in info.get("escalations", [])]
+    return merged
+
+
+def _extract_media(safe_filename, file_path, mime_type, batch_id=None):
+    """
+    Videos and multi-page scans: sends a bounded, de-duplicated set of frames/pages to Gemini in
+    parallel and merges the results. Returns (keywords, description, error, call_info, embedding_status, media).
+    """
+    with span("media.expand", mime_type=mime_type) as attributes:
+        try:
+            expansion = media_expansion.expand(file_path, mime_type)
+        except media_expansion.MediaExpansionError as e:
+            logger.error("FastAPI Server: Could not expand %s: %s", safe_filename, e)
+            return None, None, f"Error: {e}", {}, None, None
+        attributes.update(candidates=expansion["candidates"], frames=len(expansion["frames"]))
+    frames = expansion["frames"]
+    logger.info("FastAPI Server: Extracting %s representative of %s candidate frames for %s.",
+                len(frames), expansion["candidates"], safe_filename)
+
+    def extract_frame(frame):
+        info = {"frame": frame["label"]}
+        with span("media.frame", frame=frame["label"]):
+            keywords, description, error = gemini_keyword_extractor.generate_keywords_and_description(
+                frame["jpeg"], "image/jpeg", call_info=info)
+        return keywords, description, error, info
+
+    results = media_expansion.map_frames(extract_frame, frames)
+    call_info = _merge_frame_call_infos([info for _, _, _, info in results])
+    succeeded = [(frame, keywords, description) for frame, (keywords, description, error, _) in zip(frames, results) if not error]
+    media = {
+        "kind": expansion["kind"],
+        "candidate_frames": expansion["candidates"],
+        "frames_sent": len(frames),
+        "frames_failed": len(frames) - len(succeeded),
+        "dropped_blank": expansion["dropped_blank"],
+        "dropped_duplicate": expansion["dropped_duplicate"],
+        "dropped_over_limit": expansion["dropped_over_limit"],
+        "frames": [{"label": frame["label"], "keywords": keywords, "description": description, "error": error}
+                   for frame, (keywords, description, error, _) in zip(frames, results)],
+    }
+    if not succeeded:
+        return None, None, results[0][2], call_info, None, media
+    keywords_list = media_expansion.merge_keywords([keywords or [] for _, keywords, _ in succeeded])
+    description = media_expansion.merge_descriptions([(frame["label"], description) for frame, _, description in succeeded])
+    # The frame sharing the most keywords with the merged set stands in for the asset in the similarity index.
+    representative = max(succeeded, key=lambda item: len(set(item[1] or []) & set(keywords_list)))[0]
+    embedding_status = _index_embedding(safe_filename, representative["jpeg"], "image/jpeg", batch_id)
+    return keywords_list, description, None, call_info, embedding_status, media
+
 
-        mime_type, _ = mimetypes.guess_type(file_path)
-        mime_type = mime_type or 'application/octet-stream'
+def _run_extraction_on_local_file(safe_filename, file_path, batch_id=None, replace_sheet_row=False):
+    tagging_version = gemini_keyword_extractor.get_tagging_version()
+    # Trust the file's signature over its name; fall back to the extension for unknown types.
+    mime_type = image_validation.sniff_file_mime_type(file_path) or mimetypes.guess_type(file_path)[0]
+    mime_type = mime_type or 'application/octet-stream'
+    tracing.set_attribute("mime_type", mime_type)
 
-        logger.info(f"FastAPI Server: Requesting keywords and description for {safe_filename}.")
-        keywords_list, description, error_message = gemini_keyword_extractor.generate_keywords_and_description(
-            image_bytes, mime_type
+    media = None
+    if media_expansion.needs_expansion(file_path, mime_type):
+        keywords_list, description, error_message, call_info, embedding_status, media = _extract_media(
+            safe_filename, file_path, mime_type, batch_id)
+    else:
+        # The file is memory-mapped rather than read into a bytes object: the only full copy
+        # is the one the SDK builds for the request, and the page cache backs the rest.
+        with open(file_path, "rb") as f:
+            with (mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else _EmptyBuffer()) as image_bytes:
+                logger.info("FastAPI Server: Requesting keywords and description for %s.", safe_filename)
+                call_info = {}
+                keywords_list, description, error_message = gemini_keyword_extractor.generate_keywords_and_description(
+                    image_bytes, mime_type, call_info=call_info
+                )
+                embedding_status = None
+                if not error_message and (keywords_list or description):
+                    embedding_status = _index_embedding(safe_filename, image_bytes, mime_type, batch_id)
+    usage = {
+        "gemini_calls": call_info.get("calls", 0),
+        "input_tokens": call_info.get("input_tokens", 0),
+        "output_tokens": call_info.get("output_tokens", 0),
+        "prompt_tokens": call_info.get("prompt_tokens", 0),
+        "cached_input_tokens": call_info.get("cached_input_tokens", 0),
+        "prompt_cost_saved_usd": round(call_info.get("prompt_cost_saved_usd", 0.0), 6),
+        "prompt_version": call_info.get("prompt_version"),
+        "prompt_cache": call_info.get("prompt_cache"),
+        "latency_seconds": round(call_info.get("latency_seconds", 0.0), 3),
+        "estimated_cost_usd": round(call_info.get("estimated_cost_usd", 0.0), 6),
+    }
+    with span("usage_ledger.record"):
+        usage_ledger.record(
+            usage["input_tokens"], usage["output_tokens"], usage["prompt_tokens"],
+            call_info.get("estimated_cost_usd", 0.0), call_info.get("latency_seconds", 0.0), batch_id,
+            calls=usage["gemini_calls"]
         )
 
-        # --- MODIFIED RESPONSE CONTENT: Removed prompt_used_source and prompt_text_sent_to_module ---
-        response_content = {
-            "filename": safe_filename,
-            "keywords": keywords_list,
-            "description": description, 
-            "error": error_message,
-            "status": "error" if error_message else "success"
-            # "prompt_used_source": "Module Default (Keywords & Description)", # REMOVED
-            # "prompt_text_sent_to_module": prompt_to_display # REMOVED
-        }
-
-        if not error_message and (keywords_list or description): 
-            logger.info(f"FastAPI Server: Extraction successful for {safe_filename}. Keywords: {keywords_list}, Desc: {description[:50] if description else 'N/A'}...")
-            if sheets_service:
-                sheet_ready = ensure_sheet_with_headers(sheets_service, SPREADSHEET_ID, SHEET_NAME_FOR_KEYWORDS, SHEET_HEADERS)
-                if sheet_ready:
-                    try:
-                        keywords_str = ", ".join(keywords_list) if keywords_list else ""
-                        # --- MODIFIED ROW TO APPEND: Removed prompt_to_display ---
-                        row_to_append = [
-                            safe_filename,
-                            keywords_str,
-                            description if description else ""
-                            # prompt_to_display # REMOVED
-                        ]
-                        value_range_body = {'values': [row_to_append]}
-                        
-                        sheets_service.spreadsheets().values().append(
-                            spreadsheetId=SPREADSHEET_ID,
-                            range=f"'{SHEET_NAME_FOR_KEYWORDS}'!A1", 
-                            valueInputOption='USER_ENTERED',
-                            insertDataOption='INSERT_ROWS', 
-                            body=value_range_body
-                        ).execute()
-                        logger.info(f"FastAPI Server: Successfully appended data for {safe_filename} to Google Sheet '{SHEET_NAME_FOR_KEYWORDS}'.")
-                        response_content["sheets_logging_status"] = "success"
-                    except HttpError as e_sheet_http:
-                        error_details = e_sheet_http.resp.reason if hasattr(e_sheet_http.resp, 'reason') else str(e_sheet_http)
-                        if hasattr(e_sheet_http, 'content'):
-                             error_details += f" - Details: {e_sheet_http.content.decode() if isinstance(e_sheet_http.content, bytes) else e_sheet_http.content}"
-                        logger.error(f"FastAPI Server: Google API HTTP error appending data to Google Sheet for {safe_filename}: {error_details}", exc_info=False)
-                        logger.debug(f"FastAPI Server: Full Google API HTTP error details: {e_sheet_http}")
-                        response_content["sheets_logging_status"] = "error_api"
-                        response_content["sheets_logging_error"] = error_details
-                    except Exception as e_sheet:
-                        logger.error(f"FastAPI Server: Error appending data to Google Sheet for {safe_filename}: {e_sheet}", exc_info=True)
-                        response_content["sheets_logging_status"] = "error"
-                        response_content["sheets_logging_error"] = str(e_sheet)
-                else:
-                    logger.error(f"FastAPI Server: Sheet '{SHEET_NAME_FOR_KEYWORDS}' could not be prepared. Skipping sheet logging for {safe_filename}.")
-                    response_content["sheets_logging_status"] = "skipped_sheet_not_ready"
-            else:
-                logger.warning("FastAPI Server: Google Sheets service not initialized. Skipping sheet logging for {safe_filename}.")
-                response_content["sheets_logging_status"] = "skipped_not_initialized"
-        elif error_message: 
-            logger.error(f"FastAPI Server: Extraction failed for {safe_filename}: {error_message}")
-            response_content["status"] = "error"
+    response_content = {
+        "filename": safe_filename,
+        "keywords": keywords_list,
+        "description": description, 
+        "error": error_message,
+        "status": "error" if error_message else "success",
+        "source": "gemini",
+        "tagging_version": tagging_version,
+        "model_id": call_info.get("model_id"),
+        "model_version": call_info.get("model_version"),
+        "prompt_version": call_info.get("prompt_version"),
+        "model_tier": call_info.get("tier"),
+        "model_escalations": call_info.get("escalations", []),
+        "usage": usage,
+        "batch_id": batch_id
+    }
+    if media is not None:
+        response_content["media"] = media
+
+    if not error_message and (keywords_list or description): 
+        logger.info("FastAPI Server: Extraction successful for %s.", safe_filename,
+                    extra={"keyword_count": len(keywords_list or []), "model_id": call_info.get("model_id"),
+                           "vertex_endpoint": call_info.get("endpoint"), "latency_seconds": usage["latency_seconds"]})
+        logger.debug("FastAPI Server: Extraction result for %s: keywords=%s description=%s",
+                     safe_filename, keywords_list, truncate(description, 100))
+        if EMBED_IMAGE_METADATA and media is not None:
+            # XMP/IPTC embedding covers single JPEG/PNG images only.
+            response_content["metadata_embedding_status"] = "skipped_unsupported_format"
+        elif EMBED_IMAGE_METADATA:
+            with span("metadata.write_embedded_tags"):
+                embed_error = image_metadata.write_embedded_tags(file_path, keywords_list or [], description, tagging_version)
+            response_content["metadata_embedding_status"] = "error" if embed_error else "success"
+            if embed_error:
+                response_content["metadata_embedding_error"] = embed_error
+        response_content["embedding_status"] = embedding_status
+        with span("results_store.upsert"):
+            results_store.upsert(safe_filename, keywords_list, description, call_info.get("model_id"), tagging_version, batch_id,
+                                 call_info.get("model_version"), call_info.get("prompt_version"))
+        response_content.update(_log_result_to_sheet(safe_filename, keywords_list, description,
+                                                     call_info.get("model_version"), call_info.get("prompt_version"),
+                                                     replace_existing=replace_sheet_row))
+    elif error_message: 
+        logger.error("FastAPI Server: Extraction failed for %s: %s", safe_filename, truncate(error_message, 300))
+        response_content["status"] = "error"
+    return response_content
+
 
+@app.post("/extract-keywords/{filename}", tags=["AI Operations"])
+async def trigger_keyword_extraction(filename: str, x_batch_id: Optional[str] = Header(None),
+                                     idempotency_key: Optional[str] = Header(None)):
+    global _interactive_extractions
+    safe_filename = os.path.basename(filename)
+    if idempotency_key:
+        stored = idempotency_cache.get(idempotency_key)
+        if stored is not None:
+            if stored["filename"] != safe_filename:
+                raise HTTPException(status_code=422, detail="Idempotency-Key was already used for a different file.")
+            logger.info("FastAPI Server: Replaying stored result for Idempotency-Key %s.", idempotency_key)
+            return JSONResponse(status_code=200, content=stored, headers={"Idempotent-Replayed": "true"})
+
+    tracing.set_attribute("filename", safe_filename)
+    with span("storage.exists", backend=storage.name):
+        exists = await asyncio.to_thread(storage.exists, safe_filename)
+    if not exists:
+        logger.error("FastAPI Server: Image file not found for extraction: %s", safe_filename)
+        raise HTTPException(status_code=404, detail=f"File '{safe_filename}' not found for extraction.")
 
-        return JSONResponse(status_code=200, content=response_content)
+    # Header-only probe: files already tagged by the current model/prompt skip the Gemini call.
+    tagging_version = gemini_keyword_extractor.get_tagging_version()
+    if SKIP_ALREADY_TAGGED:
+        with span("metadata.probe"):
+            header = await asyncio.to_thread(storage.read_header, safe_filename, METADATA_PROBE_BYTES)
+            embedded = image_metadata.read_embedded_tags_from_header(header)
+        if embedded and embedded.get("tagging_version") == tagging_version:
+            logger.info("FastAPI Server: %s is already tagged with '%s'. Skipping extraction.", safe_filename, tagging_version)
+            return JSONResponse(status_code=200, content={
+                "filename": safe_filename,
+                "keywords": embedded.get("keywords", []),
+                "description": embedded.get("description"),
+                "error": None,
+                "status": "success",
+                "source": "embedded_metadata",
+                "tagging_version": tagging_version,
+                "sheets_logging_status": "skipped_already_tagged"
+            })
 
+    if not (hasattr(gemini_keyword_extractor, '_VERTEX_AI_INITIALIZED') and gemini_keyword_extractor._VERTEX_AI_INITIALIZED):
+        raise HTTPException(status_code=503, detail="AI service (Vertex AI) is not available.")
+
+    budget_reason = usage_ledger.budget_exhausted_reason()
+    if budget_reason:
+        retry_after = usage_ledger_module.seconds_until_budget_reset()
+        if usage_ledger_module.BUDGET_EXHAUSTED_ACTION == "queue":
+            queue_id = usage_ledger.defer(safe_filename, x_batch_id)
+            logger.warning("FastAPI Server: %s Queued %s for later extraction (id %s).", budget_reason, safe_filename, queue_id)
+            return JSONResponse(status_code=202, content={
+                "filename": safe_filename,
+                "status": "queued",
+                "queue_id": queue_id,
+                "error": budget_reason,
+                "retry_after_seconds": retry_after
+            })
+        logger.warning("FastAPI Server: %s Rejecting extraction of %s.", budget_reason, safe_filename)
+        raise HTTPException(status_code=429, detail=budget_reason, headers={"Retry-After": str(retry_after)})
+
+    _interactive_extractions += 1
+    try:
+        content, shared = await _coalesced_extraction(safe_filename, x_batch_id)
+        if idempotency_key and content["status"] == "success":
+            idempotency_cache.put(idempotency_key, content)
+        return JSONResponse(status_code=200, content=content, headers={"X-Coalesced": "true"} if shared else None)
+    except BudgetExhaustedError as e:
+        logger.warning("FastAPI Server: %s Rejecting extraction of %s.", e, safe_filename)
+        raise HTTPException(status_code=503, detail="Server is busy. Please retry shortly.",
+                            headers={"Retry-After": str(e.retry_after_seconds)})
+    except CircuitOpenError as e:
+        logger.warning("FastAPI Server: Failing fast for %s: %s", safe_filename, e)
+        raise HTTPException(status_code=503, detail="AI service (Vertex AI) is temporarily unavailable.",
+                            headers={"Retry-After": str(e.retry_after_seconds)})
     except Exception as e:
-        logger.error(f"FastAPI Server: Unexpected error during extraction endpoint for {safe_filename}: {e}", exc_info=True)
+        logger.error("FastAPI Server: Unexpected error during extraction endpoint for %s: %s", safe_filename, e, exc_info=True)
         raise HTTPException(status_code=500, detail=f"An unexpected server error occurred: {str(e)}")
+    finally:
+        _interactive_extractions -= 1
+
+
+def _extraction_reservation(safe_filename):
+    """
+    Bytes to reserve in the in-flight budget while a stored file is extracted. Images are sent
+    whole (EXTRACTION_MEMORY_FACTOR x their size); videos and PDFs are decoded frame by frame, so
+    they reserve media_expansion.reservation_bytes() however large the file is.
+    """
+    reservation = int(storage.size(safe_filename) * EXTRACTION_MEMORY_FACTOR)
+    mime_type = image_validation.sniff_mime_type(storage.read_header(safe_filename, image_validation.SNIFF_BYTES))
+    if media_expansion.decodes_by_seeking(mime_type):
+        return min(reservation, media_expansion.reservation_bytes())
+    return reservation
+
+
+async def _coalesced_extraction(safe_filename, batch_id=None, replace_sheet_row=False):
+    """Runs (or joins) the extraction of a stored file under the in-flight memory budget. Returns (content, shared)."""
+    async def extract():
+        reservation = await asyncio.to_thread(_extraction_reservation, safe_filename)
+        with span("extraction.inflight_wait", bytes=reservation):
+            await inflight_budget.acquire(reservation)
+        try:
+            return await asyncio.to_thread(run_extraction, safe_filename, batch_id, replace_sheet_row)
+        finally:
+            await inflight_budget.release(reservation)
+
+    # Keyed on name and content, so a file replaced mid-flight isn't answered with the old result.
+    with span("storage.content_hash", backend=storage.name):
+        content_hash = await asyncio.to_thread(storage.content_hash, safe_filename)
+    with span("extraction.single_flight") as attributes:
+        content, shared = await extraction_flights.do(f"{safe_filename}:{content_hash}", extract)
+        attributes["shared"] = shared
+    return content, shared
+
+
+async def _backfill_extract(safe_filename, batch_id):
+    if not await asyncio.to_thread(storage.exists, safe_filename):
+        return None
+    # A re-extraction replaces the file's sheet row rather than adding a conflicting one.
+    content, _ = await _coalesced_extraction(safe_filename, batch_id, replace_sheet_row=True)
+    return content
+
+
+def _backfill_wait_seconds():
+    """Holds the backfill back while a daily budget is exhausted or the Vertex AI breaker is open."""
+    if usage_ledger.budget_exhausted_reason():
+        return usage_ledger_module.seconds_until_budget_reset()
+    breaker = gemini_keyword_extractor.vertex_breaker.snapshot()
+    if breaker["state"] == "open":
+        return breaker["retry_after_seconds"] or 1
+    return None
+
+
+async def _drain_deferred_extractions():
+    """Background task: runs extractions queued while a daily budget was exhausted."""
+    while True:
+        await asyncio.sleep(DEFERRED_POLL_SECONDS)
+        while not usage_ledger.budget_exhausted_reason():
+            item = usage_ledger.pop_deferred()
+            if item is None:
+                break
+            token = structured_logging.set_request_id(f"deferred-{item['id']}")
+            try:
+                if not await asyncio.to_thread(storage.exists, item["filename"]):
+                    logger.warning("FastAPI Server: Deferred file %s no longer exists. Dropping it.", item["filename"])
+                    continue
+                reservation = await asyncio.to_thread(_extraction_reservation, item["filename"])
+                async with inflight_budget.reserve(reservation):
+                    result = await asyncio.to_thread(run_extraction, item["filename"], item["batch_id"])
+                logger.info("FastAPI Server: Deferred extraction for %s finished with status '%s'.", item["filename"], result["status"])
+            except (CircuitOpenError, BudgetExhaustedError) as e:
+                usage_ledger.defer(item["filename"], item["batch_id"])
+                logger.warning("FastAPI Server: %s Re-queued deferred extraction for %s.", e, item["filename"])
+                break
+            except Exception as e:
+                logger.error("FastAPI Server: Deferred extraction for %s failed: %s", item["filename"], e, exc_info=True)
+            finally:
+                structured_logging.reset_request_id(token)
+
+
+@app.get("/usage", tags=["AI Operations"])
+async def get_usage(day: Optional[str] = None, batch_id: Optional[str] = None):
+    content = {
+        "today": usage_ledger.daily_totals(),
+        "budgets": usage_ledger.budgets(),
+        "deferred_extractions": usage_ledger.deferred_count(),
+    }
+    if day:
+        content["day"] = usage_ledger.daily_totals(day)
+    else:
+        content["recent_days"] = usage_ledger.recent_days()
+    if batch_id:
+        content["batch"] = usage_ledger.batch_totals(batch_id)
+    return content
+
+def renormalize_sheet_keywords(dry_run=False):
+    """
+    Re-applies keyword normalization to the whole Keywords column of the Photos sheet,
+    paging through it RENORMALIZE_CHUNK_ROWS rows at a time and only writing changed cells.
+    """
+    stats = {"rows_scanned": 0, "rows_changed": 0, "keywords_before": 0, "keywords_after": 0, "dry_run": dry_run}
+    start_row = 2  # row 1 holds the headers
+    while True:
+        end_row = start_row + RENORMALIZE_CHUNK_ROWS - 1
+        result = sheets_service.spreadsheets().values().get(
+            spreadsheetId=SPREADSHEET_ID,
+            range=f"'{SHEET_NAME_FOR_KEYWORDS}'!B{start_row}:B{end_row}"
+        ).execute()
+        rows = result.get('values', [])
+        if not rows:
+            break
+        updates = []
+        for offset, row in enumerate(rows):
+            current = row[0] if row else ""
+            normalized = keyword_normalizer.normalizer.normalize_keyword_string(
+                current, limit=gemini_keyword_extractor.ROUTING_MAX_KEYWORDS)
+            stats["keywords_before"] += len([k for k in current.split(",") if k.strip()])
+            stats["keywords_after"] += len([k for k in normalized.split(",") if k.strip()])
+            if normalized != current:
+                updates.append({"range": f"'{SHEET_NAME_FOR_KEYWORDS}'!B{start_row + offset}", "values": [[normalized]]})
+        stats["rows_scanned"] += len(rows)
+        stats["rows_changed"] += len(updates)
+        if updates and not dry_run:
+            sheets_service.spreadsheets().values().batchUpdate(
+                spreadsheetId=SPREADSHEET_ID,
+                body={"valueInputOption": "USER_ENTERED", "data": updates}
+            ).execute()
+        if len(rows) < RENORMALIZE_CHUNK_ROWS:
+            break
+        start_row = end_row + 1
+    return stats
+
+
+def _iter_sheet_result_pages(keyword=None):
+    """Pages through the Photos sheet EXPORT_PAGE_ROWS rows at a time (historical rows predate the results store)."""
+    start_row = 2  # row 1 holds the headers
+    while True:
+        end_row = start_row + EXPORT_PAGE_ROWS - 1
+        rows = sheets_service.spreadsheets().values().get(
+            spreadsheetId=SPREADSHEET_ID,
+            range=f"'{SHEET_NAME_FOR_KEYWORDS}'!A{start_row}:E{end_row}"
+        ).execute().get('values', [])
+        if not rows:
+            return
+        page = []
+        for row in rows:
+            row = row + [""] * (5 - len(row))
+            if keyword and keyword not in (k.strip() for k in row[1].split(",")):
+                continue
+            page.append({"filename": row[0], "keywords": row[1], "description": row[2],
+                         "model_version": row[3], "prompt_version": row[4]})
+        if page:
+            yield page
+        if len(rows) < EXPORT_PAGE_ROWS:
+            return
+        start_row = end_row + 1
+
+
+def _parse_export_date(value, name, upper=False):
+    """Validates an export date bound and returns it as a UTC timestamp in the results store's format."""
+    if value is None:
+        return None
+    try:
+        return results_store_module.normalize_date_bound(value, upper)
+    except ValueError:
+        raise HTTPException(status_code=422, detail=f"'{name}' must be an ISO 8601 date or datetime (e.g. 2025-06-01 or 2025-06-01T09:00:00+09:00).")
+
+
+@app.get("/export", tags=["AI Operations"])
+async def export_results(
+    export_format: str = Query("csv", alias="format"),
+    source: str = "results",
+    since: Optional[int] = Query(None, description="Cursor from a previous export's X-Export-Cursor header; returns only rows changed after it."),
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    keyword: Optional[str] = None,
+):
+    """
+    Streams every extraction result as CSV, JSONL or Parquet. Rows are read and encoded one
+    page at a time, so memory use doesn't grow with the number of rows. The X-Export-Cursor
+    response header pins the snapshot; pass it back as `since` to get only later changes.
+    `source=sheet` exports the Photos sheet instead (keyword filter only).
+    """
+    export_format = export_format.lower()
+    if export_format not in results_store_module.EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unknown format '{export_format}'. Use csv, jsonl or parquet.")
+    if export_format == "parquet" and not results_store_module.parquet_available():
+        raise HTTPException(status_code=501, detail="Parquet export requires the pyarrow package.")
+    serializer, media_type = results_store_module.EXPORT_FORMATS[export_format]
+    date_from = _parse_export_date(date_from, "date_from")
+    date_to = _parse_export_date(date_to, "date_to", upper=True)
+    if keyword:
+        keyword = keyword_normalizer.normalizer.normalize_keyword(keyword)
+
+    headers = {"Content-Disposition": f'attachment; filename="omi-export-{datetime.now(timezone.utc):%Y%m%dT%H%M%SZ}.{export_format}"'}
+    if source == "sheet":
+        if not sheets_service:
+            raise HTTPException(status_code=503, detail="Google Sheets service is not initialized.")
+        if since is not None or date_from or date_to:
+            raise HTTPException(status_code=400, detail="The sheet has no change timestamps; 'since', 'date_from' and 'date_to' need source=results.")
+        pages = _iter_sheet_result_pages(keyword)
+        columns = ["filename", "keywords", "description"]
+    elif source == "results":
+        cursor = await asyncio.to_thread(results_store.current_cursor)
+        pages = results_store.iter_pages(since or 0, cursor, date_from, date_to, keyword, EXPORT_PAGE_ROWS)
+        columns = results_store_module.EXPORT_COLUMNS
+        headers["X-Export-Cursor"] = str(cursor)
+    else:
+        raise HTTPException(status_code=400, detail="source must be 'results' or 'sheet'.")
+    logger.info("FastAPI Server: Starting %s export from %s.", export_format, source,
+                extra={"since": since, "date_from": date_from, "date_to": date_to, "keyword": keyword})
+    # A sync generator: Starlette iterates it in a worker thread, one page per chunk.
+    return StreamingResponse(serializer(pages, columns), media_type=media_type, headers=headers)
+
+
+@app.get("/backfill", tags=["AI Operations"])
+async def get_backfill_status(diff_limit: int = 20):
+    return await asyncio.to_thread(backfill_scheduler.status, diff_limit)
+
+
+def seed_results_from_sheet():
+    """
+    Copies Photos sheet rows into the results store for files it doesn't have yet (tagged before
+    the store existed), so the backfill finds them as stale. Returns the number of rows seeded.
+    """
+    seeded = 0
+    for page in _iter_sheet_result_pages():
+        seeded += results_store.seed(page)
+    if seeded:
+        logger.info("FastAPI Server: Seeded %s results from the '%s' sheet.", seeded, SHEET_NAME_FOR_KEYWORDS)
+    return seeded
+
+
+@app.post("/backfill/start", tags=["AI Operations"])
+async def start_backfill(rate_per_minute: Optional[float] = None, seed_from_sheet: bool = True):
+    """
+    Re-extracts every stored result whose model/prompt version differs from the current one.
+    With seed_from_sheet (the default), sheet rows the results store lacks are added first.
+    """
+    if rate_per_minute is not None and rate_per_minute <= 0:
+        raise HTTPException(status_code=400, detail="rate_per_minute must be positive.")
+    if backfill_scheduler.running:
+        raise HTTPException(status_code=409, detail="A backfill run is already in progress.")
+    seeded = 0
+    if seed_from_sheet and sheets_service:
+        try:
+            seeded = await asyncio.to_thread(seed_results_from_sheet)
+        except HttpError as e:
+            logger.error(f"FastAPI Server: Google API HTTP error while seeding results from the sheet: {e.reason}")
+            raise HTTPException(status_code=502, detail=f"Google Sheets error: {e.reason}")
+    try:
+        run = backfill_scheduler.start(rate_per_minute)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    run["seeded_from_sheet"] = seeded
+    return run
+
+
+@app.post("/backfill/pause", tags=["AI Operations"])
+async def pause_backfill():
+    return backfill_scheduler.pause()
+
+
+@app.post("/backfill/resume", tags=["AI Operations"])
+async def resume_backfill():
+    return backfill_scheduler.resume()
+
+
+@app.get("/similar/{filename}", tags=["AI Operations"])
+async def get_similar_images(filename: str, k: int = 10):
+    if image_index is None:
+        raise HTTPException(status_code=503, detail="Similar-image search is not available (EMBEDDING_BACKEND is not set).")
+    safe_filename = os.path.basename(filename)
+    query = image_index.get_vector(safe_filename)
+    if query is None:
+        raise HTTPException(status_code=404, detail=f"File '{safe_filename}' has no embedding yet. Run extraction first.")
+    k = max(1, min(k, 100))
+    matches = await asyncio.to_thread(image_index.search, query, k, safe_filename)
+    return {
+        "filename": safe_filename,
+        "backend": EMBEDDING_BACKEND,
+        "results": [{"filename": name, "similarity": round(score, 4)} for name, score in matches]
+    }
+
+
+@app.post("/keywords/renormalize", tags=["AI Operations"])
+async def renormalize_keywords(dry_run: bool = False):
+    """Re-normalizes the keywords of the Photos sheet and of the results store (with its keyword index)."""
+    if not sheets_service and not results_store:
+        raise HTTPException(status_code=503, detail="Neither Google Sheets nor the results store is initialized.")
+    keyword_normalizer.normalizer.load_vocabulary_file()
+    stats = {"dry_run": dry_run}
+    if sheets_service:
+        try:
+            stats = await asyncio.to_thread(renormalize_sheet_keywords, dry_run)
+        except HttpError as e:
+            logger.error(f"FastAPI Server: Google API HTTP error while re-normalizing keywords: {e.reason}")
+            raise HTTPException(status_code=502, detail=f"Google Sheets error: {e.reason}")
+    if results_store:
+        stats["results_store"] = await asyncio.to_thread(
+            results_store.renormalize_keywords,
+            lambda keywords: keyword_normalizer.normalizer.normalize_keyword_string(
+                keywords, limit=gemini_keyword_extractor.ROUTING_MAX_KEYWORDS),
+            dry_run, RENORMALIZE_CHUNK_ROWS)
+    stats["vocabulary_terms"] = keyword_normalizer.normalizer.vocabulary_size
+    logger.info(f"FastAPI Server: Keyword re-normalization finished: {stats}")
+    return stats
+
+
+@app.get("/health", tags=["General"])
+async def health():
+    ai_health = gemini_keyword_extractor.get_health()
+    breaker_state = ai_health["circuit_breaker"]["state"]
+    healthy = ai_health["vertex_ai_initialized"] and breaker_state != "open"
+    content = {
+        "status": "ok" if healthy else "degraded",
+        "vertex_ai": ai_health,
+        "sheets_service_initialized": sheets_service is not None,
+        "storage": storage.describe(),
+    }
+    headers = {}
+    if breaker_state == "open" and ai_health["circuit_breaker"]["retry_after_seconds"] is not None:
+        headers["Retry-After"] = str(max(1, int(ai_health["circuit_breaker"]["retry_after_seconds"])))
+    return JSONResponse(status_code=200 if healthy else 503, content=content, headers=headers)
+
+@app.get("/metrics", tags=["General"])
+async def get_metrics():
+    return {
+        "gemini_hedging": gemini_keyword_extractor.get_hedging_metrics(),
+        "gemini_routing": gemini_keyword_extractor.get_routing_stats(),
+        "vertex_endpoints": gemini_keyword_extractor.get_endpoint_stats(),
+        "inflight_memory": inflight_budget.snapshot(),
+        "startup_seconds": startup_timings,
+        "logging": structured_logging.get_logging_stats(),
+        "extraction_coalescing": extraction_flights.snapshot(),
+        "idempotency": idempotency_cache.snapshot(),
+        "admission": admission.snapshot(),
+        "cassettes": cassettes.store.snapshot(),
+        "tracing": tracing.get_tracing_stats(),
+    }
+
+@app.get("/debug/slow-requests", tags=["General"])
+async def get_slow_requests(limit: int = Query(10, ge=1, le=tracing.SLOW_REQUESTS_KEPT * tracing.SLOW_REQUEST_WINDOWS),
+                            name: Optional[str] = None, within_seconds: Optional[float] = Query(None, gt=0),
+                            x_admin_token: Optional[str] = Header(None)):
+    """
+    The slowest recent requests (the slowest of each window over the last
+    SLOW_REQUEST_WINDOWS x SLOW_REQUEST_WINDOW_SECONDS), with their per-stage span breakdowns. Admin only.
+    """
+    _require_admin(x_admin_token)
+    return {"requests": tracing.slow_requests.slowest(limit, name, within_seconds),
+            "retention_seconds": tracing.SLOW_REQUEST_WINDOWS * tracing.SLOW_REQUEST_WINDOW_SECONDS}
+
+@app.get("/debug/profiles/{profile_id}", tags=["General"])
+async def get_profile(profile_id: str, x_admin_token: Optional[str] = Header(None)):
+    """A sampled CPU profile of a request sent with `X-Profile: true`. Admin only."""
+    _require_admin(x_admin_token)
+    profile = tracing.profiles.get(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail=f"No profile with ID '{profile_id}'.")
+    return profile
 
 @app.get("/", tags=["General"])
 async def root():
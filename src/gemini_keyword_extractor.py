@@ -1,39 +1,37 @@
 # gemini_keyword_extractor.py
 import os
-from dotenv import load_dotenv
 import logging
-import re # Import regular expressions for parsing
-
-# Configure logging early
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
-
-logger.info("--- gemini_keyword_extractor.py: Attempting to load .env file ---")
-load_dotenv_success = load_dotenv()
-logger.info(f"--- gemini_keyword_extractor.py: load_dotenv() executed. Success: {load_dotenv_success} ---")
-
-gac_path = os.getenv('GOOGLE_APPLICATION_CREDENTIALS')
-gcp_project = os.getenv('GOOGLE_CLOUD_PROJECT_ID')
-
-logger.info(f"--- DEBUG: GOOGLE_APPLICATION_CREDENTIALS after load_dotenv(): {gac_path}")
-logger.info(f"--- DEBUG: GOOGLE_CLOUD_PROJECT_ID after load_dotenv(): {gcp_project}")
-
-if gac_path:
-    logger.info(f"--- DEBUG: Does the GAC file exist? {os.path.exists(gac_path)}")
-else:
-    logger.error("--- DEBUG: GOOGLE_APPLICATION_CREDENTIALS is NOT SET in the environment! ---")
-
+import hashlib
+import json
+import time
+import threading
+from collections import deque
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from typing import Optional, List, Tuple
 
-import vertexai
-from vertexai.generative_models import GenerativeModel, Part, FinishReason
-import vertexai.generative_models as generative_models
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+from endpoint_pool import EndpointPool, parse_endpoints
+import keyword_normalizer
+from structured_logging import Lazy, truncate
+from tracing import span
+import cassettes
+
+# Importing this module has no side effects: the environment is loaded by the entry point
+# (fastapi_server), and the vertexai SDK is imported and initialized on first use or by
+# initialize_vertex_ai() from the server's lifespan hook.
+logger = logging.getLogger(__name__)
 
 # --- Configuration for Vertex AI ---
 PROJECT_ID = os.getenv("GOOGLE_CLOUD_PROJECT_ID", "omi-photos")
-LOCATION = "us-central1"
+LOCATION = os.getenv("GOOGLE_CLOUD_LOCATION", "us-central1")
 MODEL_ID = "gemini-2.0-flash-lite"
 
+# Project/location pairs calls are spread over, routed by recent latency and quota headroom
+# (see endpoint_pool.py). The first endpoint is the SDK's default for everything else.
+VERTEX_ENDPOINTS = os.getenv("VERTEX_ENDPOINTS", f"{PROJECT_ID}/{LOCATION}")
+endpoint_pool = EndpointPool(parse_endpoints(VERTEX_ENDPOINTS))
+
 # --- NEW PROMPT ---
 KEYWORD_DESCRIPTION_PROMPT = (
     "Analyze the image provided.\n"
@@ -47,126 +45,669 @@ KEYWORD_DESCRIPTION_PROMPT = (
     "---DESCRIPTION---\n"
     "This is a short description of the image."
 )
+PROMPT_VERSION = hashlib.sha256(KEYWORD_DESCRIPTION_PROMPT.encode("utf-8")).hexdigest()[:12]  # same as _prompt_version()
 
-SAFETY_SETTINGS = {
-    generative_models.HarmCategory.HARM_CATEGORY_HARASSMENT: generative_models.HarmBlockThreshold.BLOCK_ONLY_HIGH,
-    generative_models.HarmCategory.HARM_CATEGORY_HATE_SPEECH: generative_models.HarmBlockThreshold.BLOCK_ONLY_HIGH,
-    generative_models.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: generative_models.HarmBlockThreshold.BLOCK_ONLY_HIGH,
-    generative_models.HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: generative_models.HarmBlockThreshold.BLOCK_ONLY_HIGH,
-}
+def get_tagging_version() -> str:
+    """Identifies the model cascade + prompt combination that produces results, e.g. for embedded metadata."""
+    return f"{'+'.join(MODEL_CASCADE)}/{PROMPT_VERSION}"
+
+def _safety_settings() -> dict:
+    import vertexai.generative_models as generative_models
+    return {
+        generative_models.HarmCategory.HARM_CATEGORY_HARASSMENT: generative_models.HarmBlockThreshold.BLOCK_ONLY_HIGH,
+        generative_models.HarmCategory.HARM_CATEGORY_HATE_SPEECH: generative_models.HarmBlockThreshold.BLOCK_ONLY_HIGH,
+        generative_models.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: generative_models.HarmBlockThreshold.BLOCK_ONLY_HIGH,
+        generative_models.HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: generative_models.HarmBlockThreshold.BLOCK_ONLY_HIGH,
+    }
 
 _VERTEX_AI_INITIALIZED = False
+_vertex_init_lock = threading.Lock()
 
-def _initialize_vertex_ai_client():
+def initialize_vertex_ai() -> bool:
+    """Imports the vertexai SDK and initializes it once. Safe to call from several threads."""
     global _VERTEX_AI_INITIALIZED
     if _VERTEX_AI_INITIALIZED:
         return True
-    try:
-        if not PROJECT_ID or PROJECT_ID == "YOUR_GOOGLE_CLOUD_PROJECT_ID":
-            logger.error("PROJECT_ID is not set correctly in gemini_keyword_extractor.py.")
-            return False
-        vertexai.init(project=PROJECT_ID, location=LOCATION)
-        logger.info(f"Vertex AI client initialized successfully for project '{PROJECT_ID}' in '{LOCATION}'.")
+    if cassettes.store.replaying:
+        # Responses come from the cassette store; the SDK is never used.
         _VERTEX_AI_INITIALIZED = True
         return True
-    except Exception as e:
-        logger.error(f"Failed to initialize Vertex AI client: {e}", exc_info=True)
-        _VERTEX_AI_INITIALIZED = False
-        return False
+    with _vertex_init_lock:
+        if _VERTEX_AI_INITIALIZED:
+            return True
+        try:
+            default = endpoint_pool.default
+            if not default.project or default.project == "YOUR_GOOGLE_CLOUD_PROJECT_ID":
+                logger.error("PROJECT_ID is not set correctly in gemini_keyword_extractor.py.")
+                return False
+            import vertexai
+            vertexai.init(project=default.project, location=default.location)
+            logger.info(f"Vertex AI client initialized successfully for project '{default.project}' in '{default.location}' "
+                        f"({len(endpoint_pool.endpoints)} endpoint(s) in the pool: {', '.join(e.name for e in endpoint_pool.endpoints)}).")
+            _VERTEX_AI_INITIALIZED = True
+            return True
+        except Exception as e:
+            logger.error(f"Failed to initialize Vertex AI client: {e}", exc_info=True)
+            _VERTEX_AI_INITIALIZED = False
+            return False
+
+# --- Hedged requests (optional) ---
+# When a call hasn't returned within the HEDGE_PERCENTILE of recent latencies, an
+# identical second request is fired and whichever finishes first wins. Hedges are
+# capped at HEDGE_BUDGET_PERCENT of all calls so a slow backend isn't doubled up.
+HEDGING_ENABLED = os.getenv("GEMINI_HEDGING_ENABLED", "false").lower() in ("1", "true", "yes")
+HEDGE_PERCENTILE = float(os.getenv("GEMINI_HEDGE_PERCENTILE", "95"))
+HEDGE_BUDGET_PERCENT = float(os.getenv("GEMINI_HEDGE_BUDGET_PERCENT", "5"))
+HEDGE_MIN_SAMPLES = int(os.getenv("GEMINI_HEDGE_MIN_SAMPLES", "20"))
+HEDGE_MIN_DELAY_SECONDS = float(os.getenv("GEMINI_HEDGE_MIN_DELAY_SECONDS", "0.5"))
+HEDGE_LATENCY_WINDOW = int(os.getenv("GEMINI_HEDGE_LATENCY_WINDOW", "500"))
+
+_hedge_executor = ThreadPoolExecutor(max_workers=int(os.getenv("GEMINI_HEDGE_MAX_WORKERS", "32")), thread_name_prefix="gemini-hedge")
+_hedge_lock = threading.Lock()
+_recent_latencies = deque(maxlen=HEDGE_LATENCY_WINDOW)
+_hedge_metrics = {
+    "calls": 0,
+    "hedges_triggered": 0,
+    "hedges_won": 0,
+    "hedges_skipped_budget": 0,
+}
+
+def _record_latency(seconds: float):
+    with _hedge_lock:
+        _recent_latencies.append(seconds)
+
+def _hedge_delay() -> Optional[float]:
+    """Returns the latency percentile to wait before hedging, or None while there is too little history."""
+    with _hedge_lock:
+        if len(_recent_latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(_recent_latencies)
+    index = min(len(ordered) - 1, int(len(ordered) * HEDGE_PERCENTILE / 100.0))
+    return max(HEDGE_MIN_DELAY_SECONDS, ordered[index])
+
+def _try_reserve_hedge() -> bool:
+    with _hedge_lock:
+        if (_hedge_metrics["hedges_triggered"] + 1) * 100.0 > HEDGE_BUDGET_PERCENT * _hedge_metrics["calls"]:
+            _hedge_metrics["hedges_skipped_budget"] += 1
+            return False
+        _hedge_metrics["hedges_triggered"] += 1
+        return True
+
+def get_hedging_metrics() -> dict:
+    with _hedge_lock:
+        metrics = dict(_hedge_metrics)
+        latencies = sorted(_recent_latencies)
+    metrics["enabled"] = HEDGING_ENABLED
+    metrics["hedge_rate_percent"] = round(100.0 * metrics["hedges_triggered"] / metrics["calls"], 2) if metrics["calls"] else 0.0
+    metrics["hedge_win_rate_percent"] = round(100.0 * metrics["hedges_won"] / metrics["hedges_triggered"], 2) if metrics["hedges_triggered"] else 0.0
+    metrics["latency_samples"] = len(latencies)
+    metrics["p50_latency_seconds"] = round(latencies[len(latencies) // 2], 3) if latencies else None
+    metrics["current_hedge_delay_seconds"] = _hedge_delay()
+    return metrics
+
+def _timed_generate(model_instance, contents):
+    start = time.monotonic()
+    response = model_instance.generate_content(contents)
+    _record_latency(time.monotonic() - start)
+    return response
+
+def _call_gemini_hedged(model_instance, contents):
+    """
+    Calls generate_content, hedging with a duplicate request when enabled and the
+    primary is slower than the configured latency percentile.
+    """
+    with _hedge_lock:
+        _hedge_metrics["calls"] += 1
+    if not HEDGING_ENABLED:
+        return _timed_generate(model_instance, contents)
+
+    primary = _hedge_executor.submit(_timed_generate, model_instance, contents)
+    delay = _hedge_delay()
+    if delay is None:
+        return primary.result()
+    done, _ = wait([primary], timeout=delay)
+    if done or not _try_reserve_hedge():
+        return primary.result()
+
+    logger.info("Gemini call exceeded p%g latency (%.2fs). Sending hedged request.", HEDGE_PERCENTILE, delay)
+    hedge = _hedge_executor.submit(_timed_generate, model_instance, contents)
+    pending = {primary, hedge}
+    last_error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is not None:
+                last_error = future.exception()
+                continue
+            # A running SDK call can't be interrupted; cancel() only drops it if not yet started,
+            # otherwise its result is simply discarded.
+            for loser in pending:
+                loser.cancel()
+            if future is hedge:
+                with _hedge_lock:
+                    _hedge_metrics["hedges_won"] += 1
+            return future.result()
+    raise last_error
+
+# --- Circuit breaker for the Vertex AI dependency ---
+# While open, calls fail fast with CircuitOpenError instead of waiting on a degraded backend.
+vertex_breaker = CircuitBreaker(
+    "vertex_ai",
+    error_rate_threshold=float(os.getenv("GEMINI_BREAKER_ERROR_RATE", "0.5")),
+    slow_call_seconds=float(os.getenv("GEMINI_BREAKER_SLOW_CALL_SECONDS", "30")),
+    slow_call_rate_threshold=float(os.getenv("GEMINI_BREAKER_SLOW_CALL_RATE", "0.8")),
+    window_size=int(os.getenv("GEMINI_BREAKER_WINDOW", "20")),
+    min_calls=int(os.getenv("GEMINI_BREAKER_MIN_CALLS", "10")),
+    open_seconds=float(os.getenv("GEMINI_BREAKER_OPEN_SECONDS", "30")),
+    half_open_max_probes=int(os.getenv("GEMINI_BREAKER_HALF_OPEN_PROBES", "1")),
+    half_open_successes=int(os.getenv("GEMINI_BREAKER_HALF_OPEN_SUCCESSES", "2")),
+)
+
+def _call_gemini(model_id: str, prompt: str, contents):
+    """
+    Sends the call to the best endpoint of the pool (each endpoint has its own breaker too).
+    Returns (response, prompt_cache, endpoint_name).
+    """
+    def on_endpoint(endpoint):
+        with span("gemini.get_model", model_id=model_id, endpoint=endpoint.name):
+            model_entry = _get_model(model_id, prompt, endpoint)
+        return _call_gemini_hedged(model_entry["model"], contents), model_entry["mode"]
+    (response, prompt_cache), endpoint = vertex_breaker.call(endpoint_pool.call, on_endpoint)
+    return response, prompt_cache, endpoint.name
+
+def get_health() -> dict:
+    return {
+        "vertex_ai_initialized": _VERTEX_AI_INITIALIZED,
+        "circuit_breaker": vertex_breaker.snapshot(),
+        "endpoints": {name: {"available": e["available"], "breaker_state": e["circuit_breaker"]["state"]}
+                      for name, e in endpoint_pool.snapshot()["endpoints"].items()},
+    }
+
+def get_endpoint_stats() -> dict:
+    return endpoint_pool.snapshot()
+
+# --- Cascaded model routing ---
+# Each image starts on the cheapest tier and is escalated to the next model only when the
+# result fails the quality checks below. Configure the cascade as a comma-separated list.
+MODEL_CASCADE = [m.strip() for m in os.getenv("GEMINI_MODEL_CASCADE", f"{MODEL_ID},gemini-2.0-flash").split(",") if m.strip()]
+ROUTING_MIN_KEYWORDS = int(os.getenv("GEMINI_ROUTING_MIN_KEYWORDS", "5"))
+ROUTING_MAX_KEYWORDS = int(os.getenv("GEMINI_ROUTING_MAX_KEYWORDS", "25"))
+ROUTING_REQUIRE_DESCRIPTION = os.getenv("GEMINI_ROUTING_REQUIRE_DESCRIPTION", "true").lower() in ("1", "true", "yes")
+ROUTING_ESCALATE_ON_SAFETY = os.getenv("GEMINI_ROUTING_ESCALATE_ON_SAFETY", "true").lower() in ("1", "true", "yes")
+ROUTING_ESCALATE_ON_ERROR = os.getenv("GEMINI_ROUTING_ESCALATE_ON_ERROR", "true").lower() in ("1", "true", "yes")
+
+# USD per 1M (input, output) tokens. Override with GEMINI_MODEL_PRICING='{"model": [in, out], ...}'.
+MODEL_PRICING = {
+    "gemini-2.0-flash-lite": (0.075, 0.30),
+    "gemini-2.0-flash": (0.15, 0.60),
+    "gemini-2.5-flash": (0.30, 2.50),
+    "gemini-2.5-pro": (1.25, 10.00),
+}
+MODEL_PRICING.update({k: tuple(v) for k, v in json.loads(os.getenv("GEMINI_MODEL_PRICING", "{}")).items()})
+
+DESCRIPTION_SEPARATOR = "---DESCRIPTION---"
+MISSING_DESCRIPTION_TEXT = "Description not found (separator missing in AI response)."
+
+_routing_lock = threading.Lock()
+_routing_stats = {}
+
+def _tier_stats(model_id: str) -> dict:
+    return _routing_stats.setdefault(model_id, {
+        "attempts": 0,
+        "accepted": 0,
+        "escalated": 0,
+        "errors": 0,
+        "total_latency_seconds": 0.0,
+        "input_tokens": 0,
+        "output_tokens": 0,
+        "estimated_cost_usd": 0.0,
+    })
+
+def estimate_cost_usd(model_id: str, input_tokens: int, output_tokens: int, cached_input_tokens: int = 0) -> float:
+    input_price, output_price = MODEL_PRICING.get(model_id, (0.0, 0.0))
+    billed_input = (input_tokens - cached_input_tokens) + cached_input_tokens * CACHED_INPUT_PRICE_FACTOR
+    return (billed_input * input_price + output_tokens * output_price) / 1_000_000
+
+def get_routing_stats() -> dict:
+    with _routing_lock:
+        stats = {model_id: dict(values) for model_id, values in _routing_stats.items()}
+    for values in stats.values():
+        values["avg_latency_seconds"] = round(values["total_latency_seconds"] / values["attempts"], 3) if values["attempts"] else None
+        values["estimated_cost_usd"] = round(values["estimated_cost_usd"], 6)
+    return {"cascade": MODEL_CASCADE, "tiers": stats}
+
+# --- Static prompt as system instruction, with optional context caching ---
+# The prompt never changes between images, so it is set once as the system instruction
+# of a reusable model object and only the image goes into each request. With
+# GEMINI_CONTEXT_CACHE_ENABLED the instruction is also stored as Vertex cached content
+# so its tokens are billed at the cached rate; Vertex enforces a minimum cached size,
+# so when creation is rejected the system-instruction model is used on its own.
+CONTEXT_CACHE_ENABLED = os.getenv("GEMINI_CONTEXT_CACHE_ENABLED", "false").lower() in ("1", "true", "yes")
+CONTEXT_CACHE_TTL_SECONDS = int(os.getenv("GEMINI_CONTEXT_CACHE_TTL_SECONDS", "3600"))
+CACHED_INPUT_PRICE_FACTOR = float(os.getenv("GEMINI_CACHED_INPUT_PRICE_FACTOR", "0.25"))
+
+_model_cache = {}  # (model_id, prompt_version, endpoint name) -> {"model", "mode", "expires_at"}
+_model_cache_lock = threading.Lock()  # guards the dicts only, never held while building
+_model_build_locks = {}  # key -> lock serializing builds of that key
+
+def _prompt_version(prompt: str) -> str:
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:12]
+
+def _build_on_endpoint(endpoint, build):
+    """Runs build() with the SDK pointed at the endpoint, then points it back at the default."""
+    import vertexai
+    # vertexai.init() is process-wide, but models and cached contents keep the project and
+    # location they were created under; build this endpoint's with the SDK pointed at it.
+    with _vertex_init_lock:
+        vertexai.init(project=endpoint.project, location=endpoint.location)
+        try:
+            return build()
+        finally:
+            default = endpoint_pool.default
+            vertexai.init(project=default.project, location=default.location)
+
+def _build_model(model_id: str, prompt: str, endpoint) -> dict:
+    return _build_on_endpoint(endpoint, lambda: _build_model_for_current_endpoint(model_id, prompt, endpoint))
+
+def _build_model_for_current_endpoint(model_id: str, prompt: str, endpoint) -> dict:
+    from vertexai.generative_models import GenerativeModel
+    if CONTEXT_CACHE_ENABLED:
+        try:
+            from vertexai.preview import caching
+            import datetime
+            cached_content = caching.CachedContent.create(
+                model_name=model_id,
+                system_instruction=prompt,
+                ttl=datetime.timedelta(seconds=CONTEXT_CACHE_TTL_SECONDS),
+                display_name=f"omi-keywords-{_prompt_version(prompt)}",
+            )
+            model = GenerativeModel.from_cached_content(cached_content=cached_content)
+            logger.info(f"Created context cache for '{model_id}' on {endpoint.name} (prompt version {_prompt_version(prompt)}).")
+            # Refresh a little before Vertex expires the cache.
+            return {"model": model, "mode": "context_cache", "expires_at": time.monotonic() + CONTEXT_CACHE_TTL_SECONDS * 0.9}
+        except Exception as e:
+            logger.warning(f"Context cache unavailable for '{model_id}' on {endpoint.name}, using system instruction only: {e}")
+    model = GenerativeModel(model_id, system_instruction=[prompt], safety_settings=_safety_settings())
+    return {"model": model, "mode": "system_instruction", "expires_at": None}
+
+def _get_model(model_id: str, prompt: str, endpoint) -> dict:
+    """Returns the reusable model entry for this model, prompt version and endpoint, rebuilding it when stale."""
+    key = (model_id, _prompt_version(prompt), endpoint.name)
+    entry = _fresh_model_entry(key)
+    if entry is not None:
+        return entry
+    # Building may create a context cache over the network; only callers of the same key wait for it.
+    with _model_cache_lock:
+        build_lock = _model_build_locks.setdefault(key, threading.Lock())
+    with build_lock:
+        entry = _fresh_model_entry(key)
+        if entry is None:
+            entry = _build_model(model_id, prompt, endpoint)
+            with _model_cache_lock:
+                # Drop entries for older prompt versions of this model on this endpoint.
+                for stale_key in [k for k in _model_cache if k[0] == model_id and k[2] == endpoint.name and k != key]:
+                    del _model_cache[stale_key]
+                    _model_build_locks.pop(stale_key, None)
+                _model_cache[key] = entry
+        return entry
+
+def _fresh_model_entry(key):
+    with _model_cache_lock:
+        entry = _model_cache.get(key)
+    if entry is None or (entry["expires_at"] is not None and time.monotonic() >= entry["expires_at"]):
+        return None
+    return entry
+
+_prompt_token_cache = {}
+
+def _count_tokens_on_endpoint(endpoint, model_id: str, prompt: str) -> int:
+    from vertexai.generative_models import GenerativeModel
+    # A bare model, so the system instruction isn't counted twice.
+    model = _build_on_endpoint(endpoint, lambda: GenerativeModel(model_id))
+    return model.count_tokens(prompt).total_tokens
+
+def get_prompt_token_count(model_id: str, prompt: str) -> int:
+    """
+    Token count of the fixed text prompt, counted once per model/prompt and cached. The call
+    goes through the endpoint pool and the Vertex AI breaker like generate calls. Falls back to
+    a ~4 characters/token estimate if count_tokens is unavailable; while the breaker is open
+    the estimate is not cached, so the count is tried again once Vertex AI recovers.
+    """
+    key = (model_id, _prompt_version(prompt))
+    if key not in _prompt_token_cache:
+        def count_tokens():
+            total, _ = vertex_breaker.call(endpoint_pool.call, lambda e: _count_tokens_on_endpoint(e, model_id, prompt))
+            return total
+        try:
+            _prompt_token_cache[key], _ = cassettes.store.call(
+                "gemini_count_tokens", cassettes.request_key("count_tokens", *key), count_tokens,
+                serialize_error=_cassette_error)
+        except CircuitOpenError:
+            return max(1, len(prompt) // 4)
+        except Exception as e:
+            logger.warning(f"Could not count prompt tokens for '{model_id}', estimating instead: {e}")
+            _prompt_token_cache[key] = max(1, len(prompt) // 4)
+    return _prompt_token_cache[key]
+
+# --- Image embeddings (similar-image search, EMBEDDING_BACKEND=vertex) ---
+# Embedding calls take the same route as generate calls: the endpoint pool, the Vertex AI
+# breaker and the cassette store. Their cost is reported through call_info for the usage ledger.
+EMBEDDING_PRICE_PER_IMAGE_USD = float(os.getenv("VERTEX_EMBEDDING_PRICE_PER_IMAGE_USD", "0.0001"))
+
+_embedding_models = {}  # (model_name, endpoint name) -> MultiModalEmbeddingModel
+
+def _get_embedding_model(model_name: str, endpoint):
+    key = (model_name, endpoint.name)
+    model = _embedding_models.get(key)
+    if model is None:
+        from vertexai.vision_models import MultiModalEmbeddingModel
+        built = _build_on_endpoint(endpoint, lambda: MultiModalEmbeddingModel.from_pretrained(model_name))
+        model = _embedding_models.setdefault(key, built)
+    return model
+
+def _embed_on_endpoint(endpoint, model_name: str, image_bytes, dimension: int) -> List[float]:
+    from vertexai.vision_models import Image
+    model = _get_embedding_model(model_name, endpoint)
+    result = model.get_embeddings(image=Image(image_bytes=bytes(image_bytes)), dimension=dimension)
+    return list(result.image_embedding)
+
+def generate_image_embedding(image_bytes, model_name: str, dimension: int, call_info: Optional[dict] = None) -> List[float]:
+    """
+    Embeds an image with a Vertex multimodal embedding model. With CASSETTE_MODE=record the
+    vector is stored; with replay it is served from the store.
+    call_info is filled with calls, latency_seconds, estimated_cost_usd and endpoint.
+    Raises:
+        CircuitOpenError: if the Vertex AI circuit breaker (or every endpoint's) is open.
+    """
+    if call_info is None:
+        call_info = {}
+    if not _VERTEX_AI_INITIALIZED and not initialize_vertex_ai():
+        raise RuntimeError("Vertex AI client could not be initialized.")
+    cassette_key = cassettes.request_key("embed", model_name, dimension, cassettes.digest(image_bytes))
+    with span("vertex.embed", model_name=model_name) as attributes:
+        if cassettes.store.replaying:
+            vector, latency = cassettes.store.call("vertex_embedding", cassette_key, None)
+            endpoint_name = "cassette"
+        else:
+            def call():
+                return vertex_breaker.call(endpoint_pool.call, lambda e: _embed_on_endpoint(e, model_name, image_bytes, dimension))
+            (vector, endpoint), latency = cassettes.store.call(
+                "vertex_embedding", cassette_key, call, serialize=lambda result: result[0], serialize_error=_cassette_error)
+            endpoint_name = endpoint.name
+        attributes["endpoint"] = endpoint_name
+    call_info.update({"calls": 1, "latency_seconds": latency, "estimated_cost_usd": EMBEDDING_PRICE_PER_IMAGE_USD,
+                      "endpoint": endpoint_name})
+    return vector
+
+def _usage_from_response(response) -> Tuple[int, int, int]:
+    """Returns (input_tokens, output_tokens, cached_input_tokens)."""
+    usage = getattr(response, "usage_metadata", None)
+    if not usage:
+        return 0, 0, 0
+    return (getattr(usage, "prompt_token_count", 0) or 0,
+            getattr(usage, "candidates_token_count", 0) or 0,
+            getattr(usage, "cached_content_token_count", 0) or 0)
+
+def _model_version_from_response(response) -> Optional[str]:
+    """The concrete model version that served the call (model IDs like 'gemini-2.0-flash' are aliases)."""
+    raw = getattr(response, "_raw_response", None)
+    return getattr(response, "model_version", None) or getattr(raw, "model_version", None) or None
+
+def _parse_gemini_response(response) -> Tuple[Optional[List[str]], Optional[str], Optional[str], bool]:
+    """
+    Parses a Gemini response into (keywords, description, error_message, safety_blocked).
+    The keywords are the hashtags as the model wrote them, not yet normalized.
+    """
+    if not response.candidates:
+        logger.warning("Gemini response did not contain any candidates.")
+        logger.debug("Raw Gemini response: %s", Lazy(lambda: response))
+        error_msg = "Error: No analysis content received from AI (no candidates)."
+        blocked = False
+        if response.prompt_feedback and response.prompt_feedback.block_reason_message:
+            error_msg = f"Error: Content blocked by AI. Reason: {response.prompt_feedback.block_reason_message}"
+            blocked = True
+        return None, None, error_msg, blocked
+
+    candidate = response.candidates[0]
+
+    # Compared by name, so replayed responses parse without the SDK.
+    if getattr(candidate.finish_reason, "name", None) == "SAFETY":
+        logger.warning("Content blocked by AI due to safety reasons. Finish reason: %s", candidate.finish_reason.name)
+        block_reason_message = "Content blocked by AI due to safety settings."
+        return None, None, f"Error: {block_reason_message}", True
+
+    if not (candidate.content and candidate.content.parts and candidate.content.parts[0].text):
+        logger.warning("Gemini response structure not as expected (no text part).")
+        logger.debug("Unexpected Gemini candidate: %s", Lazy(lambda: candidate))
+        return None, None, "Error: Received an unexpected response structure from AI (no text part).", False
+
+    text_response = candidate.content.parts[0].text.strip()
+    logger.debug("Successfully received response from Gemini: %s", truncate(text_response, 150))
+
+    # Parse keywords and description
+    keywords = []
+    description = None
+
+    if DESCRIPTION_SEPARATOR in text_response:
+        parts = text_response.split(DESCRIPTION_SEPARATOR, 1)
+        keyword_section = parts[0].strip()
+        description_section = parts[1].strip() if len(parts) > 1 else ""
+
+        # Hashtags as the model wrote them; they are normalized onto the controlled vocabulary
+        # once the cascade has judged them (see _normalize_result_keywords)
+        keywords = keyword_normalizer.normalizer.find_hashtags(keyword_section)
+
+        description = description_section
+    else:
+        # Fallback: try to get keywords if separator is missing, description will be None
+        logger.warning("Separator '%s' not found in response. Attempting to extract only keywords.", DESCRIPTION_SEPARATOR)
+        keywords = keyword_normalizer.normalizer.find_hashtags(text_response)
+        description = MISSING_DESCRIPTION_TEXT
+
+    if not keywords and not description: # If both are missing, it's likely a parsing or response issue
+        logger.warning("Could not parse keywords or description from response: %s", truncate(text_response))
+        return None, None, f"Could not parse keywords or description. Model said: {text_response}", False
+
+    if not keywords:
+        logger.warning("No keywords starting with '#' found in response: %s", truncate(text_response))
+        # Decide if this is an error or just a partial success
+        # For now, let's return what we have, even if keywords are missing but description is present
+
+    return keywords if keywords else [], description, None, False # Return empty list if no keywords
+
+def _response_to_record(response, prompt_cache: str) -> dict:
+    """The parts of a response the pipeline reads, for the cassette store."""
+    candidates = []
+    for candidate in response.candidates or []:
+        texts = []
+        for part in (candidate.content.parts if candidate.content else []):
+            try:
+                texts.append(part.text)
+            except (AttributeError, ValueError):  # non-text part
+                texts.append(None)
+        candidates.append({"finish_reason": getattr(candidate.finish_reason, "name", None), "texts": texts})
+    feedback = getattr(response, "prompt_feedback", None)
+    input_tokens, output_tokens, cached_tokens = _usage_from_response(response)
+    return {
+        "candidates": candidates,
+        "block_reason_message": getattr(feedback, "block_reason_message", None) if feedback else None,
+        "usage": [input_tokens, output_tokens, cached_tokens],
+        "model_version": _model_version_from_response(response),
+        "prompt_cache": prompt_cache,
+    }
+
+def _response_from_record(record: dict) -> SimpleNamespace:
+    """Rebuilds a response-shaped object that _parse_gemini_response and the usage helpers accept."""
+    input_tokens, output_tokens, cached_tokens = record["usage"]
+    return SimpleNamespace(
+        candidates=[SimpleNamespace(finish_reason=SimpleNamespace(name=c["finish_reason"]),
+                                    content=SimpleNamespace(parts=[SimpleNamespace(text=t) for t in c["texts"]]))
+                    for c in record["candidates"]],
+        prompt_feedback=SimpleNamespace(block_reason_message=record["block_reason_message"]),
+        usage_metadata=SimpleNamespace(prompt_token_count=input_tokens, candidates_token_count=output_tokens,
+                                       cached_content_token_count=cached_tokens),
+        model_version=record["model_version"],
+    )
+
+def _cassette_error(e: Exception) -> Optional[dict]:
+    # An open breaker is local state, not a backend response.
+    return None if isinstance(e, CircuitOpenError) else {"type": type(e).__name__, "message": str(e)}
+
+def _generate(model_id: str, prompt: str, contents, cassette_key: str):
+    """
+    One Gemini call (endpoint routing, breakers, hedging) for a tier.
+    Returns (response, latency_seconds, prompt_cache, endpoint_name).
+    With CASSETTE_MODE=record the response is stored; with replay it is served from the store.
+    """
+    if cassettes.store.replaying:
+        record, latency = cassettes.store.call("gemini", cassette_key, None)
+        return _response_from_record(record), latency, record["prompt_cache"], "cassette"
+    (response, prompt_cache, endpoint_name), latency = cassettes.store.call(
+        "gemini", cassette_key, lambda: _call_gemini(model_id, prompt, contents),
+        serialize=lambda result: _response_to_record(result[0], result[1]), serialize_error=_cassette_error)
+    return response, latency, prompt_cache, endpoint_name
+
+def _normalize_result_keywords(keywords: Optional[List[str]]) -> Optional[List[str]]:
+    """
+    Folds the accepted hashtags onto the vocabulary, adding the terms found inside compound tags
+    (#ShuriCastleAtNight -> #shuricastleatnight, #shuri_castle) only while it stays within
+    ROUTING_MAX_KEYWORDS.
+    """
+    if keywords is None:
+        return None
+    return keyword_normalizer.normalizer.normalize_keywords(keywords, limit=ROUTING_MAX_KEYWORDS)
+
+def _quality_issues(keywords: Optional[List[str]], description: Optional[str], error: Optional[str], blocked: bool) -> List[str]:
+    """
+    Returns the reasons a result should be escalated to the next tier (empty if it is acceptable).
+    The keyword count is that of the distinct tags the model gave, before any vocabulary expansion.
+    """
+    if blocked:
+        return ["safety_block"] if ROUTING_ESCALATE_ON_SAFETY else []
+    if error:
+        return ["error"] if ROUTING_ESCALATE_ON_ERROR else []
+    issues = []
+    keyword_count = len(keyword_normalizer.normalizer.normalize_keywords(keywords or [], expand=False))
+    if not ROUTING_MIN_KEYWORDS <= keyword_count <= ROUTING_MAX_KEYWORDS:
+        issues.append(f"keyword_count_{keyword_count}")
+    if ROUTING_REQUIRE_DESCRIPTION and (not description or description == MISSING_DESCRIPTION_TEXT):
+        issues.append("missing_description")
+    return issues
 
 def generate_keywords_and_description(
     image_bytes: bytes,
     mime_type: str,
-    custom_prompt: Optional[str] = None
+    custom_prompt: Optional[str] = None,
+    call_info: Optional[dict] = None
 ) -> Tuple[Optional[List[str]], Optional[str], Optional[str]]: # Keywords, Description, Error
     """
-    Generates keywords and a description for an image using the Gemini model.
+    Generates keywords and a description for an image using the Gemini model cascade.
     Args:
-        image_bytes: The raw bytes of the image.
+        image_bytes: The raw bytes of the image (bytes or any buffer, e.g. an mmap).
         mime_type: The MIME type of the image (e.g., "image/jpeg", "image/png").
         custom_prompt: An optional custom prompt. If None, uses KEYWORD_DESCRIPTION_PROMPT.
+        call_info: Optional dict that is filled with details about the call
+            (model_id, model_version, tier, escalations, calls, latency_seconds, input_tokens, output_tokens,
+            prompt_tokens, cached_input_tokens, prompt_cost_saved_usd, estimated_cost_usd,
+            prompt_version, prompt_cache, endpoint), summed over every tier that was tried.
     Returns:
         A tuple: (list_of_keywords, description_text, error_message).
         If successful, list_of_keywords contains strings like "#keyword",
         description_text contains the image description, and error_message is None.
         If an error occurs, list_of_keywords and description_text are None,
         and error_message contains the error details.
+    Raises:
+        CircuitOpenError: if the Vertex AI circuit breaker is open; callers should fail fast.
     """
+    if call_info is None:
+        call_info = {}
     if not _VERTEX_AI_INITIALIZED:
         logger.warning("Vertex AI not initialized. Attempting to initialize now.")
-        if not _initialize_vertex_ai_client():
+        if not initialize_vertex_ai():
             return None, None, "Error: Vertex AI client could not be initialized."
 
     prompt_to_use = custom_prompt if custom_prompt is not None else KEYWORD_DESCRIPTION_PROMPT
 
     try:
-        model_instance = GenerativeModel(MODEL_ID, safety_settings=SAFETY_SETTINGS)
-        image_part = Part.from_data(data=image_bytes, mime_type=mime_type)
-        prompt_part = Part.from_text(prompt_to_use)
-        contents_for_sdk = [image_part, prompt_part]
-
-        logger.info(f"Sending request to Gemini model '{MODEL_ID}'. Prompt: '{prompt_to_use[:80]}...'")
-        response = model_instance.generate_content(contents_for_sdk)
-
-        if not response.candidates:
-            logger.warning(f"Gemini response did not contain any candidates. Raw response: {response}")
-            error_msg = "Error: No analysis content received from AI (no candidates)."
-            if response.prompt_feedback and response.prompt_feedback.block_reason_message:
-                error_msg = f"Error: Content blocked by AI. Reason: {response.prompt_feedback.block_reason_message}"
-            return None, None, error_msg
-
-        candidate = response.candidates[0]
-
-        if candidate.finish_reason == FinishReason.SAFETY:
-            logger.warning(f"Content blocked by AI due to safety reasons. Finish reason: {candidate.finish_reason.name}")
-            block_reason_message = "Content blocked by AI due to safety settings."
-            # (Error message extraction logic remains similar)
-            return None, None, f"Error: {block_reason_message}"
-
-        if not (candidate.content and candidate.content.parts and candidate.content.parts[0].text):
-            logger.warning(f"Gemini response structure not as expected (no text part). Candidate: {candidate}")
-            return None, None, "Error: Received an unexpected response structure from AI (no text part)."
-
-        text_response = candidate.content.parts[0].text.strip()
-        logger.info(f"Successfully received response from Gemini: '{text_response[:150]}...'")
-
-        # Parse keywords and description
-        keywords = []
-        description = None
-        
-        separator = "---DESCRIPTION---"
-        if separator in text_response:
-            parts = text_response.split(separator, 1)
-            keyword_section = parts[0].strip()
-            description_section = parts[1].strip() if len(parts) > 1 else ""
-
-            # Extract keywords from the first section
-            # Using regex to be more robust with potential leading/trailing text around keywords
-            raw_keywords = re.findall(r"#\w+", keyword_section)
-            keywords = [kw.strip() for kw in raw_keywords if kw.startswith('#')]
-            
-            description = description_section
-        else:
-            # Fallback: try to get keywords if separator is missing, description will be None
-            logger.warning(f"Separator '{separator}' not found in response. Attempting to extract only keywords.")
-            raw_keywords = re.findall(r"#\w+", text_response)
-            keywords = [kw.strip() for kw in raw_keywords if kw.startswith('#')]
-            description = "Description not found (separator missing in AI response)."
+        # Cassette recordings are keyed on the image content, model and prompt version.
+        image_digest = cassettes.digest(image_bytes) if cassettes.store.mode != "off" else None
+        contents_for_sdk = None
+        if not cassettes.store.replaying:
+            from vertexai.generative_models import Part
+            # The prompt travels as the model's system instruction; only the image is per-request.
+            # Buffers such as mmap are copied once here; the SDK then base64-encodes the request
+            # (see EXTRACTION_MEMORY_FACTOR in fastapi_server.py for the resulting peak).
+            with span("gemini.build_part", bytes=len(image_bytes)):
+                image_part = Part.from_data(data=image_bytes if isinstance(image_bytes, bytes) else bytes(image_bytes), mime_type=mime_type)
+            contents_for_sdk = [image_part]
+    except Exception as e:
+        logger.error("Error preparing Gemini request: %s", e, exc_info=True)
+        return None, None, f"Error: An exception occurred during AI processing: {str(e)}"
 
+    call_info.update({"escalations": [], "calls": 0, "latency_seconds": 0.0, "input_tokens": 0, "output_tokens": 0, "prompt_tokens": 0,
+                      "cached_input_tokens": 0, "prompt_cost_saved_usd": 0.0, "estimated_cost_usd": 0.0,
+                      "prompt_version": _prompt_version(prompt_to_use)})
+    result = (None, None, "Error: No model tiers configured.")
+    for tier, model_id in enumerate(MODEL_CASCADE):
+        is_last_tier = tier == len(MODEL_CASCADE) - 1
+        start = time.monotonic()
+        try:
+            logger.info("Sending request to Gemini model.",
+                        extra={"model_id": model_id, "tier": tier, "prompt_version": call_info["prompt_version"]})
+            cassette_key = cassettes.request_key("generate", model_id, call_info["prompt_version"], image_digest, mime_type)
+            call_info["calls"] += 1
+            with span("gemini.generate", model_id=model_id, tier=tier) as attributes:
+                response, latency, prompt_cache, endpoint_name = _generate(model_id, prompt_to_use, contents_for_sdk, cassette_key)
+                attributes.update(prompt_cache=prompt_cache, endpoint=endpoint_name)
+            input_tokens, output_tokens, cached_tokens = _usage_from_response(response)
+            model_version = _model_version_from_response(response)
+            prompt_tokens = get_prompt_token_count(model_id, prompt_to_use) if input_tokens else 0
+            with span("gemini.parse", model_id=model_id):
+                keywords, description, error_message, blocked = _parse_gemini_response(response)
+        except CircuitOpenError:
+            raise
+        except Exception as e:
+            logger.error("Error calling Gemini API or parsing response: %s", e, exc_info=True, extra={"model_id": model_id, "tier": tier})
+            latency = time.monotonic() - start
+            input_tokens, output_tokens, prompt_tokens, cached_tokens = 0, 0, 0, 0
+            model_version, prompt_cache, endpoint_name = None, None, None
+            keywords, description, blocked = None, None, False
+            error_message = f"Error: An exception occurred during AI processing: {str(e)}"
 
-        if not keywords and not description: # If both are missing, it's likely a parsing or response issue
-             logger.warning(f"Could not parse keywords or description from response: '{text_response}'")
-             return None, None, f"Could not parse keywords or description. Model said: {text_response}"
-        
-        if not keywords:
-            logger.warning(f"No keywords starting with '#' found in response: '{text_response}'")
-            # Decide if this is an error or just a partial success
-            # For now, let's return what we have, even if keywords are missing but description is present
+        cost = estimate_cost_usd(model_id, input_tokens, output_tokens, cached_tokens)
+        issues = _quality_issues(keywords, description, error_message, blocked)
+        with _routing_lock:
+            stats = _tier_stats(model_id)
+            stats["attempts"] += 1
+            stats["errors"] += 1 if error_message else 0
+            stats["total_latency_seconds"] += latency
+            stats["input_tokens"] += input_tokens
+            stats["output_tokens"] += output_tokens
+            stats["estimated_cost_usd"] += cost
+            if issues and not is_last_tier:
+                stats["escalated"] += 1
+            elif not error_message:
+                stats["accepted"] += 1
 
-        return keywords if keywords else [], description, None # Return empty list if no keywords
+        call_info["latency_seconds"] += latency
+        call_info["input_tokens"] += input_tokens
+        call_info["output_tokens"] += output_tokens
+        call_info["prompt_tokens"] += prompt_tokens
+        call_info["cached_input_tokens"] += cached_tokens
+        call_info["prompt_cost_saved_usd"] += estimate_cost_usd(model_id, cached_tokens, 0) - estimate_cost_usd(model_id, cached_tokens, 0, cached_tokens)
+        call_info["estimated_cost_usd"] += cost
 
-    except Exception as e:
-        logger.error(f"Error calling Gemini API or parsing response: {e}", exc_info=True)
-        return None, None, f"Error: An exception occurred during AI processing: {str(e)}"
+        # Keep the best usable result seen so far in case every tier falls short,
+        # attributed to the tier that actually produced it.
+        if not error_message or result[2]:
+            result = (keywords, description, error_message)
+            call_info.update({"model_id": model_id, "model_version": model_version or model_id, "tier": tier,
+                              "prompt_cache": prompt_cache, "endpoint": endpoint_name})
+        if not issues:
+            break
+        if not is_last_tier:
+            logger.info("Escalating from '%s' to '%s'.", model_id, MODEL_CASCADE[tier + 1],
+                        extra={"model_id": model_id, "reasons": issues})
+            call_info["escalations"].append({"model_id": model_id, "reasons": issues})
 
-_initialize_vertex_ai_client()
+    return (_normalize_result_keywords(result[0]), *result[1:])
@@ -0,0 +1,380 @@
+# image_metadata.py
+import io
+import os
+import re
+import shutil
+import struct
+import logging
+import tempfile
+import zlib
+import xml.etree.ElementTree as ET
+from typing import Optional, List, Dict, Any, BinaryIO
+
+logger = logging.getLogger(__name__)
+
+# --- Supported container formats ---
+JPEG_SOI = b"\xff\xd8"
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# --- Metadata identifiers ---
+XMP_APP1_HEADER = b"http://ns.adobe.com/xap/1.0/\x00"
+PHOTOSHOP_APP13_HEADER = b"Photoshop 3.0\x00"
+IPTC_IRB_RESOURCE_ID = 0x0404
+PNG_XMP_KEYWORD = b"XML:com.adobe.xmp"
+
+NS_X = "adobe:ns:meta/"
+NS_RDF = "http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+NS_DC = "http://purl.org/dc/elements/1.1/"
+NS_OMI = "urn:omi-photos:xmp:1.0"
+
+MAX_JPEG_SEGMENT_PAYLOAD = 65533  # 0xFFFF minus the two length bytes
+IPTC_KEYWORD_MAX_BYTES = 64
+IPTC_CAPTION_MAX_BYTES = 2000
+
+
+def _escape_xml(text: str) -> str:
+    return (text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+            .replace('"', "&quot;"))
+
+
+def _strip_hash(keyword: str) -> str:
+    return keyword[1:] if keyword.startswith("#") else keyword
+
+
+def build_xmp_packet(keywords: List[str], description: Optional[str], tagging_version: str) -> bytes:
+    """
+    Builds an XMP packet carrying keywords (dc:subject), the description
+    (dc:description) and the tagging version that produced them (omi:TaggingVersion).
+    Keywords are stored without the leading '#'.
+    """
+    subject_items = "".join(f"<rdf:li>{_escape_xml(_strip_hash(kw))}</rdf:li>" for kw in keywords)
+    description_xml = ""
+    if description:
+        description_xml = (
+            "<dc:description><rdf:Alt>"
+            f"<rdf:li xml:lang=\"x-default\">{_escape_xml(description)}</rdf:li>"
+            "</rdf:Alt></dc:description>"
+        )
+    packet = (
+        "<?xpacket begin=\"\ufeff\" id=\"W5M0MpCehiHzreSzNTczkc9d\"?>"
+        f"<x:xmpmeta xmlns:x=\"{NS_X}\">"
+        f"<rdf:RDF xmlns:rdf=\"{NS_RDF}\">"
+        f"<rdf:Description rdf:about=\"\" xmlns:dc=\"{NS_DC}\" xmlns:omi=\"{NS_OMI}\""
+        f" omi:TaggingVersion=\"{_escape_xml(tagging_version)}\">"
+        f"<dc:subject><rdf:Bag>{subject_items}</rdf:Bag></dc:subject>"
+        f"{description_xml}"
+        "</rdf:Description>"
+        "</rdf:RDF>"
+        "</x:xmpmeta>"
+        "<?xpacket end=\"w\"?>"
+    )
+    return packet.encode("utf-8")
+
+
+def parse_xmp_packet(packet: bytes) -> Optional[Dict[str, Any]]:
+    """
+    Parses an XMP packet and returns {"tagging_version", "keywords", "description"},
+    or None if the packet can't be parsed. Keywords are returned with a leading '#'.
+    """
+    match = re.search(rb"<x:xmpmeta.*?</x:xmpmeta>", packet, re.DOTALL)
+    if not match:
+        return None
+    try:
+        root = ET.fromstring(match.group(0))
+    except ET.ParseError as e:
+        logger.warning(f"Image Metadata: Could not parse embedded XMP packet: {e}")
+        return None
+
+    tagging_version = None
+    keywords: List[str] = []
+    description = None
+    for desc_node in root.iter(f"{{{NS_RDF}}}Description"):
+        tagging_version = tagging_version or desc_node.get(f"{{{NS_OMI}}}TaggingVersion")
+        version_node = desc_node.find(f"{{{NS_OMI}}}TaggingVersion")
+        if tagging_version is None and version_node is not None:
+            tagging_version = (version_node.text or "").strip() or None
+        subject = desc_node.find(f"{{{NS_DC}}}subject")
+        if subject is not None:
+            keywords.extend(f"#{li.text.strip()}" for li in subject.iter(f"{{{NS_RDF}}}li") if li.text and li.text.strip())
+        desc_el = desc_node.find(f"{{{NS_DC}}}description")
+        if desc_el is not None and description is None:
+            for li in desc_el.iter(f"{{{NS_RDF}}}li"):
+                if li.text:
+                    description = li.text
+                    break
+    return {"tagging_version": tagging_version, "keywords": keywords, "description": description}
+
+
+def _iptc_dataset(record: int, dataset: int, value: bytes) -> bytes:
+    return struct.pack(">BBBH", 0x1C, record, dataset, len(value)) + value
+
+
+def _truncate_utf8(text: str, max_bytes: int) -> bytes:
+    return text.encode("utf-8")[:max_bytes].decode("utf-8", errors="ignore").encode("utf-8")
+
+
+def build_iptc_block(keywords: List[str], description: Optional[str]) -> bytes:
+    """Builds an IPTC-IIM block with keywords (2:25) and caption (2:120), UTF-8 encoded."""
+    block = _iptc_dataset(1, 90, b"\x1b%G")  # CodedCharacterSet = UTF-8
+    block += _iptc_dataset(2, 0, b"\x00\x04")  # RecordVersion
+    for kw in keywords:
+        block += _iptc_dataset(2, 25, _truncate_utf8(_strip_hash(kw), IPTC_KEYWORD_MAX_BYTES))
+    if description:
+        block += _iptc_dataset(2, 120, _truncate_utf8(description, IPTC_CAPTION_MAX_BYTES))
+    return block
+
+
+def _parse_irb_resources(data: bytes) -> List[tuple]:
+    """Splits a Photoshop IRB payload into (resource_id, name_bytes, data) tuples."""
+    resources = []
+    pos = 0
+    while pos + 12 <= len(data) and data[pos:pos + 4] == b"8BIM":
+        resource_id = struct.unpack(">H", data[pos + 4:pos + 6])[0]
+        name_len = data[pos + 6]
+        name_field_len = name_len + 1
+        if name_field_len % 2:
+            name_field_len += 1
+        name = data[pos + 6:pos + 6 + name_field_len]
+        size_pos = pos + 6 + name_field_len
+        size = struct.unpack(">I", data[size_pos:size_pos + 4])[0]
+        value = data[size_pos + 4:size_pos + 4 + size]
+        resources.append((resource_id, name, value))
+        pos = size_pos + 4 + size + (size % 2)
+    return resources
+
+
+def _build_irb_resources(resources: List[tuple]) -> bytes:
+    out = b""
+    for resource_id, name, value in resources:
+        out += b"8BIM" + struct.pack(">H", resource_id) + name + struct.pack(">I", len(value)) + value
+        if len(value) % 2:
+            out += b"\x00"
+    return out
+
+
+# --- JPEG ---
+
+def _iter_jpeg_header_segments(stream: BinaryIO, load_payload):
+    """
+    Walks JPEG marker segments up to (not including) SOS without touching scan data.
+    Yields (marker, payload_or_None) tuples; payloads are only read when
+    load_payload(marker, prefix) is true, otherwise the stream seeks past them.
+    Once exhausted, the stream is left positioned at the SOS marker.
+    """
+    if stream.read(2) != JPEG_SOI:
+        raise ValueError("Not a JPEG file.")
+    while True:
+        byte = stream.read(1)
+        if not byte:
+            raise ValueError("Unexpected end of JPEG before image data.")
+        if byte != b"\xff":
+            raise ValueError("Corrupt JPEG marker structure.")
+        marker = stream.read(1)
+        while marker == b"\xff":  # fill bytes
+            marker = stream.read(1)
+        if not marker:
+            raise ValueError("Unexpected end of JPEG before image data.")
+        marker_code = marker[0]
+        if marker_code == 0xDA:  # SOS: everything from here on is copied verbatim
+            stream.seek(-2, os.SEEK_CUR)
+            return
+        if marker_code == 0xD9:
+            raise ValueError("JPEG ended before any image data.")
+        if 0xD0 <= marker_code <= 0xD7 or marker_code == 0x01:
+            yield marker_code, b""
+            continue
+        length_bytes = stream.read(2)
+        if len(length_bytes) != 2:
+            raise ValueError("Truncated JPEG segment header.")
+        payload_len = struct.unpack(">H", length_bytes)[0] - 2
+        prefix = stream.read(min(payload_len, len(XMP_APP1_HEADER)))
+        if load_payload(marker_code, prefix):
+            yield marker_code, prefix + stream.read(payload_len - len(prefix))
+        else:
+            stream.seek(payload_len - len(prefix), os.SEEK_CUR)
+            yield marker_code, None
+
+
+def _jpeg_segment(marker_code: int, payload: bytes) -> bytes:
+    if len(payload) > MAX_JPEG_SEGMENT_PAYLOAD:
+        raise ValueError(f"Metadata segment too large for JPEG ({len(payload)} bytes).")
+    return bytes((0xFF, marker_code)) + struct.pack(">H", len(payload) + 2) + payload
+
+
+def _probe_jpeg(stream: BinaryIO) -> Optional[bytes]:
+    # Stops at the packet, so a header cut off further on (e.g. mid ICC profile) still probes.
+    segments = _iter_jpeg_header_segments(
+        stream, lambda code, prefix: code == 0xE1 and prefix.startswith(XMP_APP1_HEADER)
+    )
+    for code, payload in segments:
+        if code == 0xE1 and payload:
+            return payload[len(XMP_APP1_HEADER):]
+    return None
+
+
+def _write_jpeg(src: BinaryIO, dst: BinaryIO, xmp_packet: bytes, iptc_block: bytes):
+    # Every segment before SOS is loaded (they're small); scan data is streamed.
+    segments = list(_iter_jpeg_header_segments(src, lambda code, prefix: True))
+
+    existing_irb: List[tuple] = []
+    kept = []
+    for code, payload in segments:
+        if code == 0xE1 and payload.startswith(XMP_APP1_HEADER):
+            continue
+        if code == 0xED and payload.startswith(PHOTOSHOP_APP13_HEADER):
+            existing_irb.extend(_parse_irb_resources(payload[len(PHOTOSHOP_APP13_HEADER):]))
+            continue
+        kept.append((code, payload))
+
+    irb = [r for r in existing_irb if r[0] != IPTC_IRB_RESOURCE_ID]
+    irb.append((IPTC_IRB_RESOURCE_ID, b"\x00\x00", iptc_block))
+    new_segments = [
+        (0xE1, XMP_APP1_HEADER + xmp_packet),
+        (0xED, PHOTOSHOP_APP13_HEADER + _build_irb_resources(irb)),
+    ]
+
+    # JFIF/Exif (APP0/APP1) must stay first; insert ours right after them, ahead of ICC
+    # profiles (APP2), MPF previews and the like, which can run to hundreds of KB and would
+    # push the packet past the header probe (METADATA_PROBE_BYTES in fastapi_server.py).
+    insert_at = 0
+    while insert_at < len(kept) and kept[insert_at][0] in (0xE0, 0xE1):
+        insert_at += 1
+    kept[insert_at:insert_at] = new_segments
+
+    dst.write(JPEG_SOI)
+    for code, payload in kept:
+        if 0xD0 <= code <= 0xD7 or code == 0x01:
+            dst.write(bytes((0xFF, code)))
+        else:
+            dst.write(_jpeg_segment(code, payload))
+    shutil.copyfileobj(src, dst)
+
+
+# --- PNG ---
+
+def _iter_png_chunks(stream: BinaryIO, load_payload):
+    """Yields (chunk_type, data_or_None, crc) until IDAT, which is yielded and ends iteration."""
+    if stream.read(8) != PNG_SIGNATURE:
+        raise ValueError("Not a PNG file.")
+    while True:
+        header = stream.read(8)
+        if len(header) != 8:
+            raise ValueError("Unexpected end of PNG before image data.")
+        length, chunk_type = struct.unpack(">I4s", header)
+        if chunk_type == b"IDAT":
+            stream.seek(-8, os.SEEK_CUR)
+            return
+        if load_payload(chunk_type):
+            data = stream.read(length)
+            crc = stream.read(4)
+            yield chunk_type, data, crc
+        else:
+            stream.seek(length + 4, os.SEEK_CUR)
+            yield chunk_type, None, None
+
+
+def _png_chunk(chunk_type: bytes, data: bytes) -> bytes:
+    crc = zlib.crc32(chunk_type + data) & 0xFFFFFFFF
+    return struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", crc)
+
+
+def _png_xmp_from_itxt(data: bytes) -> Optional[bytes]:
+    keyword, _, rest = data.partition(b"\x00")
+    if keyword != PNG_XMP_KEYWORD or len(rest) < 2:
+        return None
+    compressed, rest = rest[0], rest[2:]
+    _, _, rest = rest.partition(b"\x00")  # language tag
+    _, _, text = rest.partition(b"\x00")  # translated keyword
+    return zlib.decompress(text) if compressed else text
+
+
+def _probe_png(stream: BinaryIO) -> Optional[bytes]:
+    for chunk_type, data, _ in _iter_png_chunks(stream, lambda t: t == b"iTXt"):
+        if chunk_type == b"iTXt":
+            packet = _png_xmp_from_itxt(data)
+            if packet is not None:
+                return packet
+    return None
+
+
+def _write_png(src: BinaryIO, dst: BinaryIO, xmp_packet: bytes):
+    dst.write(PNG_SIGNATURE)
+    for chunk_type, data, crc in _iter_png_chunks(src, lambda t: True):
+        if chunk_type == b"iTXt" and _png_xmp_from_itxt(data) is not None:
+            continue
+        dst.write(struct.pack(">I", len(data)) + chunk_type + data + crc)
+        if chunk_type == b"IHDR":
+            # Right after IHDR, ahead of large iCCP/zTXt chunks, so the header probe finds it.
+            dst.write(_png_chunk(b"iTXt", PNG_XMP_KEYWORD + b"\x00\x00\x00\x00\x00" + xmp_packet))
+    shutil.copyfileobj(src, dst)
+
+
+# --- Public API ---
+
+def _sniff_format(stream: BinaryIO) -> Optional[str]:
+    head = stream.read(8)
+    stream.seek(0)
+    if head.startswith(JPEG_SOI):
+        return "jpeg"
+    if head == PNG_SIGNATURE:
+        return "png"
+    return None
+
+
+def read_embedded_tags_from_header(header: bytes) -> Optional[Dict[str, Any]]:
+    """
+    Fast metadata probe over just the first bytes of a file (e.g. a ranged read): parses
+    only the container header (never the pixel data) and returns the embedded
+    {"tagging_version", "keywords", "description"}, or None if there is no XMP packet,
+    the format isn't supported, or the metadata lies beyond the given header.
+    """
+    try:
+        return _read_embedded_tags_from_stream(io.BytesIO(header))
+    except (ValueError, struct.error):
+        return None
+
+
+def _read_embedded_tags_from_stream(stream: BinaryIO) -> Optional[Dict[str, Any]]:
+    image_format = _sniff_format(stream)
+    if image_format == "jpeg":
+        packet = _probe_jpeg(stream)
+    elif image_format == "png":
+        packet = _probe_png(stream)
+    else:
+        return None
+    return parse_xmp_packet(packet) if packet else None
+
+
+def write_embedded_tags(file_path: str, keywords: List[str], description: Optional[str], tagging_version: str) -> Optional[str]:
+    """
+    Writes keywords and description into the file's XMP (JPEG/PNG) and IPTC (JPEG)
+    metadata. Only header segments are rewritten; compressed image data is copied
+    byte-for-byte, so pixels are never re-encoded. Any previous XMP packet is replaced.
+    The file is replaced atomically.
+    Returns None on success or an error message.
+    """
+    xmp_packet = build_xmp_packet(keywords, description, tagging_version)
+    directory = os.path.dirname(os.path.abspath(file_path))
+    tmp_path = None
+    try:
+        with open(file_path, "rb") as src:
+            image_format = _sniff_format(src)
+            if image_format is None:
+                return "Unsupported format for metadata embedding (only JPEG and PNG are supported)."
+            with tempfile.NamedTemporaryFile("wb", dir=directory, delete=False, suffix=".tmp") as dst:
+                tmp_path = dst.name
+                if image_format == "jpeg":
+                    _write_jpeg(src, dst, xmp_packet, build_iptc_block(keywords, description))
+                else:
+                    _write_png(src, dst, xmp_packet)
+        shutil.copymode(file_path, tmp_path)
+        os.replace(tmp_path, file_path)
+        tmp_path = None
+        logger.info(f"Image Metadata: Embedded {len(keywords)} keywords and description into {os.path.basename(file_path)} ({image_format}).")
+        return None
+    except (OSError, ValueError, struct.error) as e:
+        logger.error(f"Image Metadata: Failed to embed metadata into {file_path}: {e}")
+        return str(e)
+    finally:
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
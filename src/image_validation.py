@@ -0,0 +1,221 @@
+# image_validation.py
+import os
+import logging
+from typing import Optional, Dict, Any
+
+logger = logging.getLogger(__name__)
+
+# Formats Gemini on Vertex AI accepts as inline image data.
+VERTEX_SUPPORTED_MIME_TYPES = {"image/png", "image/jpeg", "image/webp", "image/heic", "image/heif"}
+# Formats we can decode but Vertex rejects; converted to PNG (lossless).
+CONVERT_TO_PNG_FORMATS = {"TIFF", "BMP", "GIF", "PPM", "TGA", "ICO", "PCX", "SGI", "DIB", "JPEG2000"}
+
+MAX_IMAGE_PIXELS = int(os.getenv("MAX_IMAGE_PIXELS", str(200_000_000)))
+SNIFF_BYTES = 32
+
+_PIL_FORMAT_TO_MIME = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp", "HEIF": "image/heif"}
+_MIME_TO_EXTENSION = {"image/jpeg": ".jpg", "image/png": ".png", "image/webp": ".webp", "image/heic": ".heic",
+                      "image/heif": ".heif", "image/tiff": ".tif", "image/bmp": ".bmp", "image/gif": ".gif",
+                      "application/pdf": ".pdf", "video/mp4": ".mp4", "video/quicktime": ".mov",
+                      "video/x-msvideo": ".avi", "video/webm": ".webm", "video/x-matroska": ".mkv", "video/mpeg": ".mpg"}
+# Stored as uploaded and expanded into frames/pages at extraction time (see media_expansion.py).
+PASSTHROUGH_MIME_TYPES = {"application/pdf", "video/mp4", "video/quicktime", "video/x-msvideo", "video/webm",
+                          "video/x-matroska", "video/mpeg"}
+_MP4_BRANDS = (b"isom", b"iso2", b"iso4", b"iso5", b"iso6", b"mp41", b"mp42", b"avc1", b"M4V ", b"M4VP", b"3gp4", b"3gp5", b"dash")
+
+
+class ImageValidationError(Exception):
+    """Raised for files that are empty, corrupt or not a supported image, video or document."""
+
+
+def sniff_mime_type(header: bytes) -> Optional[str]:
+    """Detects the real image (or video/PDF) type from its leading bytes, independent of the filename."""
+    if header.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if header.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "image/webp"
+    if header[4:8] == b"ftyp":
+        brand = header[8:12]
+        if brand in (b"heic", b"heix", b"heim", b"heis", b"hevc", b"hevx"):
+            return "image/heic"
+        if brand in (b"mif1", b"msf1", b"heif"):
+            return "image/heif"
+        if brand in (b"avif", b"avis"):
+            return "image/avif"
+        if brand == b"qt  ":
+            return "video/quicktime"
+        if brand in _MP4_BRANDS:
+            return "video/mp4"
+    if header[:4] in (b"II*\x00", b"MM\x00*"):
+        return "image/tiff"
+    if header.startswith(b"BM"):
+        return "image/bmp"
+    if header[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    if header.startswith(b"%PDF"):
+        return "application/pdf"
+    if header[:4] == b"RIFF" and header[8:12] == b"AVI ":
+        return "video/x-msvideo"
+    if header.startswith(b"\x1a\x45\xdf\xa3"):
+        return "video/webm" if b"webm" in header else "video/x-matroska"
+    if header[:4] in (b"\x00\x00\x01\xba", b"\x00\x00\x01\xb3"):
+        return "video/mpeg"
+    return None
+
+
+def sniff_file_mime_type(file_path: str) -> Optional[str]:
+    with open(file_path, "rb") as f:
+        return sniff_mime_type(f.read(SNIFF_BYTES))
+
+
+def quick_check(file_path: str) -> str:
+    """
+    In-process checks that need no decoding: rejects empty files and unknown signatures
+    in well under a millisecond. Returns the sniffed MIME type.
+    """
+    if os.path.getsize(file_path) == 0:
+        raise ImageValidationError("File is empty (0 bytes).")
+    mime_type = sniff_file_mime_type(file_path)
+    if mime_type is None:
+        raise ImageValidationError("File is not a recognized image, video or PDF format.")
+    return mime_type
+
+
+def estimate_decoded_bytes(file_path: str) -> int:
+    """
+    Memory validate_and_normalize needs for a still image, from its header alone: the decoded
+    pixels plus one rotated/converted copy. 0 for videos, PDFs and files PIL can't identify
+    (media frames are reserved at extraction time; undecodable files are rejected by validation).
+    """
+    from PIL import Image
+
+    if sniff_file_mime_type(file_path) in PASSTHROUGH_MIME_TYPES:
+        return 0
+    try:
+        with Image.open(file_path) as img:  # lazy: reads the header, not the pixels
+            width, height = img.size
+            bands = len(img.getbands())
+    except Exception:
+        return 0
+    return 2 * width * height * bands
+
+
+def _replace_extension(file_path: str, mime_type: str) -> str:
+    base, ext = os.path.splitext(file_path)
+    wanted = _MIME_TO_EXTENSION.get(mime_type)
+    if not wanted or ext.lower() == wanted or (wanted == ".jpg" and ext.lower() == ".jpeg") or (wanted == ".tif" and ext.lower() == ".tiff"):
+        return file_path
+    candidate = f"{base}{wanted}"
+    counter = 0
+    while os.path.exists(candidate):
+        counter += 1
+        candidate = f"{base}_{counter}{wanted}"
+    return candidate
+
+
+def validate_and_normalize(file_path: str) -> Dict[str, Any]:
+    """
+    Fully decodes the image (run this in a process pool; it is CPU-bound), then:
+      - verifies the data isn't truncated/corrupt,
+      - detects the real format and fixes a mislabeled extension,
+      - applies EXIF orientation so pixels are stored upright,
+      - converts formats Vertex rejects (TIFF, BMP, GIF, ...) to PNG.
+    Videos, PDFs and multi-page TIFF/GIF files are kept as uploaded (only the extension is
+    fixed); their frames/pages are extracted at extraction time.
+    Returns a dict with the (possibly renamed) path and details; raises ImageValidationError.
+    """
+    from PIL import Image, ImageOps, UnidentifiedImageError
+
+    Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+    sniffed = quick_check(file_path)
+    result = {"path": file_path, "mime_type": sniffed, "converted_from": None, "orientation_applied": False,
+              "renamed": False, "width": None, "height": None}
+
+    if sniffed in PASSTHROUGH_MIME_TYPES:
+        new_path = _replace_extension(file_path, sniffed)
+        if new_path != file_path:
+            os.replace(file_path, new_path)
+            result.update(path=new_path, renamed=True)
+        return result
+
+    if sniffed in ("image/heic", "image/heif", "image/avif"):
+        try:
+            import pillow_heif  # optional plugin
+            pillow_heif.register_heif_opener()
+        except ImportError:
+            if sniffed == "image/avif":
+                raise ImageValidationError("AVIF images are not supported.")
+            # Vertex accepts HEIC/HEIF as-is; without the plugin we can only trust the signature.
+            new_path = _replace_extension(file_path, sniffed)
+            if new_path != file_path:
+                os.replace(file_path, new_path)
+                result.update(path=new_path, renamed=True)
+            return result
+
+    try:
+        with Image.open(file_path) as img:
+            img.verify()
+        with Image.open(file_path) as img:
+            img.load()
+            pil_format = img.format
+            result["width"], result["height"] = img.size
+            orientation = img.getexif().get(0x0112, 1)
+
+            target_mime = _PIL_FORMAT_TO_MIME.get(pil_format)
+            result["pages"] = getattr(img, "n_frames", 1)
+            if result["pages"] > 1 and sniffed in ("image/tiff", "image/gif"):
+                # Converting would keep only the first page; extraction samples all of them.
+                target_mime = sniffed
+                result["mime_type"] = sniffed
+            needs_conversion = target_mime not in VERTEX_SUPPORTED_MIME_TYPES and result["pages"] <= 1
+            if needs_conversion and pil_format not in CONVERT_TO_PNG_FORMATS:
+                raise ImageValidationError(f"Unsupported image format: {pil_format}.")
+            needs_rotation = orientation not in (None, 1) and result["pages"] <= 1
+
+            if needs_conversion or needs_rotation:
+                frame = ImageOps.exif_transpose(img) if needs_rotation else img
+                save_format = "PNG" if needs_conversion else pil_format
+                out_mime = "image/png" if needs_conversion else target_mime
+                out_path = _replace_extension(file_path, out_mime) if needs_conversion else file_path
+                tmp_path = f"{out_path}.normalizing"
+                save_kwargs = {}
+                if img.info.get("icc_profile"):
+                    save_kwargs["icc_profile"] = img.info["icc_profile"]
+                if save_format == "JPEG":
+                    frame = frame.convert("RGB") if frame.mode not in ("RGB", "L", "CMYK") else frame
+                    save_kwargs["quality"] = 95
+                    exif = img.getexif()
+                    exif[0x0112] = 1
+                    save_kwargs["exif"] = exif.tobytes()
+                elif frame.mode not in ("1", "L", "LA", "P", "RGB", "RGBA", "I", "I;16"):
+                    frame = frame.convert("RGBA" if "A" in frame.getbands() else "RGB")
+                try:
+                    frame.save(tmp_path, format=save_format, **save_kwargs)
+                    os.replace(tmp_path, out_path)
+                finally:
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+                if out_path != file_path:
+                    os.remove(file_path)
+                    result["renamed"] = True
+                result.update(path=out_path, mime_type=out_mime, orientation_applied=needs_rotation,
+                              converted_from=pil_format if needs_conversion else None)
+                result["width"], result["height"] = frame.size
+            else:
+                result["mime_type"] = target_mime
+        if result["path"] == file_path:
+            new_path = _replace_extension(file_path, result["mime_type"])
+            if new_path != file_path:
+                os.replace(file_path, new_path)
+                result.update(path=new_path, renamed=True)
+    except ImageValidationError:
+        raise
+    except Image.DecompressionBombError as e:
+        raise ImageValidationError(f"Image is too large to process safely: {e}")
+    except UnidentifiedImageError:
+        raise ImageValidationError("File could not be decoded as an image.")
+    except (OSError, SyntaxError, ValueError) as e:
+        raise ImageValidationError(f"Image data is corrupt or truncated: {e}")
+    return result
@@ -0,0 +1,92 @@
+# inflight_budget.py
+import time
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class BudgetExhaustedError(Exception):
+    """Raised when bytes can't be reserved within the wait timeout."""
+
+    def __init__(self, requested: int, retry_after_seconds: int):
+        self.requested = requested
+        self.retry_after_seconds = retry_after_seconds
+        super().__init__(f"In-flight memory budget exhausted (requested {requested} bytes).")
+
+
+class InflightBytesBudget:
+    """
+    Global cap on bytes held in memory by concurrent uploads and extractions.
+    Requests wait (FIFO-ish, via an asyncio.Condition) until their reservation fits,
+    or fail with BudgetExhaustedError after `wait_timeout_seconds`. A single request
+    larger than the whole budget is admitted only when nothing else is in flight.
+    """
+
+    def __init__(self, limit_bytes: int, wait_timeout_seconds: float = 10.0, retry_after_seconds: int = 5):
+        self.limit_bytes = limit_bytes
+        self.wait_timeout_seconds = wait_timeout_seconds
+        self.retry_after_seconds = retry_after_seconds
+        self._condition = None
+        self.current_bytes = 0
+        self.peak_bytes = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.total_wait_seconds = 0.0
+
+    def _get_condition(self) -> asyncio.Condition:
+        # Created lazily so it binds to the running event loop.
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        return self._condition
+
+    def _fits(self, nbytes: int) -> bool:
+        return self.current_bytes + nbytes <= self.limit_bytes or self.current_bytes == 0
+
+    async def acquire(self, nbytes: int):
+        condition = self._get_condition()
+        start = time.monotonic()
+        async with condition:
+            if not self._fits(nbytes):
+                self.waiting += 1
+                try:
+                    await asyncio.wait_for(condition.wait_for(lambda: self._fits(nbytes)), self.wait_timeout_seconds)
+                except asyncio.TimeoutError:
+                    self.rejected += 1
+                    logger.warning(f"In-flight Budget: Rejected reservation of {nbytes} bytes after {self.wait_timeout_seconds}s "
+                                   f"({self.current_bytes}/{self.limit_bytes} in flight).")
+                    raise BudgetExhaustedError(nbytes, self.retry_after_seconds)
+                finally:
+                    self.waiting -= 1
+            self.current_bytes += nbytes
+            self.peak_bytes = max(self.peak_bytes, self.current_bytes)
+            self.admitted += 1
+            self.total_wait_seconds += time.monotonic() - start
+
+    async def release(self, nbytes: int):
+        # Give the bytes back before awaiting the lock, so a release that is itself cancelled can't leak them.
+        self.current_bytes = max(0, self.current_bytes - nbytes)
+        condition = self._get_condition()
+        async with condition:
+            condition.notify_all()
+
+    @asynccontextmanager
+    async def reserve(self, nbytes: int):
+        await self.acquire(nbytes)
+        try:
+            yield
+        finally:
+            await self.release(nbytes)
+
+    def snapshot(self) -> dict:
+        return {
+            "limit_bytes": self.limit_bytes,
+            "current_bytes": self.current_bytes,
+            "peak_bytes": self.peak_bytes,
+            "waiting_requests": self.waiting,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "avg_wait_seconds": round(self.total_wait_seconds / self.admitted, 4) if self.admitted else 0.0,
+        }
@@ -0,0 +1,222 @@
+# keyword_normalizer.py
+import os
+import re
+import json
+import logging
+import threading
+import unicodedata
+from collections import deque
+from typing import Optional, List, Dict, Tuple, Iterable
+
+logger = logging.getLogger(__name__)
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+KEYWORD_VOCABULARY_PATH = os.getenv("KEYWORD_VOCABULARY_PATH", os.path.join(SCRIPT_DIR, "keyword_vocabulary.json"))
+NORMALIZER_CACHE_SIZE = int(os.getenv("KEYWORD_NORMALIZER_CACHE_SIZE", "1000000"))
+
+# A hashtag runs until whitespace, another '#', or list/sentence punctuation, so inner
+# punctuation survives (#shuri-jo, #ryūkyū・kingdom, #b&w). Trailing sentence punctuation is
+# stripped afterwards. CJK and accented letters stay in one keyword.
+HASHTAG_PATTERN = re.compile(r"#[^\s#,;:!?()\[\]{}<>\"“”「」、。，；：！？]+")
+_HASHTAG_TRAILING = ".-'’・·…"
+_TOKEN_SPLIT_PATTERN = re.compile(r"[\s_\-'’・·]+")
+_CAMEL_BOUNDARY_PATTERN = re.compile(r"(?<=[a-z0-9])(?=[A-Z])|(?<=[A-Z])(?=[A-Z][a-z])")
+
+
+def _fold(text: str) -> str:
+    return unicodedata.normalize("NFKC", text).casefold()
+
+
+def tokenize(text: str) -> Tuple[str, ...]:
+    """Splits a keyword or phrase into case-folded tokens on separators and camelCase boundaries."""
+    text = unicodedata.normalize("NFKC", text.lstrip("#"))
+    text = _CAMEL_BOUNDARY_PATTERN.sub(" ", text)
+    return tuple(t for t in _TOKEN_SPLIT_PATTERN.split(text.casefold()) if t)
+
+
+class PhraseAutomaton:
+    """
+    Aho-Corasick automaton over token sequences. Built once per vocabulary; matching
+    is a single left-to-right pass regardless of how many phrases are loaded.
+    """
+
+    def __init__(self, phrases: Dict[Tuple[str, ...], str]):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._output: List[List[Tuple[int, str]]] = [[]]  # (phrase_length, canonical)
+        for tokens, canonical in phrases.items():
+            state = 0
+            for token in tokens:
+                nxt = self._goto[state].get(token)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[state][token] = nxt
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append([])
+                state = nxt
+            self._output[state].append((len(tokens), canonical))
+
+        # Breadth-first failure links; depth-1 states fall back to the root.
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for token, nxt in self._goto[state].items():
+                queue.append(nxt)
+                fallback = self._fail[state]
+                while fallback and token not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                target = self._goto[fallback].get(token, 0)
+                self._fail[nxt] = target if target != nxt else 0
+                self._output[nxt] = self._output[nxt] + self._output[self._fail[nxt]]
+
+    def find(self, tokens: Tuple[str, ...]) -> List[Tuple[int, int, str]]:
+        """Returns leftmost-longest, non-overlapping (start, end, canonical) matches."""
+        matches = []
+        state = 0
+        for i, token in enumerate(tokens):
+            while state and token not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(token, 0)
+            for length, canonical in self._output[state]:
+                matches.append((i + 1 - length, i + 1, canonical))
+        matches.sort(key=lambda m: (m[0], -(m[1] - m[0])))
+        selected = []
+        last_end = 0
+        for start, end, canonical in matches:
+            if start >= last_end:
+                selected.append((start, end, canonical))
+                last_end = end
+        return selected
+
+
+class KeywordNormalizer:
+    """
+    Normalizes hashtags: Unicode NFKC + case folding, then alias/synonym mapping against
+    a curated vocabulary ({"#canonical": ["alias", "multi word alias", ...]}). Keywords
+    that are not an alias themselves are scanned with the phrase automaton, so a compound
+    tag such as #ShuriCastleAtNight also yields the vocabulary term #shuri_castle (callers
+    that must respect a keyword count pass `limit`, see normalize_keywords).
+    Results are memoized, so bulk re-normalization of repetitive historical data is
+    mostly dictionary lookups. Without an explicit vocabulary, the vocabulary file is
+    loaded on first use.
+    """
+
+    def __init__(self, vocabulary: Optional[Dict[str, List[str]]] = None, path: str = KEYWORD_VOCABULARY_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._phrases: Optional[Dict[Tuple[str, ...], str]] = None
+        self._automaton: Optional[PhraseAutomaton] = None
+        self._cache: Dict[str, Tuple[str, ...]] = {}
+        self.vocabulary_size = 0
+        if vocabulary is not None:
+            self.load_vocabulary(vocabulary)
+
+    def _ensure_loaded(self):
+        if self._phrases is None:
+            with self._load_lock:
+                if self._phrases is None:
+                    self.load_vocabulary_file(self.path)
+
+    def load_vocabulary(self, vocabulary: Dict[str, List[str]]):
+        phrases: Dict[Tuple[str, ...], str] = {}
+        for canonical, aliases in vocabulary.items():
+            canonical_tag = "#" + _fold(canonical.lstrip("#"))
+            for alias in [canonical, *aliases]:
+                tokens = tokenize(alias)
+                if tokens:
+                    phrases[tokens] = canonical_tag
+        automaton = PhraseAutomaton(phrases)
+        with self._lock:
+            self._phrases = phrases
+            self._automaton = automaton
+            self._cache = {}
+            self.vocabulary_size = len(vocabulary)
+        logger.info(f"Keyword Normalizer: Loaded vocabulary with {len(vocabulary)} terms and {len(phrases)} aliases.")
+
+    def load_vocabulary_file(self, path: str = KEYWORD_VOCABULARY_PATH) -> bool:
+        if not os.path.exists(path):
+            logger.warning(f"Keyword Normalizer: Vocabulary file not found at {path}. Only case/Unicode folding will be applied.")
+            self.load_vocabulary({})
+            return False
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                self.load_vocabulary(json.load(f))
+            return True
+        except (OSError, ValueError) as e:
+            logger.error(f"Keyword Normalizer: Could not load vocabulary from {path}: {e}")
+            if self._phrases is None:
+                self.load_vocabulary({})
+            return False
+
+    def _normalize_uncached(self, keyword: str) -> Tuple[str, ...]:
+        """The keyword's normalized form, followed by any vocabulary terms found inside it."""
+        self._ensure_loaded()
+        tokens = tokenize(keyword)
+        if not tokens:
+            return ("",)
+        canonical = self._phrases.get(tokens)
+        if canonical:
+            return (canonical,)
+        folded = "#" + _fold(keyword.lstrip("#"))
+        return (folded, *(term for term in self.find_terms(tokens) if term != folded))
+
+    def _lookup(self, keyword: str) -> Tuple[str, ...]:
+        cache = self._cache
+        normalized = cache.get(keyword)
+        if normalized is None:
+            normalized = self._normalize_uncached(keyword)
+            if len(cache) >= NORMALIZER_CACHE_SIZE:
+                cache.clear()
+            cache[keyword] = normalized
+        return normalized
+
+    def normalize_keyword(self, keyword: str) -> str:
+        return self._lookup(keyword)[0]
+
+    def normalize_keywords(self, keywords: Iterable[str], expand: bool = True, limit: Optional[int] = None) -> List[str]:
+        """
+        Normalizes and de-duplicates keywords, preserving first-seen order. With `expand`, the
+        vocabulary terms found inside compound tags follow the tag; with `limit`, those terms are
+        the first to go, so expansion never crowds out a keyword that was given.
+        """
+        found = [self._lookup(keyword) for keyword in keywords]
+        given = {normalized[0] for normalized in found}
+        seen = set()
+        result = []
+        for normalized_forms in found:
+            for normalized in (normalized_forms if expand else normalized_forms[:1]):
+                if normalized and normalized not in seen:
+                    seen.add(normalized)
+                    result.append(normalized)
+        if limit is not None and len(result) > limit:
+            room_for_terms = max(0, limit - sum(1 for n in result if n in given))
+            terms = [n for n in result if n not in given][:room_for_terms]
+            kept = given.union(terms)
+            result = [n for n in result if n in kept][:limit]
+        return result
+
+    def find_hashtags(self, text: str) -> List[str]:
+        """The hashtags in model output as written, without trailing sentence punctuation."""
+        return [tag.rstrip(_HASHTAG_TRAILING) for tag in HASHTAG_PATTERN.findall(text)]
+
+    def extract_keywords(self, text: str, expand: bool = True, limit: Optional[int] = None) -> List[str]:
+        """Finds hashtags in model output and returns them normalized and de-duplicated."""
+        return self.normalize_keywords(self.find_hashtags(text), expand, limit)
+
+    def find_terms(self, text) -> List[str]:
+        """
+        Returns the canonical vocabulary tags mentioned anywhere in free text or a token
+        tuple (multi-word aware), in order of appearance.
+        """
+        self._ensure_loaded()
+        tokens = text if isinstance(text, tuple) else tokenize(text)
+        return list(dict.fromkeys(canonical for _, _, canonical in self._automaton.find(tokens)))
+
+    def normalize_keyword_string(self, keywords_str: str, separator: str = ", ", limit: Optional[int] = None) -> str:
+        """Re-normalizes a stored 'Keywords' cell such as '#Okinawa, #okinawan'."""
+        return separator.join(self.normalize_keywords((k.strip() for k in keywords_str.split(",") if k.strip()), limit=limit))
+
+
+normalizer = KeywordNormalizer()
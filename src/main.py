@@ -4,6 +4,7 @@ import requests
 import urllib.parse
 import json
 import os # For os.path.splitext
+import uuid
 
 # Configuration for FastAPI backend
 FASTAPI_BASE_URL = "http://127.0.0.1:8000" # Ensure this matches your FastAPI host and port
@@ -117,8 +118,13 @@ if uploaded_files:
                                     encoded_filename_for_analysis = urllib.parse.quote(filename_for_analysis)
                                     analysis_url = f"{EXTRACT_KEYWORDS_ENDPOINT_BASE}{encoded_filename_for_analysis}"
                                     
+                                    # One Idempotency-Key per session and file: reruns, double-clicks and retries
+                                    # get the server's stored result instead of a second Gemini call and sheet row.
+                                    idempotency_keys = st.session_state.setdefault('idempotency_keys', {})
+                                    idempotency_key = idempotency_keys.setdefault(filename_for_analysis, uuid.uuid4().hex)
+
                                     # The FastAPI endpoint now uses its internal prompt
-                                    analysis_response = requests.post(analysis_url, timeout=180) # Increased timeout
+                                    analysis_response = requests.post(analysis_url, headers={"Idempotency-Key": idempotency_key}, timeout=180) # Increased timeout
 
                                     if analysis_response.status_code == 200:
                                         analysis_data = analysis_response.json()
@@ -0,0 +1,270 @@
+# media_expansion.py
+import io
+import os
+import logging
+import contextvars
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Callable, Dict, Iterator, List, Optional, Tuple
+
+if TYPE_CHECKING:  # Pillow and NumPy are imported where they are used
+    import numpy as np
+    from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# Videos and multi-page scans are expanded into frames/pages before extraction. Candidates are
+# sampled evenly (so decoding is bounded however long the asset is), blank and near-duplicate
+# frames are dropped, and at most MEDIA_MAX_FRAMES representative frames are sent to Gemini.
+MEDIA_EXPANSION_ENABLED = os.getenv("MEDIA_EXPANSION_ENABLED", "true").lower() in ("1", "true", "yes")
+MEDIA_MAX_FRAMES = int(os.getenv("MEDIA_MAX_FRAMES", "8"))
+MEDIA_MAX_CANDIDATES = int(os.getenv("MEDIA_MAX_CANDIDATES", "48"))
+# Mean absolute difference of 32x32 grayscale thumbnails (0..1) under which two frames are duplicates.
+MEDIA_DEDUP_THRESHOLD = float(os.getenv("MEDIA_DEDUP_THRESHOLD", "0.06"))
+# Frames whose thumbnail has less contrast than this (black leader, blank pages) are dropped.
+MEDIA_BLANK_STDDEV = float(os.getenv("MEDIA_BLANK_STDDEV", "0.02"))
+MEDIA_FRAME_MAX_SIDE = int(os.getenv("MEDIA_FRAME_MAX_SIDE", "1024"))
+MEDIA_FRAME_JPEG_QUALITY = int(os.getenv("MEDIA_FRAME_JPEG_QUALITY", "85"))
+MEDIA_PDF_RENDER_DPI = int(os.getenv("MEDIA_PDF_RENDER_DPI", "110"))
+MEDIA_PARALLEL_CALLS = int(os.getenv("MEDIA_PARALLEL_CALLS", "4"))
+MEDIA_MAX_MERGED_KEYWORDS = int(os.getenv("MEDIA_MAX_MERGED_KEYWORDS", "25"))
+MEDIA_MAX_DESCRIPTION_CHARS = int(os.getenv("MEDIA_MAX_DESCRIPTION_CHARS", "1200"))
+
+VIDEO_MIME_TYPES = {"video/mp4", "video/quicktime", "video/x-msvideo", "video/webm", "video/x-matroska", "video/mpeg"}
+PAGED_MIME_TYPES = {"application/pdf", "image/tiff", "image/gif"}
+
+_THUMB_SIZE = 32
+
+
+class MediaExpansionError(Exception):
+    """Raised when a video or document can't be decoded into frames."""
+
+
+def needs_expansion(file_path: str, mime_type: Optional[str]) -> bool:
+    """Videos and PDFs always; TIFF/GIF only when they hold more than one page/frame."""
+    if not MEDIA_EXPANSION_ENABLED or not mime_type:
+        return False
+    if mime_type in VIDEO_MIME_TYPES or mime_type == "application/pdf":
+        return True
+    if mime_type in PAGED_MIME_TYPES:
+        return page_count(file_path) > 1
+    return False
+
+
+def decodes_by_seeking(mime_type: Optional[str]) -> bool:
+    """
+    True for the types that are always expanded (videos and PDFs): frames are decoded by seeking,
+    never loaded whole, so the memory they need doesn't depend on the file size.
+    """
+    return MEDIA_EXPANSION_ENABLED and (mime_type in VIDEO_MIME_TYPES or mime_type == "application/pdf")
+
+
+def reservation_bytes() -> int:
+    """In-flight memory to reserve while expanding one asset: about MEDIA_MAX_FRAMES decoded RGB frames."""
+    return MEDIA_MAX_FRAMES * MEDIA_FRAME_MAX_SIDE * MEDIA_FRAME_MAX_SIDE * 3
+
+
+def page_count(file_path: str) -> int:
+    from PIL import Image
+    try:
+        with Image.open(file_path) as img:
+            return getattr(img, "n_frames", 1)
+    except Exception:
+        return 1
+
+
+def _evenly_spaced(total: int, limit: int) -> List[int]:
+    if total <= limit:
+        return list(range(total))
+    return sorted({int((i + 0.5) * total / limit) for i in range(limit)})
+
+
+# --- Decoders: each yields (label, PIL image) for at most MEDIA_MAX_CANDIDATES positions ---
+
+def _iter_image_pages(file_path: str) -> Iterator[Tuple[str, "Image.Image"]]:
+    from PIL import Image
+    with Image.open(file_path) as img:
+        for index in _evenly_spaced(getattr(img, "n_frames", 1), MEDIA_MAX_CANDIDATES):
+            img.seek(index)
+            yield f"page {index + 1}", img.convert("RGB")
+
+
+def _iter_pdf_pages(file_path: str) -> Iterator[Tuple[str, "Image.Image"]]:
+    try:
+        import pypdfium2  # optional dependency
+    except ImportError:
+        raise MediaExpansionError("PDF support requires the optional 'pypdfium2' package.")
+    document = pypdfium2.PdfDocument(file_path)
+    try:
+        for index in _evenly_spaced(len(document), MEDIA_MAX_CANDIDATES):
+            page = document[index]
+            try:
+                yield f"page {index + 1}", page.render(scale=MEDIA_PDF_RENDER_DPI / 72).to_pil().convert("RGB")
+            finally:
+                page.close()
+    finally:
+        document.close()
+
+
+def _format_timestamp(seconds: float) -> str:
+    seconds = int(seconds)
+    return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+def _iter_video_frames(file_path: str) -> Iterator[Tuple[str, "Image.Image"]]:
+    """Seeks to evenly spaced timestamps and decodes one frame at each, so cost doesn't grow with length."""
+    try:
+        import av  # optional dependency (PyAV)
+    except ImportError:
+        raise MediaExpansionError("Video support requires the optional 'av' (PyAV) package.")
+    with av.open(file_path) as container:
+        if not container.streams.video:
+            raise MediaExpansionError("File has no video stream.")
+        stream = container.streams.video[0]
+        duration = float(stream.duration * stream.time_base) if stream.duration else (container.duration or 0) / 1_000_000
+        if duration <= 0:
+            # Unknown length: keyframes from the start, still capped.
+            stream.codec_context.skip_frame = "NONKEY"
+            for count, frame in enumerate(container.decode(stream)):
+                if count >= MEDIA_MAX_CANDIDATES:
+                    break
+                yield _format_timestamp(frame.time or 0), frame.to_image()
+            return
+        for step in range(MEDIA_MAX_CANDIDATES):
+            target = (step + 0.5) * duration / MEDIA_MAX_CANDIDATES
+            # Seeking lands on the preceding keyframe; decode forward to the first frame at/after it.
+            container.seek(int(target / stream.time_base), stream=stream, backward=True)
+            for frame in container.decode(stream):
+                if frame.time is None or frame.time >= target - 0.5:
+                    yield _format_timestamp(frame.time if frame.time is not None else target), frame.to_image()
+                    break
+
+
+def _decode_candidates(file_path: str, mime_type: str) -> Iterator[Tuple[str, "Image.Image"]]:
+    if mime_type in VIDEO_MIME_TYPES:
+        return _iter_video_frames(file_path)
+    if mime_type == "application/pdf":
+        return _iter_pdf_pages(file_path)
+    return _iter_image_pages(file_path)
+
+
+# --- Selection ---
+
+def _thumbnail(image: "Image.Image") -> "np.ndarray":
+    import numpy as np
+    from PIL import Image
+    return np.asarray(image.convert("L").resize((_THUMB_SIZE, _THUMB_SIZE), Image.BILINEAR), dtype=np.float32) / 255.0
+
+
+def _difference(a, b) -> float:
+    import numpy as np
+    return float(np.abs(a - b).mean())
+
+
+def select_representative(thumbs: List["np.ndarray"], max_frames: int = MEDIA_MAX_FRAMES,
+                          dedup_threshold: float = MEDIA_DEDUP_THRESHOLD, blank_stddev: float = MEDIA_BLANK_STDDEV) -> Dict:
+    """
+    Picks candidate indices to keep: drops blank frames, then any frame within
+    `dedup_threshold` of one already kept, then (if still over `max_frames`) keeps the most
+    mutually distinct frames, farthest-point first. Returns the kept indices in order and counts.
+    """
+    non_blank = [i for i, t in enumerate(thumbs) if float(t.std()) >= blank_stddev]
+    if not non_blank and thumbs:
+        non_blank = [0]  # an all-blank asset still gets one frame
+    kept: List[int] = []
+    for i in non_blank:
+        if all(_difference(thumbs[i], thumbs[k]) >= dedup_threshold for k in kept):
+            kept.append(i)
+    distinct = len(kept)
+    if len(kept) > max_frames:
+        selected = [kept[0]]
+        distance = {i: _difference(thumbs[i], thumbs[kept[0]]) for i in kept[1:]}
+        while len(selected) < max_frames and distance:
+            farthest = max(distance, key=distance.get)
+            selected.append(farthest)
+            del distance[farthest]
+            for i in distance:
+                distance[i] = min(distance[i], _difference(thumbs[i], thumbs[farthest]))
+        kept = sorted(selected)
+    return {
+        "indices": kept,
+        "dropped_blank": len(thumbs) - len(non_blank),
+        "dropped_duplicate": len(non_blank) - distinct,
+        "dropped_over_limit": distinct - len(kept),
+    }
+
+
+def _downscaled(image: "Image.Image") -> "Image.Image":
+    """A copy no larger than MEDIA_FRAME_MAX_SIDE, so held candidates don't keep full-size frames alive."""
+    image = image.copy()
+    image.thumbnail((MEDIA_FRAME_MAX_SIDE, MEDIA_FRAME_MAX_SIDE))
+    return image
+
+
+def _to_jpeg(image: "Image.Image") -> bytes:
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=MEDIA_FRAME_JPEG_QUALITY)
+    return buffer.getvalue()
+
+
+def expand(file_path: str, mime_type: str) -> Dict:
+    """
+    Decodes the asset's candidate frames/pages and returns the representative subset as JPEGs:
+    {"kind", "candidates", "frames": [{"index", "label", "jpeg"}], "dropped_blank",
+    "dropped_duplicate", "dropped_over_limit"}. Raises MediaExpansionError.
+    Only a thumbnail and a downscaled copy of each candidate are kept while decoding, and only
+    the selected frames are JPEG-encoded.
+    """
+    labels, images, thumbs = [], [], []
+    try:
+        for label, image in _decode_candidates(file_path, mime_type):
+            labels.append(label)
+            thumbs.append(_thumbnail(image))
+            images.append(_downscaled(image))
+    except MediaExpansionError:
+        raise
+    except Exception as e:
+        raise MediaExpansionError(f"Could not decode {mime_type} into frames: {e}")
+    if not thumbs:
+        raise MediaExpansionError(f"No frames could be decoded from the {mime_type} file.")
+    selection = select_representative(thumbs)
+    return {
+        "kind": "video" if mime_type in VIDEO_MIME_TYPES else "pages",
+        "candidates": len(thumbs),
+        "frames": [{"index": i, "label": labels[i], "jpeg": _to_jpeg(images[i])} for i in selection["indices"]],
+        "dropped_blank": selection["dropped_blank"],
+        "dropped_duplicate": selection["dropped_duplicate"],
+        "dropped_over_limit": selection["dropped_over_limit"],
+    }
+
+
+# --- Parallel per-frame calls and merging ---
+
+_frame_pool: Optional[ThreadPoolExecutor] = None
+
+
+def map_frames(func: Callable, frames: List[Dict]) -> List:
+    """Runs func(frame) for every frame on a shared, bounded pool, keeping the caller's context (request ID, trace)."""
+    global _frame_pool
+    if _frame_pool is None:
+        _frame_pool = ThreadPoolExecutor(max_workers=MEDIA_PARALLEL_CALLS, thread_name_prefix="media-frame")
+    futures = [_frame_pool.submit(contextvars.copy_context().run, func, frame) for frame in frames]
+    return [future.result() for future in futures]
+
+
+def merge_keywords(per_frame: List[List[str]], limit: int = MEDIA_MAX_MERGED_KEYWORDS) -> List[str]:
+    """Keywords ranked by how many frames they appear in; ties keep first-seen order."""
+    counts = Counter(k for keywords in per_frame for k in dict.fromkeys(keywords))
+    first_seen = {k: i for i, k in enumerate(dict.fromkeys(k for keywords in per_frame for k in keywords))}
+    return sorted(counts, key=lambda k: (-counts[k], first_seen[k]))[:limit]
+
+
+def merge_descriptions(labelled: List[Tuple[str, str]], limit: int = MEDIA_MAX_DESCRIPTION_CHARS) -> str:
+    """One description per distinct frame description, labelled with its page or timestamp."""
+    seen, parts = set(), []
+    for label, description in labelled:
+        if description and description not in seen:
+            seen.add(description)
+            parts.append(f"[{label}] {description}")
+    merged = " ".join(parts)
+    return merged if len(merged) <= limit else merged[:limit - 3].rstrip() + "..."
@@ -0,0 +1,86 @@
+# request_coalescing.py
+import time
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key: the first caller (the leader) runs the work,
+    later callers await the leader's result or exception instead of repeating it. The key is
+    forgotten as soon as the work finishes, so this only deduplicates in-flight work.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._inflight: dict = {}
+        self.leaders = 0
+        self.followers = 0
+
+    async def do(self, key: str, work: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """Returns (result, shared); shared is True when the result came from another caller's run."""
+        task = self._inflight.get(key)
+        if task is not None:
+            self.followers += 1
+            logger.info("Single-flight (%s): Joining in-flight call for %s.", self.name, key)
+            return await asyncio.shield(task), True
+
+        # The work runs as its own task, so no single caller disconnecting can cancel it for the others.
+        task = asyncio.ensure_future(work())
+        self._inflight[key] = task
+        self.leaders += 1
+        task.add_done_callback(lambda finished: self._forget(key, finished))
+        return await asyncio.shield(task), False
+
+    def _forget(self, key: str, task: asyncio.Future):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            task.exception()  # mark retrieved even if every caller went away
+
+    def snapshot(self) -> dict:
+        return {"in_flight": len(self._inflight), "leaders": self.leaders, "coalesced_followers": self.followers}
+
+
+class IdempotencyCache:
+    """
+    Remembers responses by client-supplied Idempotency-Key for `ttl_seconds`, so a retried
+    request gets the stored response instead of re-running. Bounded LRU, in process memory.
+    """
+
+    def __init__(self, ttl_seconds: float = 3600, max_entries: int = 10_000):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Tuple[float, dict]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.stores = 0
+
+    def get(self, key: str) -> Optional[dict]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if time.monotonic() >= expires_at:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: str, value: dict):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+            self._entries.move_to_end(key)
+            self.stores += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def snapshot(self) -> dict:
+        return {"entries": len(self._entries), "hits": self.hits, "stores": self.stores, "ttl_seconds": self.ttl_seconds}
@@ -0,0 +1,342 @@
+# results_store.py
+import io
+import csv
+import json
+import sqlite3
+import logging
+import threading
+from datetime import date, datetime, timedelta, timezone
+from typing import Callable, Optional, List, Iterator
+
+logger = logging.getLogger(__name__)
+
+EXPORT_COLUMNS = ["filename", "keywords", "description", "model_id", "model_version", "prompt_version", "tagging_version",
+                  "batch_id", "created_at", "updated_at", "cursor"]
+# Columns added after the first release; created on open for existing databases.
+_ADDED_COLUMNS = {"model_version": "TEXT", "prompt_version": "TEXT"}
+_SELECT_COLUMNS = ("r.filename, r.keywords, r.description, r.model_id, r.model_version, r.prompt_version, "
+                   "r.tagging_version, r.batch_id, r.created_at, r.updated_at, r.change_seq")
+
+
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).strftime(TIMESTAMP_FORMAT)
+
+
+def normalize_date_bound(value: str, upper: bool = False) -> str:
+    """
+    Parses an ISO 8601 date or datetime into the stored UTC timestamp format, so bounds compare
+    correctly as strings. Naive datetimes are taken as UTC. A bare date as the upper bound means
+    the end of that day (the result is exclusive). Raises ValueError for anything else.
+    """
+    try:
+        day = date.fromisoformat(value)
+    except ValueError:
+        parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        parsed = parsed.replace(tzinfo=timezone.utc) if parsed.tzinfo is None else parsed.astimezone(timezone.utc)
+    else:
+        parsed = datetime(day.year, day.month, day.day, tzinfo=timezone.utc) + timedelta(days=1 if upper else 0)
+    return parsed.strftime(TIMESTAMP_FORMAT)
+
+
+class ResultsStore:
+    """
+    Local SQLite copy of every extraction result, one row per file (re-extraction overwrites).
+    Each write takes the next value of a global change counter, which serves both as the
+    keyset for paging and as the cursor for incremental exports ("rows changed since N").
+    Keywords are also kept in an indexed side table so keyword filters don't scan every row.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS extraction_results (
+                filename TEXT PRIMARY KEY,
+                keywords TEXT NOT NULL DEFAULT '',
+                description TEXT NOT NULL DEFAULT '',
+                model_id TEXT,
+                model_version TEXT,
+                prompt_version TEXT,
+                tagging_version TEXT,
+                batch_id TEXT,
+                created_at TEXT NOT NULL,
+                updated_at TEXT NOT NULL,
+                change_seq INTEGER NOT NULL
+            );
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_results_change_seq ON extraction_results (change_seq);
+            CREATE TABLE IF NOT EXISTS result_keywords (
+                keyword TEXT NOT NULL,
+                filename TEXT NOT NULL,
+                PRIMARY KEY (keyword, filename)
+            );
+            CREATE INDEX IF NOT EXISTS idx_result_keywords_filename ON result_keywords (filename);
+        """)
+        existing = {row[1] for row in self._conn.execute("PRAGMA table_info(extraction_results)")}
+        for column, column_type in _ADDED_COLUMNS.items():
+            if column not in existing:
+                self._conn.execute(f"ALTER TABLE extraction_results ADD COLUMN {column} {column_type}")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_results_tagging_version ON extraction_results (tagging_version, filename)")
+        self._conn.commit()
+
+    def upsert(self, filename: str, keywords: Optional[List[str]], description: Optional[str],
+               model_id: Optional[str] = None, tagging_version: Optional[str] = None, batch_id: Optional[str] = None,
+               model_version: Optional[str] = None, prompt_version: Optional[str] = None):
+        keywords = list(dict.fromkeys(keywords or []))
+        now = _now()
+        with self._lock:
+            seq = self._conn.execute("SELECT COALESCE(MAX(change_seq), 0) + 1 FROM extraction_results").fetchone()[0]
+            self._conn.execute("""
+                INSERT INTO extraction_results (filename, keywords, description, model_id, model_version, prompt_version,
+                                                tagging_version, batch_id, created_at, updated_at, change_seq)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(filename) DO UPDATE SET
+                    keywords = excluded.keywords,
+                    description = excluded.description,
+                    model_id = excluded.model_id,
+                    model_version = excluded.model_version,
+                    prompt_version = excluded.prompt_version,
+                    tagging_version = excluded.tagging_version,
+                    batch_id = excluded.batch_id,
+                    updated_at = excluded.updated_at,
+                    change_seq = excluded.change_seq
+            """, (filename, ", ".join(keywords), description or "", model_id, model_version, prompt_version,
+                  tagging_version, batch_id, now, now, seq))
+            self._conn.execute("DELETE FROM result_keywords WHERE filename = ?", (filename,))
+            self._conn.executemany("INSERT INTO result_keywords (keyword, filename) VALUES (?, ?)",
+                                   [(k, filename) for k in keywords])
+            self._conn.commit()
+
+    def seed(self, rows: List[dict]) -> int:
+        """
+        Adds results recorded elsewhere (the Photos sheet predates this store) for files the store
+        doesn't have yet. Seeded rows carry no tagging version, so they count as stale; a later
+        seed row for the same file replaces an earlier one, a real extraction result never is.
+        Returns the number of rows inserted or replaced.
+        """
+        seeded = 0
+        now = _now()
+        with self._lock:
+            seq = self._conn.execute("SELECT COALESCE(MAX(change_seq), 0) FROM extraction_results").fetchone()[0]
+            for row in rows:
+                filename = row.get("filename")
+                if not filename:
+                    continue
+                keywords = list(dict.fromkeys(k.strip() for k in (row.get("keywords") or "").split(",") if k.strip()))
+                seq += 1
+                cursor = self._conn.execute("""
+                    INSERT INTO extraction_results (filename, keywords, description, model_version, prompt_version,
+                                                    created_at, updated_at, change_seq)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(filename) DO UPDATE SET
+                        keywords = excluded.keywords,
+                        description = excluded.description,
+                        model_version = excluded.model_version,
+                        prompt_version = excluded.prompt_version,
+                        updated_at = excluded.updated_at,
+                        change_seq = excluded.change_seq
+                    WHERE extraction_results.tagging_version IS NULL
+                """, (filename, ", ".join(keywords), row.get("description") or "", row.get("model_version") or None,
+                      row.get("prompt_version") or None, now, now, seq))
+                if cursor.rowcount:
+                    seeded += 1
+                    self._conn.execute("DELETE FROM result_keywords WHERE filename = ?", (filename,))
+                    self._conn.executemany("INSERT INTO result_keywords (keyword, filename) VALUES (?, ?)",
+                                           [(k, filename) for k in keywords])
+            self._conn.commit()
+        return seeded
+
+    def renormalize_keywords(self, normalize: Callable[[str], str], dry_run: bool = False, chunk_rows: int = 5000) -> dict:
+        """
+        Applies `normalize` (keyword string in, keyword string out) to every stored result, a chunk
+        of rows at a time in filename order. Changed rows get a new change_seq, so the next
+        incremental export picks them up, and their result_keywords entries are rebuilt.
+        """
+        stats = {"rows_scanned": 0, "rows_changed": 0, "keywords_before": 0, "keywords_after": 0}
+        after = ""
+        while True:
+            with self._lock:
+                rows = self._conn.execute("SELECT filename, keywords FROM extraction_results WHERE filename > ? "
+                                          "ORDER BY filename LIMIT ?", (after, chunk_rows)).fetchall()
+                if not rows:
+                    break
+                seq = self._conn.execute("SELECT COALESCE(MAX(change_seq), 0) FROM extraction_results").fetchone()[0]
+                now = _now()
+                for filename, current in rows:
+                    keywords = [k for k in normalize(current).split(", ") if k]
+                    stats["keywords_before"] += len([k for k in current.split(",") if k.strip()])
+                    stats["keywords_after"] += len(keywords)
+                    if ", ".join(keywords) == current:
+                        continue
+                    stats["rows_changed"] += 1
+                    if dry_run:
+                        continue
+                    seq += 1
+                    self._conn.execute("UPDATE extraction_results SET keywords = ?, updated_at = ?, change_seq = ? "
+                                       "WHERE filename = ?", (", ".join(keywords), now, seq, filename))
+                    self._conn.execute("DELETE FROM result_keywords WHERE filename = ?", (filename,))
+                    self._conn.executemany("INSERT INTO result_keywords (keyword, filename) VALUES (?, ?)",
+                                           [(k, filename) for k in keywords])
+                self._conn.commit()
+            stats["rows_scanned"] += len(rows)
+            if len(rows) < chunk_rows:
+                break
+            after = rows[-1][0]
+        return stats
+
+    def current_cursor(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COALESCE(MAX(change_seq), 0) FROM extraction_results").fetchone()[0]
+
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM extraction_results").fetchone()[0]
+
+    def get(self, filename: str) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute(f"SELECT {_SELECT_COLUMNS} FROM extraction_results r WHERE r.filename = ?",
+                                     (filename,)).fetchone()
+        return dict(zip(EXPORT_COLUMNS, row)) if row else None
+
+    def stale_filenames(self, current_version: str, after: str = "", limit: int = 100) -> List[str]:
+        """Files whose stored result came from another model/prompt version, in filename order after `after`."""
+        with self._lock:
+            rows = self._conn.execute("""
+                SELECT filename FROM extraction_results
+                WHERE filename > ? AND (tagging_version IS NULL OR tagging_version != ?)
+                ORDER BY filename LIMIT ?
+            """, (after, current_version, limit)).fetchall()
+        return [row[0] for row in rows]
+
+    def count_stale(self, current_version: str) -> int:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM extraction_results WHERE tagging_version IS NULL OR tagging_version != ?",
+                (current_version,)).fetchone()[0]
+
+    def version_counts(self) -> List[dict]:
+        with self._lock:
+            rows = self._conn.execute("""
+                SELECT tagging_version, COUNT(*) FROM extraction_results GROUP BY tagging_version ORDER BY COUNT(*) DESC
+            """).fetchall()
+        return [{"tagging_version": version, "results": count} for version, count in rows]
+
+    def iter_pages(self, since_cursor: int = 0, until_cursor: Optional[int] = None, date_from: Optional[str] = None,
+                   date_to: Optional[str] = None, keyword: Optional[str] = None, page_size: int = 5000) -> Iterator[List[dict]]:
+        """
+        Yields lists of at most page_size result dicts in change order, using keyset paging on the
+        change counter, so each page is an index range scan and memory stays flat however many rows
+        there are. until_cursor pins the snapshot; date_from (inclusive) and date_to (exclusive, or
+        the whole day for a bare date) filter on updated_at, see normalize_date_bound.
+        """
+        where = ["r.change_seq > ?"]
+        params: list = []
+        if until_cursor is not None:
+            where.append("r.change_seq <= ?")
+            params.append(until_cursor)
+        if date_from:
+            where.append("r.updated_at >= ?")
+            params.append(normalize_date_bound(date_from))
+        if date_to:
+            where.append("r.updated_at < ?")
+            params.append(normalize_date_bound(date_to, upper=True))
+        join, join_params = "", []
+        if keyword:
+            join, join_params = "JOIN result_keywords k ON k.filename = r.filename AND k.keyword = ?", [keyword]
+        sql = f"""
+            SELECT {_SELECT_COLUMNS}
+            FROM extraction_results r {join}
+            WHERE {' AND '.join(where)}
+            ORDER BY r.change_seq
+            LIMIT ?
+        """
+        last_seq = since_cursor
+        while True:
+            with self._lock:
+                rows = self._conn.execute(sql, (*join_params, last_seq, *params, page_size)).fetchall()
+            if not rows:
+                return
+            yield [dict(zip(EXPORT_COLUMNS, row)) for row in rows]
+            if len(rows) < page_size:
+                return
+            last_seq = rows[-1][-1]
+
+
+# --- Streaming serializers: each takes an iterator of pages and yields encoded chunks ---
+
+def iter_csv(pages: Iterator[List[dict]], columns: List[str] = EXPORT_COLUMNS) -> Iterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=columns, extrasaction="ignore")
+    writer.writeheader()
+    for page in pages:
+        writer.writerows(page)
+        yield buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")
+
+
+def iter_jsonl(pages: Iterator[List[dict]], columns: List[str] = EXPORT_COLUMNS) -> Iterator[bytes]:
+    for page in pages:
+        yield "".join(json.dumps({c: row.get(c) for c in columns}, ensure_ascii=False) + "\n" for row in page).encode("utf-8")
+
+
+class _ChunkSink:
+    """Write-only file object that hands written bytes back to a generator instead of keeping them."""
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def iter_parquet(pages: Iterator[List[dict]], columns: List[str] = EXPORT_COLUMNS) -> Iterator[bytes]:
+    """One Parquet row group per page; requires the optional pyarrow dependency."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    schema = pa.schema([(c, pa.int64() if c == "cursor" else pa.string()) for c in columns])
+    sink = _ChunkSink()
+    with pq.ParquetWriter(sink, schema, compression="zstd") as writer:
+        for page in pages:
+            writer.write_table(pa.Table.from_pylist([{c: row.get(c) for c in columns} for row in page], schema=schema))
+            yield sink.drain()
+    yield sink.drain()
+
+
+EXPORT_FORMATS = {
+    "csv": (iter_csv, "text/csv; charset=utf-8"),
+    "jsonl": (iter_jsonl, "application/x-ndjson"),
+    "parquet": (iter_parquet, "application/vnd.apache.parquet"),
+}
+
+
+def parquet_available() -> bool:
+    try:
+        import pyarrow.parquet  # noqa: F401
+        return True
+    except ImportError:
+        return False
@@ -0,0 +1,294 @@
+# storage_backends.py
+import os
+import uuid
+import hashlib
+import logging
+import tempfile
+import mimetypes
+import datetime
+from contextlib import contextmanager
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "local").lower()
+GCS_BUCKET_NAME = os.getenv("GCS_BUCKET_NAME")
+SIGNED_URL_TTL_SECONDS = int(os.getenv("SIGNED_URL_TTL_SECONDS", "900"))
+GCS_PARALLEL_UPLOAD_THRESHOLD_BYTES = int(os.getenv("GCS_PARALLEL_UPLOAD_THRESHOLD_BYTES", str(32 * 1024 * 1024)))
+GCS_UPLOAD_CHUNK_BYTES = int(os.getenv("GCS_UPLOAD_CHUNK_BYTES", str(16 * 1024 * 1024)))
+GCS_UPLOAD_WORKERS = int(os.getenv("GCS_UPLOAD_WORKERS", "8"))
+
+
+def unique_candidates(name: str):
+    """Yields name, name_1.ext, name_2.ext, ... (the upload naming scheme)."""
+    base, ext = os.path.splitext(name)
+    yield name
+    counter = 0
+    while True:
+        counter += 1
+        yield f"{base}_{counter}{ext}"
+
+
+class StorageBackend:
+    """
+    Where original uploads live. New uploads are written to a local staging path
+    (so they can be validated/normalized with ordinary file APIs) and then committed.
+    """
+    name = "base"
+
+    def exists(self, name: str) -> bool:
+        raise NotImplementedError
+
+    def size(self, name: str) -> int:
+        raise NotImplementedError
+
+    def staging_path(self, name: str) -> str:
+        """Reserves a new, empty local file for an upload of `name` and returns its path."""
+        raise NotImplementedError
+
+    def commit_staged(self, staged_path: str, name: str) -> str:
+        """Moves a staged local file into storage under `name`. Returns the stored name."""
+        raise NotImplementedError
+
+    def discard_staged(self, staged_path: str):
+        if os.path.exists(staged_path):
+            os.remove(staged_path)
+
+    def read_header(self, name: str, nbytes: int) -> bytes:
+        raise NotImplementedError
+
+    def content_hash(self, name: str) -> str:
+        """A digest of the file's current bytes, for detecting identical content."""
+        raise NotImplementedError
+
+    @contextmanager
+    def local_copy(self, name: str, writeback: bool = False):
+        """Yields a local filesystem path for `name`; with writeback, local changes are stored back."""
+        raise NotImplementedError
+
+    def delete(self, name: str):
+        raise NotImplementedError
+
+    def download_response(self, name: str):
+        """Returns the FastAPI response that serves the file to a client."""
+        raise NotImplementedError
+
+    def describe(self) -> dict:
+        return {"backend": self.name}
+
+
+class LocalStorageBackend(StorageBackend):
+    """
+    Files on the API server's disk (the original UPLOAD_DIRECTORY behaviour). Uploads are
+    staged in a hidden subdirectory, so files that are still being written or validated are
+    never served, and hard-linked into place under a name no other file has.
+    """
+    name = "local"
+    STAGING_SUBDIRECTORY = ".staging"
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.staging_directory = os.path.join(directory, self.STAGING_SUBDIRECTORY)
+        self._hash_cache = {}  # (path, size, mtime_ns) -> sha256
+        os.makedirs(self.staging_directory, exist_ok=True)
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.directory, os.path.basename(name))
+
+    def exists(self, name: str) -> bool:
+        return os.path.isfile(self.path(name))
+
+    def size(self, name: str) -> int:
+        return os.path.getsize(self.path(name))
+
+    def staging_path(self, name: str) -> str:
+        return _reserve_staging_file(self.staging_directory, name)
+
+    def commit_staged(self, staged_path: str, name: str) -> str:
+        # link() never replaces an existing file, so choosing the unique name and publishing
+        # the file is one atomic step, and readers only ever see the complete file.
+        for candidate in unique_candidates(os.path.basename(name)):
+            try:
+                os.link(staged_path, self.path(candidate))
+                break
+            except FileExistsError:
+                continue
+        os.remove(staged_path)
+        return candidate
+
+    def read_header(self, name: str, nbytes: int) -> bytes:
+        with open(self.path(name), "rb") as f:
+            return f.read(nbytes)
+
+    def content_hash(self, name: str) -> str:
+        path = self.path(name)
+        stat = os.stat(path)
+        key = (path, stat.st_size, stat.st_mtime_ns)
+        cached = self._hash_cache.get(key)
+        if cached is None:
+            digest = hashlib.sha256()
+            with open(path, "rb") as f:
+                for block in iter(lambda: f.read(1024 * 1024), b""):
+                    digest.update(block)
+            cached = digest.hexdigest()
+            if len(self._hash_cache) >= 10_000:
+                self._hash_cache.clear()
+            self._hash_cache[key] = cached
+        return cached
+
+    @contextmanager
+    def local_copy(self, name: str, writeback: bool = False):
+        yield self.path(name)
+
+    def delete(self, name: str):
+        os.remove(self.path(name))
+
+    def download_response(self, name: str):
+        from fastapi.responses import FileResponse
+        file_path = self.path(name)
+        media_type, _ = mimetypes.guess_type(file_path)
+        return FileResponse(path=file_path, media_type=media_type or 'application/octet-stream', filename=os.path.basename(name))
+
+    def describe(self) -> dict:
+        return {"backend": self.name, "directory": self.directory}
+
+
+class GCSStorageBackend(StorageBackend):
+    """
+    Google Cloud Storage bucket. Large files are uploaded as parallel multipart chunks,
+    and clients download directly through time-limited V4 signed URLs.
+    Honors STORAGE_EMULATOR_HOST (e.g. fake-gcs-server) for local testing; the emulator
+    can't verify signatures, so there /files redirects to its plain media URL.
+    """
+    name = "gcs"
+
+    def __init__(self, bucket_name: str, client=None, staging_directory: Optional[str] = None):
+        if not bucket_name:
+            raise ValueError("GCS_BUCKET_NAME must be set for the gcs storage backend.")
+        self.emulator_host = os.getenv("STORAGE_EMULATOR_HOST")
+        if client is None:
+            from google.cloud import storage
+            if self.emulator_host:
+                from google.auth.credentials import AnonymousCredentials
+                client = storage.Client(project=os.getenv("GOOGLE_CLOUD_PROJECT_ID", "test"), credentials=AnonymousCredentials())
+            else:
+                client = storage.Client()
+        self.client = client
+        self.bucket_name = bucket_name
+        self.bucket = client.bucket(bucket_name)
+        self.staging_directory = staging_directory or tempfile.mkdtemp(prefix="omi-staging-")
+        os.makedirs(self.staging_directory, exist_ok=True)
+
+    def exists(self, name: str) -> bool:
+        return self.bucket.blob(name).exists()
+
+    def size(self, name: str) -> int:
+        blob = self.bucket.get_blob(name)
+        if blob is None:
+            raise FileNotFoundError(name)
+        return blob.size
+
+    def staging_path(self, name: str) -> str:
+        # commit_staged picks the final name with a create-only precondition.
+        return _reserve_staging_file(self.staging_directory, name)
+
+    def _upload(self, local_path: str, name: str, if_generation_match=None):
+        blob = self.bucket.blob(name)
+        blob.content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        size = os.path.getsize(local_path)
+        if size >= GCS_PARALLEL_UPLOAD_THRESHOLD_BYTES and not self.emulator_host:
+            from google.cloud.storage import transfer_manager
+            # The chunked upload takes no precondition, so it goes to a private object that is
+            # then composed into place; compose honours if_generation_match.
+            part = self.bucket.blob(f".uploads/{uuid.uuid4().hex}")
+            part.content_type = blob.content_type
+            transfer_manager.upload_chunks_concurrently(
+                local_path, part, chunk_size=GCS_UPLOAD_CHUNK_BYTES, max_workers=GCS_UPLOAD_WORKERS)
+            try:
+                blob.compose([part], if_generation_match=if_generation_match)
+            finally:
+                part.delete()
+        else:
+            blob.upload_from_filename(local_path, if_generation_match=if_generation_match)
+        logger.info(f"Storage (gcs): Uploaded {name} ({size} bytes) to gs://{self.bucket_name}.")
+
+    def commit_staged(self, staged_path: str, name: str) -> str:
+        from google.api_core.exceptions import PreconditionFailed
+        for candidate in unique_candidates(name):
+            try:
+                # if_generation_match=0 only creates; a concurrent upload of the same name fails here.
+                self._upload(staged_path, candidate, if_generation_match=0)
+                break
+            except PreconditionFailed:
+                continue
+        os.remove(staged_path)
+        return candidate
+
+    def read_header(self, name: str, nbytes: int) -> bytes:
+        return self.bucket.blob(name).download_as_bytes(start=0, end=nbytes - 1)
+
+    def content_hash(self, name: str) -> str:
+        # GCS already stores a checksum; composite (parallel-uploaded) objects only have crc32c.
+        blob = self.bucket.get_blob(name)
+        if blob is None:
+            raise FileNotFoundError(name)
+        return blob.md5_hash or f"crc32c:{blob.crc32c}"
+
+    @contextmanager
+    def local_copy(self, name: str, writeback: bool = False):
+        from google.api_core.exceptions import PreconditionFailed
+        fd, tmp_path = tempfile.mkstemp(dir=self.staging_directory, suffix=os.path.splitext(name)[1])
+        os.close(fd)
+        try:
+            blob = self.bucket.get_blob(name)
+            if blob is None:
+                raise FileNotFoundError(name)
+            generation = blob.generation
+            blob.download_to_filename(tmp_path, if_generation_match=generation)
+            before = os.stat(tmp_path)
+            yield tmp_path
+            if writeback and os.path.exists(tmp_path):
+                after = os.stat(tmp_path)
+                if (after.st_size, after.st_mtime_ns, after.st_ino) != (before.st_size, before.st_mtime_ns, before.st_ino):
+                    try:
+                        # Only replaces the generation that was downloaded; a concurrent rewrite wins instead.
+                        self._upload(tmp_path, name, if_generation_match=generation)
+                    except PreconditionFailed:
+                        logger.warning(f"Storage (gcs): {name} changed since it was downloaded (generation {generation}); "
+                                       f"not writing back the local changes.")
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def delete(self, name: str):
+        self.bucket.blob(name).delete()
+
+    def signed_url(self, name: str) -> str:
+        if self.emulator_host:
+            from urllib.parse import quote
+            return f"{self.emulator_host.rstrip('/')}/download/storage/v1/b/{self.bucket_name}/o/{quote(name, safe='')}?alt=media"
+        return self.bucket.blob(name).generate_signed_url(
+            version="v4", expiration=datetime.timedelta(seconds=SIGNED_URL_TTL_SECONDS), method="GET")
+
+    def download_response(self, name: str):
+        from fastapi.responses import RedirectResponse
+        return RedirectResponse(url=self.signed_url(name), status_code=307)
+
+    def describe(self) -> dict:
+        return {"backend": self.name, "bucket": self.bucket_name, "emulator": self.emulator_host,
+                "signed_url_ttl_seconds": SIGNED_URL_TTL_SECONDS}
+
+
+def _reserve_staging_file(directory: str, name: str) -> str:
+    """Creates an empty, uniquely named staging file for an upload of `name` and returns its path."""
+    path = os.path.join(directory, f"{uuid.uuid4().hex}_{os.path.basename(name)}")
+    os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644))
+    return path
+
+
+def create_storage_backend(local_directory: str) -> StorageBackend:
+    if STORAGE_BACKEND == "gcs":
+        return GCSStorageBackend(GCS_BUCKET_NAME)
+    if STORAGE_BACKEND != "local":
+        raise ValueError(f"Unknown STORAGE_BACKEND '{STORAGE_BACKEND}'. Use 'local' or 'gcs'.")
+    return LocalStorageBackend(local_directory)
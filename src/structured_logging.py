@@ -0,0 +1,185 @@
+# structured_logging.py
+import os
+import sys
+import json
+import time
+import uuid
+import queue
+import random
+import logging
+import zlib
+import atexit
+import contextvars
+import logging.handlers
+from typing import Optional, Callable
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()  # json | text
+# Fraction of requests whose DEBUG lines are kept. Sampling is per request ID, so a sampled
+# request keeps all of its debug lines and an unsampled one keeps none.
+LOG_DEBUG_SAMPLE_RATE = float(os.getenv("LOG_DEBUG_SAMPLE_RATE", "0.01"))
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+request_id_var: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("request_id", default=None)
+
+# Attributes every LogRecord has; anything else was passed through `extra=` and is emitted as a field.
+_STANDARD_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "request_id"}
+
+
+def new_request_id() -> str:
+    return uuid.uuid4().hex
+
+
+def set_request_id(request_id: Optional[str]) -> contextvars.Token:
+    """Binds a request ID to the current context; asyncio.to_thread and tasks inherit it."""
+    return request_id_var.set(request_id)
+
+
+def reset_request_id(token: contextvars.Token):
+    request_id_var.reset(token)
+
+
+def get_request_id() -> Optional[str]:
+    return request_id_var.get()
+
+
+class Lazy:
+    """
+    Defers building an expensive log argument until a handler actually formats the record:
+        logger.debug("Raw response: %s", Lazy(lambda: response))
+    Nothing is evaluated when DEBUG is disabled or the line is sampled out.
+    """
+    __slots__ = ("_func",)
+
+    def __init__(self, func: Callable[[], object]):
+        self._func = func
+
+    def __str__(self) -> str:
+        return str(self._func())
+
+    __repr__ = __str__
+
+
+def truncate(text: object, limit: int = 200) -> Lazy:
+    """Lazy, length-capped rendering of a possibly large value."""
+    def render():
+        value = str(text)
+        return value if len(value) <= limit else f"{value[:limit]}... ({len(value)} chars)"
+    return Lazy(render)
+
+
+class RequestContextFilter(logging.Filter):
+    """Stamps records with the current request ID and samples DEBUG lines."""
+
+    def __init__(self, debug_sample_rate: float = LOG_DEBUG_SAMPLE_RATE):
+        super().__init__()
+        self.debug_sample_rate = debug_sample_rate
+
+    def _sampled(self, request_id: Optional[str]) -> bool:
+        if self.debug_sample_rate >= 1.0:
+            return True
+        if request_id is None:
+            return random.random() < self.debug_sample_rate
+        return (zlib.crc32(request_id.encode("ascii", "replace")) % 10_000) < self.debug_sample_rate * 10_000
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        request_id = request_id_var.get()
+        record.request_id = request_id
+        if record.levelno <= logging.DEBUG and not self._sampled(request_id):
+            return False
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: ts, level, logger, request_id, message, any `extra=` fields, exc_info."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "request_id": getattr(record, "request_id", None),
+            "message": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _STANDARD_RECORD_ATTRS and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class _TextFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        record.request_id_suffix = f" [{record.request_id}]" if getattr(record, "request_id", None) else ""
+        return super().format(record)
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands the record to the listener thread without formatting it, so the caller only pays
+    for the enqueue. (The stock QueueHandler formats the message in the calling thread.)
+    Drops records instead of blocking when the queue is full.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_listener: Optional[logging.handlers.QueueListener] = None
+_queue_handler: Optional[_DeferredQueueHandler] = None
+
+
+def configure_logging(level: str = LOG_LEVEL, log_format: str = LOG_FORMAT, stream=None):
+    """
+    Routes the root logger through a bounded queue to a background thread that formats and
+    writes the lines. Idempotent: later calls are no-ops.
+    """
+    global _listener, _queue_handler
+    if _listener is not None:
+        return
+    output = logging.StreamHandler(stream or sys.stderr)
+    if log_format == "json":
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(_TextFormatter("%(levelname)s:%(name)s%(request_id_suffix)s:%(message)s"))
+
+    _queue_handler = _DeferredQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    _queue_handler.addFilter(RequestContextFilter())
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_queue_handler)
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(_queue_handler.queue, output, respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown_logging)
+
+
+def shutdown_logging():
+    """Flushes queued records and stops the listener thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def get_logging_stats() -> dict:
+    return {
+        "format": LOG_FORMAT,
+        "level": logging.getLevelName(logging.getLogger().level),
+        "debug_sample_rate": LOG_DEBUG_SAMPLE_RATE,
+        "queued": _queue_handler.queue.qsize() if _queue_handler else 0,
+        "dropped": _queue_handler.dropped if _queue_handler else 0,
+    }
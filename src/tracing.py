@@ -0,0 +1,401 @@
+# tracing.py
+import os
+import sys
+import json
+import time
+import heapq
+import queue
+import random
+import logging
+import threading
+import contextvars
+from collections import Counter
+from contextlib import contextmanager
+from typing import Optional, List
+
+logger = logging.getLogger(__name__)
+
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "true").lower() in ("1", "true", "yes")
+# Exporters: "none", "file" (JSON lines in TRACE_FILE_PATH) or "otlp" (OTLP/HTTP JSON to TRACE_OTLP_ENDPOINT,
+# e.g. http://localhost:4318/v1/traces for an OpenTelemetry collector or Jaeger).
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "none").lower()
+TRACE_FILE_PATH = os.getenv("TRACE_FILE_PATH", "traces.jsonl")
+TRACE_OTLP_ENDPOINT = os.getenv("TRACE_OTLP_ENDPOINT", "http://localhost:4318/v1/traces")
+TRACE_EXPORT_SAMPLE_RATE = float(os.getenv("TRACE_EXPORT_SAMPLE_RATE", "1.0"))
+TRACE_SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "omi-photo-tagger")
+SLOW_REQUESTS_KEPT = int(os.getenv("SLOW_REQUESTS_KEPT", "50"))  # per window
+# The slow-request store keeps the slowest traces of each window and drops windows older
+# than SLOW_REQUEST_WINDOWS x SLOW_REQUEST_WINDOW_SECONDS (the last hour by default).
+SLOW_REQUEST_WINDOW_SECONDS = float(os.getenv("SLOW_REQUEST_WINDOW_SECONDS", "300"))
+SLOW_REQUEST_WINDOWS = int(os.getenv("SLOW_REQUEST_WINDOWS", "12"))
+PROFILE_SAMPLE_INTERVAL_SECONDS = float(os.getenv("PROFILE_SAMPLE_INTERVAL_SECONDS", "0.005"))
+PROFILES_KEPT = int(os.getenv("PROFILES_KEPT", "20"))
+
+_current_trace: contextvars.ContextVar[Optional["Trace"]] = contextvars.ContextVar("current_trace", default=None)
+_current_span_id: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("current_span_id", default=None)
+
+
+def _new_id(hex_chars: int) -> str:
+    return f"{random.getrandbits(hex_chars * 4):0{hex_chars}x}"
+
+
+class Trace:
+    """All spans of one request. Spans may be recorded from worker threads (asyncio.to_thread copies the context)."""
+
+    def __init__(self, name: str, request_id: Optional[str] = None):
+        self.trace_id = _new_id(32)
+        self.name = name
+        self.request_id = request_id
+        self.spans: List[dict] = []
+        self._open_spans = Counter()  # thread id -> spans of this trace open on it, for the profiler
+        self.root_attributes: dict = {}
+        self._lock = threading.Lock()
+
+    def add(self, span: dict):
+        with self._lock:
+            self.spans.append(span)
+
+    def _span_opened(self, thread_id: int):
+        with self._lock:
+            self._open_spans[thread_id] += 1
+
+    def _span_closed(self, thread_id: int):
+        with self._lock:
+            self._open_spans[thread_id] -= 1
+            if not self._open_spans[thread_id]:
+                del self._open_spans[thread_id]
+
+    def active_thread_ids(self) -> List[int]:
+        """Threads currently inside one of this trace's spans."""
+        with self._lock:
+            return list(self._open_spans)
+
+    def to_dict(self) -> dict:
+        root = next((s for s in self.spans if s["parent_id"] is None), None)
+        return {
+            "trace_id": self.trace_id,
+            "request_id": self.request_id,
+            "name": self.name,
+            "duration_ms": root["duration_ms"] if root else None,
+            "attributes": root["attributes"] if root else {},
+            "spans": sorted(self.spans, key=lambda s: s["start_ns"]),
+        }
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """
+    Times a stage of the current request's trace. A no-op (one context-variable lookup) when
+    there is no active trace, so it is safe in code that also runs outside requests.
+    Yields the attribute dict, so attributes can be added once they're known.
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        yield attributes
+        return
+    span_id = _new_id(16)
+    parent_id = _current_span_id.get()
+    token = _current_span_id.set(span_id)
+    thread_id = threading.get_ident()
+    trace._span_opened(thread_id)
+    start_ns = time.time_ns()
+    start = time.perf_counter()
+    error = None
+    try:
+        yield attributes
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        trace._span_closed(thread_id)
+        _current_span_id.reset(token)
+        trace.add({
+            "span_id": span_id,
+            "parent_id": parent_id,
+            "name": name,
+            "start_ns": start_ns,
+            "duration_ms": round((time.perf_counter() - start) * 1000, 3),
+            "attributes": attributes,
+            "error": error,
+        })
+
+
+def set_attribute(key: str, value):
+    """Adds an attribute to the request's root span (e.g. the filename once it is known)."""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.root_attributes[key] = value
+
+
+@contextmanager
+def trace_request(name: str, request_id: Optional[str] = None, **attributes):
+    """Starts a trace with a root span; on exit it is recorded in the slow-request store and exported."""
+    if not TRACING_ENABLED:
+        yield None
+        return
+    trace = Trace(name, request_id)
+    token = _current_trace.set(trace)
+    try:
+        with span(name, **attributes) as root_attributes:
+            trace.root_attributes = root_attributes
+            yield trace
+    finally:
+        _current_trace.reset(token)
+        slow_requests.offer(trace)
+        if _exporter is not None and random.random() < TRACE_EXPORT_SAMPLE_RATE:
+            _exporter.submit(trace)
+
+
+# --- Slowest-N store ---
+
+class SlowRequestStore:
+    """
+    Keeps the N slowest traces of each time window (a min-heap on duration per window), with
+    their full span breakdowns, in a ring of the most recent windows. A burst of slow requests
+    at start-up ages out instead of hiding every later one.
+    """
+
+    def __init__(self, capacity: int = SLOW_REQUESTS_KEPT, window_seconds: float = SLOW_REQUEST_WINDOW_SECONDS,
+                 windows: int = SLOW_REQUEST_WINDOWS, clock=time.time):
+        self.capacity = capacity
+        self.window_seconds = window_seconds
+        self.windows = windows
+        self._clock = clock
+        self._heaps = {}  # window number -> min-heap of (duration_ms, counter, entry)
+        self._counter = 0
+        self._lock = threading.Lock()
+
+    def _expire(self, current_window: int):
+        for window in [w for w in self._heaps if w <= current_window - self.windows]:
+            del self._heaps[window]
+
+    def offer(self, trace: Trace):
+        entry = trace.to_dict()
+        duration = entry["duration_ms"] or 0.0
+        now = self._clock()
+        entry["finished_at"] = round(now, 3)
+        window = int(now // self.window_seconds)
+        with self._lock:
+            self._expire(window)
+            self._counter += 1
+            heap = self._heaps.setdefault(window, [])
+            item = (duration, self._counter, entry)
+            if len(heap) < self.capacity:
+                heapq.heappush(heap, item)
+            elif duration > heap[0][0]:
+                heapq.heapreplace(heap, item)
+
+    def slowest(self, limit: Optional[int] = None, name: Optional[str] = None,
+                within_seconds: Optional[float] = None) -> List[dict]:
+        """The slowest retained traces, slowest first; `within_seconds` keeps only those that finished that recently."""
+        now = self._clock()
+        with self._lock:
+            self._expire(int(now // self.window_seconds))
+            items = [item for heap in self._heaps.values() for item in heap]
+        items.sort(key=lambda item: (item[0], item[1]), reverse=True)
+        entries = [entry for _, _, entry in items]
+        if within_seconds is not None:
+            entries = [e for e in entries if e["finished_at"] >= now - within_seconds]
+        if name:
+            entries = [e for e in entries if e["name"] == name]
+        return entries[:limit] if limit else entries
+
+    def clear(self):
+        with self._lock:
+            self._heaps.clear()
+
+
+slow_requests = SlowRequestStore()
+
+
+# --- Exporters (background thread; requests never wait on export I/O) ---
+
+def _otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def to_otlp(traces: List[dict]) -> dict:
+    spans = []
+    for trace in traces:
+        for s in trace["spans"]:
+            attributes = dict(s["attributes"])
+            if trace["request_id"]:
+                attributes["request.id"] = trace["request_id"]
+            spans.append({
+                "traceId": trace["trace_id"],
+                "spanId": s["span_id"],
+                **({"parentSpanId": s["parent_id"]} if s["parent_id"] else {}),
+                "name": s["name"],
+                "kind": 2 if s["parent_id"] is None else 1,  # SERVER for the root, INTERNAL otherwise
+                "startTimeUnixNano": str(s["start_ns"]),
+                "endTimeUnixNano": str(s["start_ns"] + int(s["duration_ms"] * 1_000_000)),
+                "attributes": [{"key": k, "value": _otlp_value(v)} for k, v in attributes.items() if v is not None],
+                "status": {"code": 2, "message": s["error"]} if s["error"] else {},
+            })
+    return {"resourceSpans": [{
+        "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": TRACE_SERVICE_NAME}}]},
+        "scopeSpans": [{"scope": {"name": "omi.tracing"}, "spans": spans}],
+    }]}
+
+
+class TraceExporter:
+    def __init__(self, kind: str, batch_size: int = 64, flush_seconds: float = 2.0):
+        self.kind = kind
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self._queue = queue.Queue(maxsize=10_000)
+        self.exported = 0
+        self.dropped = 0
+        self.errors = 0
+        self._thread = threading.Thread(target=self._run, name="trace-exporter", daemon=True)
+        self._thread.start()
+
+    def submit(self, trace: Trace):
+        try:
+            self._queue.put_nowait(trace.to_dict())
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_seconds
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            try:
+                self._write(batch)
+                self.exported += len(batch)
+            except Exception as e:
+                self.errors += 1
+                logger.warning("Tracing: Failed to export %s traces to %s: %s", len(batch), self.kind, e)
+
+    def _write(self, batch: List[dict]):
+        if self.kind == "file":
+            with open(TRACE_FILE_PATH, "a", encoding="utf-8") as f:
+                f.writelines(json.dumps(t, default=str) + "\n" for t in batch)
+        elif self.kind == "otlp":
+            import urllib.request
+            body = json.dumps(to_otlp(batch), default=str).encode("utf-8")
+            request = urllib.request.Request(TRACE_OTLP_ENDPOINT, data=body, headers={"Content-Type": "application/json"})
+            with urllib.request.urlopen(request, timeout=5):
+                pass
+
+    def snapshot(self) -> dict:
+        return {"exporter": self.kind, "exported": self.exported, "dropped": self.dropped, "errors": self.errors,
+                "queued": self._queue.qsize()}
+
+
+_exporter: Optional[TraceExporter] = None
+
+
+def start_exporter():
+    """Starts the configured exporter thread (called from the server's lifespan hook)."""
+    global _exporter
+    if _exporter is None and TRACING_ENABLED and TRACE_EXPORTER in ("file", "otlp"):
+        _exporter = TraceExporter(TRACE_EXPORTER)
+        logger.info("Tracing: Exporting traces via '%s'.", TRACE_EXPORTER)
+
+
+def get_tracing_stats() -> dict:
+    return {
+        "enabled": TRACING_ENABLED,
+        "export": _exporter.snapshot() if _exporter else {"exporter": "none"},
+        "slow_requests_kept": len(slow_requests.slowest()),
+    }
+
+
+# --- Sampling profiler ---
+
+class SamplingProfiler:
+    """
+    Samples the Python stacks of the threads that run a trace's spans (the event loop thread
+    and its to_thread workers) every PROFILE_SAMPLE_INTERVAL_SECONDS, and aggregates them into
+    folded stacks ("a;b;c count", the input format of flamegraph.pl and speedscope).
+    A thread is sampled only while one of the trace's spans is open on it, so pooled workers
+    are not sampled once they move on to other requests. The event loop thread is the
+    exception: the root span stays open across awaits, so its samples also include whatever
+    other requests' coroutines run on the loop meanwhile.
+    """
+
+    def __init__(self, trace: Trace, interval: float = PROFILE_SAMPLE_INTERVAL_SECONDS):
+        self.trace = trace
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="request-profiler", daemon=True)
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.duration_seconds = time.perf_counter() - self._started
+        return False
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            for thread_id in self.trace.active_thread_ids():
+                frame = frames.get(thread_id)
+                if frame is None or thread_id == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+                self.samples += 1
+
+    def result(self, top: int = 30) -> dict:
+        functions = Counter()
+        for stack, count in self.stacks.items():
+            functions[stack.rsplit(";", 1)[-1]] += count
+        return {
+            "trace_id": self.trace.trace_id,
+            "request_id": self.trace.request_id,
+            "name": self.trace.name,
+            "duration_seconds": round(self.duration_seconds, 4),
+            "sample_interval_seconds": self.interval,
+            "samples": self.samples,
+            "top_self_frames": [{"frame": f, "samples": c, "percent": round(100.0 * c / self.samples, 1)}
+                                for f, c in functions.most_common(top)] if self.samples else [],
+            "folded_stacks": "\n".join(f"{stack} {count}" for stack, count in self.stacks.most_common()),
+            "trace": self.trace.to_dict(),
+        }
+
+
+class ProfileStore:
+    """The last PROFILES_KEPT profiles, fetched by ID through the admin endpoint."""
+
+    def __init__(self, capacity: int = PROFILES_KEPT):
+        self.capacity = capacity
+        self._profiles = {}
+        self._lock = threading.Lock()
+
+    def put(self, profile_id: str, profile: dict):
+        with self._lock:
+            self._profiles[profile_id] = profile
+            while len(self._profiles) > self.capacity:
+                self._profiles.pop(next(iter(self._profiles)))
+
+    def get(self, profile_id: str) -> Optional[dict]:
+        with self._lock:
+            return self._profiles.get(profile_id)
+
+
+profiles = ProfileStore()
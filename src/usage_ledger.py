@@ -0,0 +1,159 @@
+# usage_ledger.py
+import os
+import sqlite3
+import logging
+import threading
+from datetime import datetime, timezone, timedelta
+from typing import Optional, List
+
+logger = logging.getLogger(__name__)
+
+# --- Daily budgets (0 disables a budget) ---
+DAILY_TOKEN_BUDGET = int(os.getenv("DAILY_TOKEN_BUDGET", "0"))
+DAILY_COST_BUDGET_USD = float(os.getenv("DAILY_COST_BUDGET_USD", "0"))
+DAILY_CALL_BUDGET = int(os.getenv("DAILY_CALL_BUDGET", "0"))
+# "reject" answers 429 once a budget is exhausted; "queue" defers the work until the next day.
+BUDGET_EXHAUSTED_ACTION = os.getenv("BUDGET_EXHAUSTED_ACTION", "reject").lower()
+
+
+def _today() -> str:
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d")
+
+
+def seconds_until_budget_reset() -> int:
+    now = datetime.now(timezone.utc)
+    tomorrow = (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    return max(1, int((tomorrow - now).total_seconds()))
+
+
+class UsageLedger:
+    """
+    Local SQLite store of token usage, cost and latency, aggregated per UTC day and batch.
+    Also holds the queue of extractions deferred because a daily budget was exhausted.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS usage_totals (
+                day TEXT NOT NULL,
+                batch_id TEXT NOT NULL DEFAULT '',
+                calls INTEGER NOT NULL DEFAULT 0,
+                input_tokens INTEGER NOT NULL DEFAULT 0,
+                output_tokens INTEGER NOT NULL DEFAULT 0,
+                prompt_tokens INTEGER NOT NULL DEFAULT 0,
+                cost_usd REAL NOT NULL DEFAULT 0,
+                latency_seconds REAL NOT NULL DEFAULT 0,
+                PRIMARY KEY (day, batch_id)
+            );
+            CREATE TABLE IF NOT EXISTS deferred_extractions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                filename TEXT NOT NULL,
+                batch_id TEXT NOT NULL DEFAULT '',
+                queued_at TEXT NOT NULL
+            );
+        """)
+        self._conn.commit()
+
+    def record(self, input_tokens: int, output_tokens: int, prompt_tokens: int, cost_usd: float,
+               latency_seconds: float, batch_id: Optional[str] = None, calls: int = 1):
+        """Adds the usage of one extraction, which made `calls` Gemini calls (cascade tiers, media frames)."""
+        with self._lock:
+            self._conn.execute("""
+                INSERT INTO usage_totals (day, batch_id, calls, input_tokens, output_tokens, prompt_tokens, cost_usd, latency_seconds)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(day, batch_id) DO UPDATE SET
+                    calls = calls + excluded.calls,
+                    input_tokens = input_tokens + excluded.input_tokens,
+                    output_tokens = output_tokens + excluded.output_tokens,
+                    prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+                    cost_usd = cost_usd + excluded.cost_usd,
+                    latency_seconds = latency_seconds + excluded.latency_seconds
+            """, (_today(), batch_id or "", calls, input_tokens, output_tokens, prompt_tokens, cost_usd, latency_seconds))
+            self._conn.commit()
+
+    def _totals(self, where: str, params: tuple) -> dict:
+        with self._lock:
+            row = self._conn.execute(f"""
+                SELECT COALESCE(SUM(calls), 0), COALESCE(SUM(input_tokens), 0), COALESCE(SUM(output_tokens), 0),
+                       COALESCE(SUM(prompt_tokens), 0), COALESCE(SUM(cost_usd), 0), COALESCE(SUM(latency_seconds), 0)
+                FROM usage_totals WHERE {where}
+            """, params).fetchone()
+        calls, input_tokens, output_tokens, prompt_tokens, cost_usd, latency_seconds = row
+        return {
+            "calls": calls,
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "total_tokens": input_tokens + output_tokens,
+            "prompt_tokens": prompt_tokens,
+            "prompt_token_share": round(prompt_tokens / input_tokens, 4) if input_tokens else None,
+            "estimated_cost_usd": round(cost_usd, 6),
+            "avg_latency_seconds": round(latency_seconds / calls, 3) if calls else None,
+        }
+
+    def daily_totals(self, day: Optional[str] = None) -> dict:
+        day = day or _today()
+        totals = self._totals("day = ?", (day,))
+        totals["day"] = day
+        return totals
+
+    def batch_totals(self, batch_id: str) -> dict:
+        totals = self._totals("batch_id = ?", (batch_id,))
+        totals["batch_id"] = batch_id
+        return totals
+
+    def recent_days(self, limit: int = 30) -> List[dict]:
+        with self._lock:
+            days = [r[0] for r in self._conn.execute(
+                "SELECT DISTINCT day FROM usage_totals ORDER BY day DESC LIMIT ?", (limit,))]
+        return [self.daily_totals(day) for day in days]
+
+    def budget_exhausted_reason(self) -> Optional[str]:
+        """Returns why today's budget is exhausted, or None if work may proceed."""
+        if not (DAILY_TOKEN_BUDGET or DAILY_COST_BUDGET_USD or DAILY_CALL_BUDGET):
+            return None
+        today = self.daily_totals()
+        if DAILY_TOKEN_BUDGET and today["total_tokens"] >= DAILY_TOKEN_BUDGET:
+            return f"Daily token budget of {DAILY_TOKEN_BUDGET} exhausted."
+        if DAILY_COST_BUDGET_USD and today["estimated_cost_usd"] >= DAILY_COST_BUDGET_USD:
+            return f"Daily cost budget of ${DAILY_COST_BUDGET_USD:.2f} exhausted."
+        if DAILY_CALL_BUDGET and today["calls"] >= DAILY_CALL_BUDGET:
+            return f"Daily call budget of {DAILY_CALL_BUDGET} exhausted."
+        return None
+
+    def budgets(self) -> dict:
+        return {
+            "daily_token_budget": DAILY_TOKEN_BUDGET or None,
+            "daily_cost_budget_usd": DAILY_COST_BUDGET_USD or None,
+            "daily_call_budget": DAILY_CALL_BUDGET or None,
+            "exhausted_action": BUDGET_EXHAUSTED_ACTION,
+            "exhausted_reason": self.budget_exhausted_reason(),
+            "seconds_until_reset": seconds_until_budget_reset(),
+        }
+
+    # --- Deferred work ---
+
+    def defer(self, filename: str, batch_id: Optional[str] = None) -> int:
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT INTO deferred_extractions (filename, batch_id, queued_at) VALUES (?, ?, ?)",
+                (filename, batch_id or "", datetime.now(timezone.utc).isoformat()))
+            self._conn.commit()
+            return cursor.lastrowid
+
+    def pop_deferred(self) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, filename, batch_id, queued_at FROM deferred_extractions ORDER BY id LIMIT 1").fetchone()
+            if row is None:
+                return None
+            self._conn.execute("DELETE FROM deferred_extractions WHERE id = ?", (row[0],))
+            self._conn.commit()
+        return {"id": row[0], "filename": row[1], "batch_id": row[2] or None, "queued_at": row[3]}
+
+    def deferred_count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM deferred_extractions").fetchone()[0]
@@ -0,0 +1,121 @@
+# test_admission_control.py
+import asyncio
+
+import pytest
+
+from admission_control import AdmissionController, PriorityClass, RequestShedError, PRIORITY_BULK, PRIORITY_INTERACTIVE
+
+
+def _controller(capacity=1, interactive_queue=4, bulk_queue=4, queue_timeout=5.0, **kwargs):
+    classes = [
+        PriorityClass(PRIORITY_INTERACTIVE, rank=0, max_concurrent=capacity, max_queue=interactive_queue,
+                      queue_timeout_seconds=queue_timeout, retry_after_seconds=2),
+        PriorityClass(PRIORITY_BULK, rank=1, max_concurrent=capacity, max_queue=bulk_queue,
+                      queue_timeout_seconds=queue_timeout, retry_after_seconds=15),
+    ]
+    return AdmissionController(classes, capacity, **kwargs)
+
+
+async def _settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_classify_uses_the_priority_header_and_api_keys_only():
+    controller = _controller(api_keys={"etl-key": PRIORITY_BULK, "ui-key": PRIORITY_INTERACTIVE})
+    assert controller.classify({}) == PRIORITY_INTERACTIVE
+    assert controller.classify({"x-batch-id": "upload-42"}) == PRIORITY_INTERACTIVE
+    assert controller.classify({"x-priority": "bulk"}) == PRIORITY_BULK
+    assert controller.classify({"x-api-key": "etl-key"}) == PRIORITY_BULK
+    assert controller.classify({"x-api-key": "ui-key", "x-priority": "bulk"}) == PRIORITY_INTERACTIVE
+    # X-Priority can lower a request's class, never raise it above the default.
+    lowered = _controller(default_class=PRIORITY_BULK)
+    assert lowered.classify({"x-priority": "interactive"}) == PRIORITY_BULK
+
+
+def test_batch_id_implies_bulk_only_when_opted_in():
+    controller = _controller(batch_id_is_bulk=True)
+    assert controller.classify({"x-batch-id": "upload-42"}) == PRIORITY_BULK
+    assert controller.classify({"x-batch-id": "upload-42", "x-api-key": "unknown"}) == PRIORITY_BULK
+
+
+def test_bulk_is_shed_while_interactive_requests_queue_and_admitted_after_them():
+    async def scenario():
+        controller = _controller()
+        running = await controller.acquire(PRIORITY_INTERACTIVE)
+        waiting = asyncio.create_task(controller.acquire(PRIORITY_INTERACTIVE))
+        await _settle()
+        with pytest.raises(RequestShedError) as shed:
+            await controller.acquire(PRIORITY_BULK)
+        assert (shed.value.reason, shed.value.retry_after_seconds) == ("higher_priority_waiting", 15)
+
+        await controller.release(running)
+        second = await waiting
+        bulk = asyncio.create_task(controller.acquire(PRIORITY_BULK))  # nothing interactive queued: it waits
+        await _settle()
+        assert not bulk.done()
+        await controller.release(second)
+        await controller.release(await bulk)
+        return controller.snapshot()
+
+    snapshot = asyncio.run(scenario())
+    assert snapshot["active"] == 0
+    assert snapshot["classes"][PRIORITY_INTERACTIVE]["admitted"] == 2
+    assert snapshot["classes"][PRIORITY_BULK]["shed"]["higher_priority_waiting"] == 1
+    assert snapshot["classes"][PRIORITY_BULK]["admitted"] == 1
+
+
+def test_full_queue_sheds_at_once():
+    async def scenario():
+        controller = _controller(interactive_queue=1)
+        running = await controller.acquire(PRIORITY_INTERACTIVE)
+        waiting = asyncio.create_task(controller.acquire(PRIORITY_INTERACTIVE))
+        await _settle()
+        with pytest.raises(RequestShedError) as shed:
+            await controller.acquire(PRIORITY_INTERACTIVE)
+        await controller.release(running)
+        await controller.release(await waiting)
+        return shed.value
+
+    assert asyncio.run(scenario()).reason == "queue_full"
+
+
+def test_queue_timeout_sheds_and_frees_the_queue_place():
+    async def scenario():
+        controller = _controller(interactive_queue=1, queue_timeout=0.01)
+        running = await controller.acquire(PRIORITY_INTERACTIVE)
+        with pytest.raises(RequestShedError) as shed:
+            await controller.acquire(PRIORITY_INTERACTIVE)
+        assert shed.value.reason == "queue_timeout"
+        assert controller.classes[PRIORITY_INTERACTIVE].queued == 0
+        await controller.release(running)
+        # Bulk was only held back by the timed-out waiter.
+        await controller.release(await controller.acquire(PRIORITY_BULK))
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_requests_give_back_their_slot_and_queue_place():
+    async def scenario():
+        controller = _controller()
+        entered = asyncio.Event()
+
+        async def handler():
+            async with controller.admit(PRIORITY_INTERACTIVE):
+                entered.set()
+                await asyncio.sleep(60)
+
+        running = asyncio.create_task(handler())
+        await entered.wait()
+        queued = asyncio.create_task(controller.acquire(PRIORITY_INTERACTIVE))
+        await _settle()
+        assert controller.classes[PRIORITY_INTERACTIVE].queued == 1
+
+        queued.cancel()  # client went away while waiting
+        running.cancel()  # client went away mid-request
+        await asyncio.gather(queued, running, return_exceptions=True)
+        assert (controller.active, controller.classes[PRIORITY_INTERACTIVE].queued) == (0, 0)
+        # Neither left anything behind that would hold back bulk traffic.
+        await controller.release(await asyncio.wait_for(controller.acquire(PRIORITY_BULK), 1))
+
+    asyncio.run(scenario())
@@ -0,0 +1,245 @@
+# test_backfill.py
+import re
+import asyncio
+
+import pytest
+
+import backfill
+import fastapi_server
+from backfill import BackfillScheduler
+from results_store import ResultsStore
+
+
+class _Request:
+    def __init__(self, result):
+        self._result = result
+
+    def execute(self):
+        return self._result()
+
+
+def _parse_range(a1):
+    """'Photos'!A2:E10 -> (first_column, first_row, last_column, last_row); missing parts are None."""
+    first_col, first_row, last_col, last_row = re.fullmatch(r"([A-Z]*)(\d*)(?::([A-Z]*)(\d*))?", a1.split("!", 1)[1]).groups()
+    column = lambda letter: ord(letter) - ord("A") if letter else None
+    number = lambda digits: int(digits) if digits else None
+    return column(first_col), number(first_row), column(last_col), number(last_row)
+
+
+class FakeSheetsService:
+    """In-memory stand-in for the parts of the Sheets API the server uses on the Photos sheet."""
+
+    def __init__(self, rows):
+        self.rows = [list(fastapi_server.SHEET_HEADERS)] + [list(row) for row in rows]
+
+    def spreadsheets(self):
+        return self
+
+    def values(self):
+        return self
+
+    def get(self, spreadsheetId, range=None):
+        if range is None:
+            return _Request(lambda: {"sheets": [{"properties": {"title": fastapi_server.SHEET_NAME_FOR_KEYWORDS}}]})
+        first_col, first_row, last_col, last_row = _parse_range(range)
+        first_col = first_col or 0
+        last_col = len(fastapi_server.SHEET_HEADERS) - 1 if last_col is None else last_col
+        rows = self.rows[first_row - 1:last_row]
+        return _Request(lambda: {"values": [row[first_col:last_col + 1] for row in rows]})
+
+    def append(self, spreadsheetId, range, valueInputOption, insertDataOption, body):
+        return _Request(lambda: self.rows.extend(list(row) for row in body["values"]))
+
+    def batchUpdate(self, spreadsheetId, body):
+        def apply():
+            for update in body["data"]:
+                self.rows[_parse_range(update["range"])[1] - 1] = list(update["values"][0])
+        return _Request(apply)
+
+
+@pytest.fixture
+def sheet_server(tmp_path, monkeypatch):
+    store = ResultsStore(str(tmp_path / "results.sqlite3"))
+    sheet = FakeSheetsService([
+        ["old.jpg", "#okinawa, #naha", "Tagged before the results store.", "", ""],
+        ["known.jpg", "#eisa", "Already in the store.", "gemini-2.0-flash-lite-001", "abc"],
+        ["old.jpg", "#okinawa, #eisa", "A later row for the same file.", "", ""],
+    ])
+    monkeypatch.setattr(fastapi_server, "results_store", store)
+    monkeypatch.setattr(fastapi_server, "sheets_service", sheet)
+    monkeypatch.setattr(fastapi_server, "SPREADSHEET_ID", "spreadsheet")
+    monkeypatch.setattr(fastapi_server, "EXPORT_PAGE_ROWS", 2)
+    return store, sheet
+
+
+def test_sheet_only_results_are_seeded_as_stale(sheet_server):
+    store, _ = sheet_server
+    store.upsert("known.jpg", ["#eisa", "#sanshin"], "Current result.", "gemini-2.0-flash-lite", "v2")
+
+    fastapi_server.seed_results_from_sheet()
+
+    assert store.count_stale("v2") == 1
+    assert store.stale_filenames("v2") == ["old.jpg"]
+    seeded = store.get("old.jpg")
+    assert (seeded["keywords"], seeded["description"], seeded["tagging_version"]) == \
+        ("#okinawa, #eisa", "A later row for the same file.", None)
+    assert store.get("known.jpg")["description"] == "Current result."
+    assert [row["filename"] for page in store.iter_pages(keyword="#eisa") for row in page] == ["known.jpg", "old.jpg"]
+
+
+def test_replace_existing_overwrites_the_files_rows_instead_of_appending(sheet_server):
+    _, sheet = sheet_server
+    status = fastapi_server._log_result_to_sheet("old.jpg", ["#ryukyu"], "Re-extracted.", "model-2", "prompt-2",
+                                                 replace_existing=True)
+    assert status == {"sheets_logging_status": "updated"}
+    assert len(sheet.rows) == 4
+    assert [row for row in sheet.rows if row[0] == "old.jpg"] == [["old.jpg", "#ryukyu", "Re-extracted.", "model-2", "prompt-2"]] * 2
+
+
+def test_replace_existing_appends_when_the_file_has_no_row(sheet_server):
+    _, sheet = sheet_server
+    status = fastapi_server._log_result_to_sheet("new.jpg", ["#naha"], "First result.", replace_existing=True)
+    assert status == {"sheets_logging_status": "success"}
+    assert sheet.rows[-1] == ["new.jpg", "#naha", "First result.", "", ""]
+
+
+# --- BackfillScheduler ---
+
+@pytest.fixture
+def results(tmp_path, monkeypatch):
+    monkeypatch.setattr(backfill, "BACKFILL_BUSY_POLL_SECONDS", 0.001)
+    monkeypatch.setattr(backfill, "BACKFILL_BATCH_SIZE", 2)
+    store = ResultsStore(str(tmp_path / "results.sqlite3"))
+    for name in ("a.jpg", "b.jpg", "c.jpg", "d.jpg"):
+        store.upsert(name, ["#okinawa", "#naha"], "Old description.", "model", "v1")
+    return store
+
+
+class FakeExtractor:
+    """Stands in for the server's extraction: records the calls and stores a result at the new version."""
+
+    def __init__(self, store, version="v2", keywords=("#okinawa", "#eisa"), description="Old description."):
+        self.store = store
+        self.version = version
+        self.keywords = list(keywords)
+        self.description = description
+        self.calls = []
+        self.on_call = lambda filename: None
+
+    async def __call__(self, filename, batch_id):
+        self.calls.append((filename, batch_id))
+        self.on_call(filename)
+        self.store.upsert(filename, self.keywords, self.description, "model", self.version)
+        return {"status": "success", "keywords": self.keywords, "description": self.description,
+                "tagging_version": self.version}
+
+
+def _scheduler(tmp_path, store, extract, version, **kwargs):
+    return BackfillScheduler(str(tmp_path / "backfill.sqlite3"), store, extract, lambda: version["current"], **kwargs)
+
+
+async def _finish(scheduler):
+    if scheduler._task is not None:
+        await scheduler._task
+
+
+def test_paused_run_resumes_from_its_cursor_after_a_restart(tmp_path, results):
+    extract = FakeExtractor(results)
+    version = {"current": "v2"}
+
+    async def first_session():
+        scheduler = _scheduler(tmp_path, results, extract, version, is_busy=lambda: False)
+        extract.on_call = lambda filename: filename == "b.jpg" and scheduler.pause()
+        scheduler.start(rate_per_minute=600_000)
+        await _finish(scheduler)
+        return scheduler.latest_run()
+
+    paused = asyncio.run(first_session())
+    assert (paused["status"], paused["cursor"], paused["processed"]) == ("paused", "b.jpg", 2)
+
+    async def second_session():
+        scheduler = _scheduler(tmp_path, results, extract, version, is_busy=lambda: False)
+        extract.on_call = lambda filename: None
+        scheduler.resume()
+        await _finish(scheduler)
+        return scheduler.latest_run()
+
+    finished = asyncio.run(second_session())
+    assert [filename for filename, _ in extract.calls] == ["a.jpg", "b.jpg", "c.jpg", "d.jpg"]
+    assert {batch_id for _, batch_id in extract.calls} == {f"backfill-{finished['id']}"}
+    assert (finished["id"], finished["status"], finished["processed"]) == (paused["id"], "completed", 4)
+    assert results.count_stale("v2") == 0
+
+
+def test_a_version_change_supersedes_a_paused_run(tmp_path, results):
+    extract = FakeExtractor(results)
+    version = {"current": "v2"}
+
+    async def scenario():
+        scheduler = _scheduler(tmp_path, results, extract, version, is_busy=lambda: False)
+        extract.on_call = lambda filename: scheduler.pause()
+        scheduler.start(rate_per_minute=600_000)
+        await _finish(scheduler)
+        version["current"] = "v3"
+        extract.on_call = lambda filename: None
+        resumed = scheduler.resume()
+        await _finish(scheduler)
+        return resumed
+
+    run = asyncio.run(scenario())
+    assert run["status"] == "superseded"
+    assert run["target_version"] == "v2"
+    assert [filename for filename, _ in extract.calls] == ["a.jpg"]
+
+
+def test_waits_while_interactive_extractions_run_or_budgets_hold_it_back(tmp_path, results):
+    extract = FakeExtractor(results)
+    checks = {"busy": 0, "wait": 0}
+    seen_at_first_call = {}
+
+    def is_busy():
+        checks["busy"] += 1
+        return checks["busy"] <= 3
+
+    def wait_seconds():
+        checks["wait"] += 1
+        return 0.001 if checks["wait"] == 1 else None
+
+    async def scenario():
+        scheduler = _scheduler(tmp_path, results, extract, {"current": "v2"}, is_busy=is_busy, wait_seconds=wait_seconds)
+        extract.on_call = lambda filename: seen_at_first_call.setdefault("checks", dict(checks))
+        scheduler.start(rate_per_minute=600_000)
+        await _finish(scheduler)
+
+    asyncio.run(scenario())
+    # The first file only went out once the budget wait was over and the server was no longer busy.
+    assert seen_at_first_call["checks"]["wait"] > 1
+    assert seen_at_first_call["checks"]["busy"] > 3
+    assert len(extract.calls) == 4
+
+
+def test_records_keyword_diffs_failures_and_missing_files(tmp_path, results):
+    extract = FakeExtractor(results, keywords=["#naha", "#eisa"], description="New description.")
+    inner = extract.__call__
+
+    async def extract_with_failures(filename, batch_id):
+        if filename == "c.jpg":
+            return {"status": "error", "error": "Error: quota"}
+        if filename == "d.jpg":
+            return None
+        return await inner(filename, batch_id)
+
+    async def scenario():
+        scheduler = _scheduler(tmp_path, results, extract_with_failures, {"current": "v2"}, is_busy=lambda: False)
+        scheduler.start(rate_per_minute=600_000)
+        await _finish(scheduler)
+        return scheduler.status(diff_limit=10)
+
+    status = asyncio.run(scenario())
+    run = status["run"]
+    assert (run["processed"], run["changed"], run["failed"], run["missing"]) == (3, 2, 1, 1)
+    assert run["last_error"] == "c.jpg: Error: quota"
+    assert [diff["filename"] for diff in status["recent_diffs"]] == ["b.jpg", "a.jpg"]
+    diff = status["recent_diffs"][-1]
+    assert (diff["old_version"], diff["new_version"]) == ("v1", "v2")
+    assert (diff["added"], diff["removed"], diff["description_changed"]) == (["#eisa"], ["#okinawa"], True)
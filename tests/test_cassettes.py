@@ -0,0 +1,144 @@
+# test_cassettes.py
+import socket
+import sys
+import types
+from types import SimpleNamespace
+
+import pytest
+
+import cassettes
+import gemini_keyword_extractor
+from cassettes import CassetteMissError, CassetteStore, ReplayedError, request_key
+
+
+def _store(tmp_path, mode):
+    return CassetteStore(str(tmp_path / "cassettes.sqlite3"), mode=mode, replay_latency="zero")
+
+
+def test_record_then_replay_round_trip(tmp_path):
+    recorder = _store(tmp_path, "record")
+    key = request_key("generate", "model-a", "prompt-v1", "digest")
+    result, _ = recorder.call("gemini", key, lambda: {"keywords": ["#okinawa"]})
+    assert result == {"keywords": ["#okinawa"]}
+
+    player = _store(tmp_path, "replay")
+    replayed, latency = player.call("gemini", key, None)
+    assert replayed == {"keywords": ["#okinawa"]}
+    assert latency >= 0
+    assert player.snapshot()["replayed"] == 1
+
+
+def test_replay_serves_occurrences_in_order_then_repeats_the_last(tmp_path):
+    recorder = _store(tmp_path, "record")
+    for value in ("first", "second"):
+        recorder.call("sheets", "key", lambda: value)
+
+    player = _store(tmp_path, "replay")
+    assert [player.call("sheets", "key", None)[0] for _ in range(3)] == ["first", "second", "second"]
+
+
+def test_recorded_errors_are_raised_on_replay(tmp_path):
+    recorder = _store(tmp_path, "record")
+
+    def fail():
+        raise ValueError("quota exceeded")
+
+    with pytest.raises(ValueError):
+        recorder.call("gemini", "key", fail)
+
+    player = _store(tmp_path, "replay")
+    with pytest.raises(ReplayedError) as excinfo:
+        player.call("gemini", "key", None)
+    assert excinfo.value.error_type == "ValueError"
+    assert str(excinfo.value) == "quota exceeded"
+
+
+def test_unrecorded_request_is_a_miss(tmp_path):
+    _store(tmp_path, "record").call("gemini", "known", lambda: 1)
+    player = _store(tmp_path, "replay")
+    with pytest.raises(CassetteMissError):
+        player.call("gemini", "unknown", None)
+    assert player.snapshot()["misses"] == 1
+
+
+def test_serializers_are_applied_both_ways(tmp_path):
+    recorder = _store(tmp_path, "record")
+    recorder.call("gemini", "key", lambda: {3, 1, 2}, serialize=sorted)
+    player = _store(tmp_path, "replay")
+    assert player.call("gemini", "key", None, deserialize=set)[0] == {1, 2, 3}
+
+
+def test_request_key_is_stable_and_order_sensitive():
+    assert request_key("a", {"x": 1, "y": 2}) == request_key("a", {"y": 2, "x": 1})
+    assert request_key("a", "b") != request_key("b", "a")
+
+
+def _fake_gemini_response():
+    text = "#okinawa #naha #eisa #sanshin #ryukyu\n---DESCRIPTION---\nDancers at an Eisa festival."
+    return SimpleNamespace(
+        candidates=[SimpleNamespace(finish_reason=SimpleNamespace(name="STOP"),
+                                    content=SimpleNamespace(parts=[SimpleNamespace(text=text)]))],
+        prompt_feedback=None,
+        usage_metadata=SimpleNamespace(prompt_token_count=300, candidates_token_count=40, cached_content_token_count=0),
+        model_version="gemini-2.0-flash-lite-001",
+    )
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    """fastapi_server wired to local stand-ins, with Vertex embeddings switched on."""
+    import fastapi_server
+    from embedding_index import EmbeddingIndex, VertexMultimodalEmbeddingBackend
+    from results_store import ResultsStore
+    from storage_backends import LocalStorageBackend
+    from usage_ledger import UsageLedger
+
+    storage = LocalStorageBackend(str(tmp_path / "uploads"))
+    with open(storage.path("photo.png"), "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n" + b"\x00" * 64)
+    monkeypatch.setattr(fastapi_server, "storage", storage)
+    monkeypatch.setattr(fastapi_server, "usage_ledger", UsageLedger(str(tmp_path / "usage.sqlite3")))
+    monkeypatch.setattr(fastapi_server, "results_store", ResultsStore(str(tmp_path / "results.sqlite3")))
+    monkeypatch.setattr(fastapi_server, "sheets_service", None)
+    monkeypatch.setattr(fastapi_server, "EMBED_IMAGE_METADATA", False)
+    monkeypatch.setattr(fastapi_server, "embedding_backend", VertexMultimodalEmbeddingBackend(dimension=4))
+    monkeypatch.setattr(fastapi_server, "image_index", EmbeddingIndex(str(tmp_path / "index"), dimension=4))
+    monkeypatch.setattr(gemini_keyword_extractor, "_VERTEX_AI_INITIALIZED", True)
+    return fastapi_server
+
+
+def test_replayed_extraction_with_vertex_embeddings_opens_no_socket(server, tmp_path, monkeypatch):
+    path = str(tmp_path / "cassettes.sqlite3")
+
+    # Record against stand-ins for the SDK and the Vertex endpoints.
+    sdk = types.ModuleType("vertexai.generative_models")
+    sdk.Part = SimpleNamespace(from_data=lambda data, mime_type: (mime_type, len(data)))
+    with monkeypatch.context() as recording:
+        recording.setitem(sys.modules, "vertexai", types.ModuleType("vertexai"))
+        recording.setitem(sys.modules, "vertexai.generative_models", sdk)
+        recording.setattr(cassettes, "store", CassetteStore(path, mode="record", replay_latency="zero"))
+        recording.setattr(gemini_keyword_extractor, "_call_gemini",
+                          lambda model_id, prompt, contents: (_fake_gemini_response(), "system_instruction", "proj/region"))
+        recording.setattr(gemini_keyword_extractor, "_embed_on_endpoint", lambda endpoint, *args: [0.5, 0.5, 0.0, 0.0])
+        recorded = server.run_extraction("photo.png")
+    assert recorded["status"] == "success"
+    assert recorded["embedding_status"] == "success"
+
+    # Replay with every way out of the process shut.
+    connections = []
+
+    def refuse(sock, address, *args):
+        connections.append(address)
+        raise OSError(f"replay tried to connect to {address}")
+
+    monkeypatch.setattr(socket.socket, "connect", refuse)
+    monkeypatch.setattr(socket.socket, "connect_ex", refuse)
+    monkeypatch.setattr(cassettes, "store", CassetteStore(path, mode="replay", replay_latency="zero"))
+    monkeypatch.setattr(gemini_keyword_extractor, "_call_gemini", lambda *args: pytest.fail("Gemini called in replay"))
+    monkeypatch.setattr(gemini_keyword_extractor, "_embed_on_endpoint", lambda *args: pytest.fail("embedding called in replay"))
+    replayed = server.run_extraction("photo.png")
+
+    assert connections == []
+    assert cassettes.store.snapshot()["misses"] == 0
+    assert replayed["embedding_status"] == "success"
+    assert (replayed["keywords"], replayed["description"]) == (recorded["keywords"], recorded["description"])
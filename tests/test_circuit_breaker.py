@@ -0,0 +1,115 @@
+# test_circuit_breaker.py
+from types import SimpleNamespace
+
+import pytest
+
+import circuit_breaker
+from circuit_breaker import CircuitBreaker, CircuitOpenError, STATE_CLOSED, STATE_HALF_OPEN, STATE_OPEN
+
+
+class ServiceUnavailable(Exception):
+    pass
+
+
+class InvalidArgument(Exception):
+    pass
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(circuit_breaker, "time", SimpleNamespace(monotonic=fake))
+    return fake
+
+
+def _fail(error):
+    def func():
+        raise error
+    return func
+
+
+def _breaker(**overrides):
+    settings = dict(error_rate_threshold=0.5, window_size=4, min_calls=4, open_seconds=10,
+                    half_open_max_probes=1, half_open_successes=2)
+    settings.update(overrides)
+    return CircuitBreaker("test", **settings)
+
+
+def _trip(breaker):
+    for _ in range(4):
+        with pytest.raises(ServiceUnavailable):
+            breaker.call(_fail(ServiceUnavailable("down")))
+
+
+def test_opens_at_error_rate_and_fails_fast(clock):
+    breaker = _breaker()
+    breaker.call(lambda: "ok")
+    breaker.call(lambda: "ok")
+    for _ in range(2):
+        with pytest.raises(ServiceUnavailable):
+            breaker.call(_fail(ServiceUnavailable("down")))
+    assert breaker.snapshot()["state"] == STATE_OPEN
+    with pytest.raises(CircuitOpenError) as excinfo:
+        breaker.call(lambda: "never called")
+    assert excinfo.value.retry_after_seconds == 10
+
+
+def test_client_errors_do_not_open_the_circuit(clock):
+    breaker = _breaker()
+    for _ in range(10):
+        with pytest.raises(InvalidArgument):
+            breaker.call(_fail(InvalidArgument("corrupt image")))
+    snapshot = breaker.snapshot()
+    assert snapshot["state"] == STATE_CLOSED
+    assert snapshot["window_calls"] == 0
+    assert snapshot["ignored_errors"] == 10
+
+
+def test_half_open_probes_close_the_circuit(clock):
+    breaker = _breaker()
+    _trip(breaker)
+    clock.now += 10
+    assert breaker.call(lambda: "probe") == "probe"
+    assert breaker.snapshot()["state"] == STATE_HALF_OPEN
+    breaker.call(lambda: "probe")
+    assert breaker.snapshot()["state"] == STATE_CLOSED
+
+
+def test_failed_probe_reopens(clock):
+    breaker = _breaker()
+    _trip(breaker)
+    clock.now += 10
+    with pytest.raises(ServiceUnavailable):
+        breaker.call(_fail(ServiceUnavailable("still down")))
+    assert breaker.snapshot()["state"] == STATE_OPEN
+    assert breaker.snapshot()["times_opened"] == 2
+
+
+def test_client_error_releases_the_probe_slot(clock):
+    breaker = _breaker()
+    _trip(breaker)
+    clock.now += 10
+    with pytest.raises(InvalidArgument):
+        breaker.call(_fail(InvalidArgument("bad request")))
+    assert breaker.snapshot()["state"] == STATE_HALF_OPEN
+    assert breaker.call(lambda: "probe") == "probe"  # not rejected as "probe in flight"
+
+
+def test_slow_calls_open_the_circuit(clock):
+    breaker = _breaker(slow_call_seconds=5, slow_call_rate_threshold=0.5)
+
+    def slow():
+        clock.now += 6
+        return "slow"
+
+    for _ in range(4):
+        breaker.call(slow)
+    assert breaker.snapshot()["state"] == STATE_OPEN
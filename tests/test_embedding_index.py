@@ -0,0 +1,80 @@
+# test_embedding_index.py
+import numpy as np
+import pytest
+
+import embedding_index
+import gemini_keyword_extractor
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+from embedding_index import EmbeddingIndex, LocalHashEmbeddingBackend, VertexMultimodalEmbeddingBackend, create_backend
+
+
+def test_local_backend_is_deterministic():
+    a = LocalHashEmbeddingBackend(dimension=16)
+    b = LocalHashEmbeddingBackend(dimension=16)
+    np.testing.assert_array_equal(a.embed(b"same bytes", "image/png"), b.embed(b"same bytes", "image/png"))
+    assert not np.array_equal(a.embed(b"same bytes", "image/png"), a.embed(b"other bytes", "image/png"))
+
+
+def test_search_ranks_by_cosine_and_excludes_query(tmp_path):
+    index = EmbeddingIndex(str(tmp_path), dimension=4)
+    index.add("a.jpg", np.array([1, 0, 0, 0]))
+    index.add("b.jpg", np.array([0.9, 0.1, 0, 0]))
+    index.add("c.jpg", np.array([0, 0, 1, 0]))
+    results = index.search(np.array([1, 0, 0, 0]), k=2, exclude="a.jpg")
+    assert [name for name, _ in results] == ["b.jpg", "c.jpg"]
+
+
+def test_reembedding_masks_old_row_and_survives_reload(tmp_path):
+    index = EmbeddingIndex(str(tmp_path), dimension=4)
+    index.add("a.jpg", np.array([1, 0, 0, 0]))
+    index.add("a.jpg", np.array([0, 1, 0, 0]))
+    reloaded = EmbeddingIndex(str(tmp_path), dimension=4)
+    assert len(reloaded) == 1
+    assert reloaded.search(np.array([0, 1, 0, 0]), k=5) == [("a.jpg", 1.0)]
+
+
+def test_resident_and_memory_mapped_search_agree_as_the_index_grows(tmp_path, monkeypatch):
+    monkeypatch.setattr(embedding_index, "SEARCH_CHUNK_ROWS", 7)
+    vectors = np.random.default_rng(0).standard_normal((60, 8))
+    query = np.random.default_rng(1).standard_normal(8)
+    results = {}
+    for resident in (True, False):
+        monkeypatch.setattr(embedding_index, "RESIDENT_FLOAT32", resident)
+        index = EmbeddingIndex(str(tmp_path / str(resident)), dimension=8)
+        for i, vector in enumerate(vectors[:25]):
+            index.add(f"{i}.jpg", vector)
+        index.search(query, k=5)
+        for i, vector in enumerate(vectors[25:], start=25):
+            index.add(f"{i % 40}.jpg", vector)  # grows past the first query and re-embeds some files
+        results[resident] = index.search(query, k=5, exclude="3.jpg")
+    assert [name for name, _ in results[True]] == [name for name, _ in results[False]]
+    assert len(results[True]) == 5 and "3.jpg" not in dict(results[True])
+
+
+def test_embeddings_are_off_unless_a_backend_is_chosen():
+    assert create_backend("none") is None
+    assert not LocalHashEmbeddingBackend.billed
+    assert VertexMultimodalEmbeddingBackend.billed
+
+
+def test_vertex_backend_is_routed_over_the_endpoint_pool_and_reports_its_cost(monkeypatch):
+    served_by = []
+    monkeypatch.setattr(gemini_keyword_extractor, "_VERTEX_AI_INITIALIZED", True)
+    monkeypatch.setattr(gemini_keyword_extractor, "_embed_on_endpoint",
+                        lambda endpoint, model_name, image_bytes, dimension: served_by.append(endpoint.name) or [1.0] * dimension)
+    call_info = {}
+    vector = VertexMultimodalEmbeddingBackend(dimension=4).embed(b"image bytes", "image/png", call_info=call_info)
+    np.testing.assert_array_equal(vector, np.ones(4, dtype=np.float32))
+    assert served_by == [gemini_keyword_extractor.endpoint_pool.default.name]
+    assert call_info["calls"] == 1
+    assert call_info["estimated_cost_usd"] == gemini_keyword_extractor.EMBEDDING_PRICE_PER_IMAGE_USD
+
+
+def test_vertex_backend_fails_fast_while_the_breaker_is_open(monkeypatch):
+    breaker = CircuitBreaker("test", window_size=1, min_calls=1)
+    breaker.after_call(True, 0.0)
+    monkeypatch.setattr(gemini_keyword_extractor, "vertex_breaker", breaker)
+    monkeypatch.setattr(gemini_keyword_extractor, "_VERTEX_AI_INITIALIZED", True)
+    monkeypatch.setattr(gemini_keyword_extractor, "_embed_on_endpoint", lambda *args: pytest.fail("called while open"))
+    with pytest.raises(CircuitOpenError):
+        VertexMultimodalEmbeddingBackend(dimension=4).embed(b"image bytes", "image/png")
@@ -0,0 +1,99 @@
+# test_endpoint_pool.py
+import pytest
+
+from endpoint_pool import Endpoint, EndpointPool, parse_endpoints
+
+
+class ServiceUnavailable(Exception):
+    pass
+
+
+class ResourceExhausted(Exception):
+    pass
+
+
+class InvalidArgument(Exception):
+    pass
+
+
+def _pool(*latencies):
+    endpoints = [Endpoint("proj", f"region-{i}") for i in range(len(latencies))]
+    for endpoint, latency in zip(endpoints, latencies):
+        endpoint.latency_ewma = latency
+    return EndpointPool(endpoints, explore_rate=0.0, failover=True)
+
+
+def test_routes_to_the_lowest_latency_endpoint():
+    pool = _pool(0.9, 0.2, 0.5)
+    _, endpoint = pool.call(lambda e: e.name)
+    assert endpoint.name == "proj/region-1"
+
+
+def test_unmeasured_endpoints_are_tried_first():
+    pool = _pool(0.2, None)
+    _, endpoint = pool.call(lambda e: None)
+    assert endpoint.name == "proj/region-1"
+
+
+def test_in_flight_calls_raise_the_score():
+    pool = _pool(0.2, 0.3)
+    pool.endpoints[0].in_flight = 2
+    assert pool._ranked()[0].name == "proj/region-1"
+
+
+def test_quota_error_fails_over_and_throttles_the_endpoint():
+    pool = _pool(0.1, 0.5)
+
+    def call(endpoint):
+        if endpoint.location == "region-0":
+            raise ResourceExhausted("quota")
+        return "ok"
+
+    result, endpoint = pool.call(call)
+    assert (result, endpoint.name) == ("ok", "proj/region-1")
+    assert pool.failovers == 1
+    assert pool.endpoints[0].headroom() == 0.0
+    assert pool.endpoints[0].score() == float("inf")
+    # While throttled, the slower endpoint goes first.
+    assert pool.call(call)[1].name == "proj/region-1"
+
+
+def test_client_errors_neither_fail_over_nor_count_against_the_endpoint():
+    pool = _pool(0.1, 0.5)
+    calls = []
+
+    def call(endpoint):
+        calls.append(endpoint.name)
+        raise InvalidArgument("corrupt image")
+
+    for _ in range(10):
+        with pytest.raises(InvalidArgument):
+            pool.call(call)
+    assert set(calls) == {"proj/region-0"}
+    assert pool.failovers == 0
+    assert pool.endpoints[0].available()
+    assert pool.endpoints[0].breaker.snapshot()["window_calls"] == 0
+
+
+def test_failing_endpoint_drops_out_of_rotation():
+    pool = _pool(0.1, 0.5)
+    pool.failover = False
+    down = pool.endpoints[0]
+
+    def call(endpoint):
+        if endpoint is down:
+            raise ServiceUnavailable("down")
+        return "ok"
+
+    for _ in range(down.breaker.min_calls):
+        with pytest.raises(ServiceUnavailable):
+            pool.call(call)
+    assert not down.available()
+    assert pool.call(call) == ("ok", pool.endpoints[1])
+
+
+def test_parse_endpoints():
+    endpoints = parse_endpoints("a/us-central1@300, b/europe-west4")
+    assert [(e.name, e.requests_per_minute) for e in endpoints] == [("a/us-central1", 300), ("b/europe-west4", None)]
+    with pytest.raises(ValueError):
+        parse_endpoints("missing-location")
@@ -0,0 +1,253 @@
+# test_gemini_keyword_extractor.py
+import sys
+import types
+import threading
+from types import SimpleNamespace
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import gemini_keyword_extractor
+import keyword_normalizer
+from circuit_breaker import CircuitBreaker
+from endpoint_pool import Endpoint, EndpointPool
+from keyword_normalizer import KeywordNormalizer
+
+
+@pytest.fixture
+def model_cache(monkeypatch):
+    monkeypatch.setattr(gemini_keyword_extractor, "_model_cache", {})
+    monkeypatch.setattr(gemini_keyword_extractor, "_model_build_locks", {})
+    builds = []
+    release = {}
+
+    def build(model_id, prompt, endpoint):
+        builds.append((model_id, prompt))
+        if prompt in release:
+            assert release[prompt].wait(5)
+        return {"model": f"{model_id}:{prompt}", "mode": "system_instruction", "expires_at": None}
+
+    monkeypatch.setattr(gemini_keyword_extractor, "_build_model", build)
+    return builds, release
+
+
+def test_a_slow_build_only_holds_up_callers_of_the_same_model(model_cache):
+    builds, release = model_cache
+    endpoint = Endpoint("proj", "us-central1")
+    get = gemini_keyword_extractor._get_model
+    get("flash", "fast prompt", endpoint)
+    release["slow prompt"] = threading.Event()
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        slow = [pool.submit(get, "flash", "slow prompt", endpoint) for _ in range(3)]
+        # Served from the cache while the other key is still building.
+        assert pool.submit(get, "flash", "fast prompt", endpoint).result(timeout=2)["model"] == "flash:fast prompt"
+        assert pool.submit(get, "pro", "fast prompt", endpoint).result(timeout=2)["model"] == "pro:fast prompt"
+        release["slow prompt"].set()
+        assert {future.result(timeout=5)["model"] for future in slow} == {"flash:slow prompt"}
+    assert builds.count(("flash", "slow prompt")) == 1
+
+
+def test_a_new_prompt_version_replaces_the_old_entry(model_cache):
+    endpoint = Endpoint("proj", "us-central1")
+    gemini_keyword_extractor._get_model("flash", "prompt v1", endpoint)
+    gemini_keyword_extractor._get_model("flash", "prompt v2", endpoint)
+    assert [key[1] for key in gemini_keyword_extractor._model_cache] == [gemini_keyword_extractor._prompt_version("prompt v2")]
+
+
+# --- Cascade keyword counting ---
+
+def _response(keywords):
+    text = " ".join(keywords) + "\n---DESCRIPTION---\nShuri Castle lit up at night."
+    return SimpleNamespace(
+        candidates=[SimpleNamespace(finish_reason=SimpleNamespace(name="STOP"),
+                                    content=SimpleNamespace(parts=[SimpleNamespace(text=text)]))],
+        prompt_feedback=None,
+        usage_metadata=SimpleNamespace(prompt_token_count=300, candidates_token_count=40, cached_content_token_count=0),
+        model_version="tier-0-001",
+    )
+
+
+@pytest.fixture
+def cascade(monkeypatch):
+    sdk = types.ModuleType("vertexai.generative_models")
+    sdk.Part = SimpleNamespace(from_data=lambda data, mime_type: (mime_type, len(data)))
+    monkeypatch.setitem(sys.modules, "vertexai", types.ModuleType("vertexai"))
+    monkeypatch.setitem(sys.modules, "vertexai.generative_models", sdk)
+    monkeypatch.setattr(gemini_keyword_extractor, "_VERTEX_AI_INITIALIZED", True)
+    monkeypatch.setattr(gemini_keyword_extractor, "MODEL_CASCADE", ["tier-0", "tier-1"])
+    monkeypatch.setattr(gemini_keyword_extractor, "get_prompt_token_count", lambda model_id, prompt: 0)
+    monkeypatch.setattr(keyword_normalizer, "normalizer", KeywordNormalizer({"#shuri_castle": ["shuri castle"],
+                                                                             "#naha": ["naha city"]}))
+    responses = {}
+    monkeypatch.setattr(gemini_keyword_extractor, "_generate",
+                        lambda model_id, prompt, contents, key: (responses[model_id], 0.1, "system_instruction", "proj/region"))
+    return responses
+
+
+def test_compound_expansion_neither_escalates_nor_exceeds_the_keyword_cap(cascade):
+    given = ["#ShuriCastleAtNight", "#NahaCityLights"] + [f"#tag{i}" for i in range(23)]
+    cascade["tier-0"] = _response(given)
+    cascade["tier-1"] = _response(["#unused"] * 5)
+    call_info = {}
+    keywords, description, error = gemini_keyword_extractor.generate_keywords_and_description(b"image", "image/png",
+                                                                                            call_info=call_info)
+    assert error is None and call_info["escalations"] == [] and call_info["model_id"] == "tier-0"
+    assert len(keywords) == 25
+    assert keywords[:2] == ["#shuricastleatnight", "#nahacitylights"]
+
+
+def test_expansion_fills_room_under_the_cap_and_the_count_is_of_given_tags(cascade):
+    cascade["tier-0"] = _response(["#ShuriCastleAtNight", "#sunset", "#Sunset", "#lanterns"])  # 3 distinct tags: too few
+    cascade["tier-1"] = _response(["#ShuriCastleAtNight", "#sunset", "#lanterns", "#stone_walls", "#gate"])
+    call_info = {}
+    keywords, _, error = gemini_keyword_extractor.generate_keywords_and_description(b"image", "image/png", call_info=call_info)
+    assert call_info["escalations"] == [{"model_id": "tier-0", "reasons": ["keyword_count_3"]}]
+    assert keywords == ["#shuricastleatnight", "#shuri_castle", "#sunset", "#lanterns", "#stone_walls", "#gate"]
+
+
+# --- Prompt token counting ---
+
+@pytest.fixture
+def token_counts(monkeypatch):
+    monkeypatch.setattr(gemini_keyword_extractor, "_prompt_token_cache", {})
+    monkeypatch.setattr(gemini_keyword_extractor, "endpoint_pool", EndpointPool([Endpoint("proj", "us-central1")], explore_rate=0.0))
+    breaker = CircuitBreaker("test", window_size=1, min_calls=1)
+    monkeypatch.setattr(gemini_keyword_extractor, "vertex_breaker", breaker)
+    calls = []
+    monkeypatch.setattr(gemini_keyword_extractor, "_count_tokens_on_endpoint",
+                        lambda endpoint, model_id, prompt: calls.append(endpoint.name) or 321)
+    return calls, breaker
+
+
+def test_prompt_tokens_are_counted_over_the_endpoint_pool_once(token_counts):
+    calls, breaker = token_counts
+    assert gemini_keyword_extractor.get_prompt_token_count("flash", "the prompt") == 321
+    assert gemini_keyword_extractor.get_prompt_token_count("flash", "the prompt") == 321
+    assert calls == ["proj/us-central1"]
+    assert breaker.snapshot()["state"] == "closed"
+
+
+def test_an_open_breaker_estimates_without_calling_or_caching(token_counts, monkeypatch):
+    calls, breaker = token_counts
+    breaker.after_call(True, 0.0)
+    assert gemini_keyword_extractor.get_prompt_token_count("flash", "x" * 400) == 100
+    assert calls == []
+    monkeypatch.setattr(gemini_keyword_extractor, "vertex_breaker", CircuitBreaker("test"))  # recovered
+    assert gemini_keyword_extractor.get_prompt_token_count("flash", "x" * 400) == 321
+    assert calls == ["proj/us-central1"]
+
+
+# --- Hedged requests ---
+
+class _FakeModel:
+    """Runs one scripted behaviour per generate_content call, in call order."""
+
+    def __init__(self, *behaviours):
+        self.behaviours = list(behaviours)
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def generate_content(self, contents):
+        with self._lock:
+            behaviour = self.behaviours[self.calls]
+            self.calls += 1
+        return behaviour()
+
+
+def _after(event, result):
+    def behaviour():
+        assert event.wait(5)
+        if isinstance(result, Exception):
+            raise result
+        return result
+    return behaviour
+
+
+def _fail(message, then_release):
+    def behaviour():
+        then_release.set()  # the other attempt finishes only after this one has failed
+        raise RuntimeError(message)
+    return behaviour
+
+
+@pytest.fixture
+def hedging(monkeypatch):
+    monkeypatch.setattr(gemini_keyword_extractor, "HEDGING_ENABLED", True)
+    monkeypatch.setattr(gemini_keyword_extractor, "HEDGE_MIN_SAMPLES", 4)
+    monkeypatch.setattr(gemini_keyword_extractor, "HEDGE_MIN_DELAY_SECONDS", 0.01)
+    monkeypatch.setattr(gemini_keyword_extractor, "HEDGE_BUDGET_PERCENT", 50)
+    monkeypatch.setattr(gemini_keyword_extractor, "_recent_latencies", deque([0.02] * 4, maxlen=100))
+    metrics = {"calls": 10, "hedges_triggered": 0, "hedges_won": 0, "hedges_skipped_budget": 0}
+    monkeypatch.setattr(gemini_keyword_extractor, "_hedge_metrics", metrics)
+    release = threading.Event()
+    yield metrics, release
+    release.set()  # let any still-blocked primary finish
+
+
+def test_hedge_delay_needs_history_and_has_a_floor(monkeypatch):
+    monkeypatch.setattr(gemini_keyword_extractor, "HEDGE_MIN_SAMPLES", 3)
+    monkeypatch.setattr(gemini_keyword_extractor, "HEDGE_PERCENTILE", 50)
+    monkeypatch.setattr(gemini_keyword_extractor, "HEDGE_MIN_DELAY_SECONDS", 0.5)
+    monkeypatch.setattr(gemini_keyword_extractor, "_recent_latencies", deque([1.0, 3.0], maxlen=10))
+    assert gemini_keyword_extractor._hedge_delay() is None
+    gemini_keyword_extractor._recent_latencies.append(2.0)
+    assert gemini_keyword_extractor._hedge_delay() == 2.0
+    gemini_keyword_extractor._recent_latencies.extend([0.1, 0.1, 0.1, 0.1])
+    assert gemini_keyword_extractor._hedge_delay() == 0.5
+
+
+def test_hedges_are_capped_at_the_budget_percent(hedging):
+    metrics, _ = hedging
+    metrics["calls"] = 4  # 50% of 4 calls: two hedges
+    assert [gemini_keyword_extractor._try_reserve_hedge() for _ in range(3)] == [True, True, False]
+    assert (metrics["hedges_triggered"], metrics["hedges_skipped_budget"]) == (2, 1)
+
+
+def test_the_first_attempt_to_finish_wins(hedging):
+    metrics, release = hedging
+    model = _FakeModel(_after(release, "primary"), lambda: "hedge")
+    assert gemini_keyword_extractor._call_gemini_hedged(model, ["image"]) == "hedge"
+    assert model.calls == 2
+    assert (metrics["hedges_triggered"], metrics["hedges_won"]) == (1, 1)
+
+
+def test_a_failed_hedge_falls_back_to_the_primary(hedging):
+    metrics, release = hedging
+    model = _FakeModel(_after(release, "primary"), _fail("hedge down", release))
+    assert gemini_keyword_extractor._call_gemini_hedged(model, ["image"]) == "primary"
+    assert (metrics["hedges_triggered"], metrics["hedges_won"]) == (1, 0)
+
+
+def test_a_failed_primary_falls_back_to_the_hedge(hedging):
+    metrics, release = hedging
+    hedge_done = threading.Event()
+    model = _FakeModel(_after(release, RuntimeError("primary down")), _after(hedge_done, "hedge"))
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        call = pool.submit(gemini_keyword_extractor._call_gemini_hedged, model, ["image"])
+        while model.calls < 2:
+            threading.Event().wait(0.005)
+        release.set()  # the primary fails first...
+        threading.Event().wait(0.05)
+        assert not call.done()  # ...and the hedge is still awaited
+        hedge_done.set()
+        assert call.result(timeout=5) == "hedge"
+    assert metrics["hedges_won"] == 1
+
+
+def test_both_attempts_failing_raises(hedging):
+    _, release = hedging
+    model = _FakeModel(_after(release, RuntimeError("primary down")), _fail("hedge down", release))
+    with pytest.raises(RuntimeError):
+        gemini_keyword_extractor._call_gemini_hedged(model, ["image"])
+
+
+def test_no_hedge_once_the_budget_is_spent(hedging):
+    metrics, release = hedging
+    metrics["hedges_triggered"] = 5  # already 50% of the calls
+    model = _FakeModel(_after(release, "primary"), lambda: "hedge")
+    threading.Timer(0.1, release.set).start()  # well past the 0.02s hedge delay
+    assert gemini_keyword_extractor._call_gemini_hedged(model, ["image"]) == "primary"
+    assert model.calls == 1
+    assert (metrics["hedges_triggered"], metrics["hedges_skipped_budget"]) == (5, 1)
@@ -0,0 +1,143 @@
+# test_image_metadata.py
+import io
+import os
+import struct
+
+import pytest
+from PIL import Image
+
+import image_metadata
+from image_metadata import (MAX_JPEG_SEGMENT_PAYLOAD, IPTC_KEYWORD_MAX_BYTES, PHOTOSHOP_APP13_HEADER, XMP_APP1_HEADER,
+                            read_embedded_tags_from_header, write_embedded_tags)
+
+PROBE_BYTES = 256 * 1024  # METADATA_PROBE_BYTES in fastapi_server.py
+
+
+def _jpeg(path, icc_profile=None, exif=True):
+    image = Image.new("RGB", (64, 48), (200, 120, 40))
+    options = {"quality": 90}
+    if icc_profile is not None:
+        options["icc_profile"] = icc_profile
+    if exif:
+        tags = Image.Exif()
+        tags[0x0112] = 1  # Orientation
+        options["exif"] = tags.tobytes()
+    image.save(path, "JPEG", **options)
+    return path
+
+
+def _png(path):
+    image = Image.new("RGB", (64, 48), (10, 200, 90))
+    image.save(path, "PNG", icc_profile=os.urandom(300_000))
+    return path
+
+
+def _jpeg_markers(data):
+    """The marker codes of the header segments, in order."""
+    stream = io.BytesIO(data)
+    return [code for code, _ in image_metadata._iter_jpeg_header_segments(stream, lambda code, prefix: False)]
+
+
+def _jpeg_scan(data):
+    return data[data.index(b"\xff\xda"):]
+
+
+def _png_from_idat(data):
+    return data[data.index(b"IDAT") - 4:]
+
+
+def _probe(path):
+    with open(path, "rb") as f:
+        return read_embedded_tags_from_header(f.read(PROBE_BYTES))
+
+
+def test_jpeg_tags_round_trip_without_touching_the_scan(tmp_path):
+    path = _jpeg(str(tmp_path / "photo.jpg"))
+    original = open(path, "rb").read()
+    assert _probe(path) is None
+
+    assert write_embedded_tags(path, ["#okinawa", "#eisa"], "Dancers & drums <live>.", "model@v1") is None
+    written = open(path, "rb").read()
+    assert _probe(path) == {"tagging_version": "model@v1", "keywords": ["#okinawa", "#eisa"],
+                            "description": "Dancers & drums <live>."}
+    assert _jpeg_scan(written) == _jpeg_scan(original)
+    assert Image.open(path).tobytes() == Image.open(io.BytesIO(original)).tobytes()
+
+
+def test_jpeg_packet_goes_before_a_large_icc_profile(tmp_path):
+    path = _jpeg(str(tmp_path / "phone.jpg"), icc_profile=os.urandom(400_000))  # ~7 APP2 chunks
+    assert write_embedded_tags(path, ["#naha"], "Harbour.", "model@v1") is None
+    data = open(path, "rb").read()
+    markers = _jpeg_markers(data)
+    assert markers[:4] == [0xE0, 0xE1, 0xE1, 0xED]  # JFIF, Exif, then our XMP and IPTC
+    assert 0xE2 in markers[4:]
+    assert len(data) > PROBE_BYTES
+    assert _probe(path)["keywords"] == ["#naha"]
+
+
+def test_rewriting_replaces_the_xmp_and_iptc_blocks(tmp_path):
+    path = _jpeg(str(tmp_path / "photo.jpg"))
+    # An unrelated IRB resource (e.g. Photoshop's resolution info) must survive.
+    other_resource = image_metadata._build_irb_resources([(0x03ED, b"\x00\x00", b"resolution")])
+    with open(path, "rb") as f:
+        data = f.read()
+    app13 = image_metadata._jpeg_segment(0xED, PHOTOSHOP_APP13_HEADER + other_resource)
+    with open(path, "wb") as f:
+        f.write(data[:2] + app13 + data[2:])
+
+    write_embedded_tags(path, ["#old"], "First.", "model@v1")
+    original_scan = _jpeg_scan(open(path, "rb").read())
+    write_embedded_tags(path, ["#new", "#tags"], "Second.", "model@v2")
+    data = open(path, "rb").read()
+    assert data.count(XMP_APP1_HEADER) == 1
+    assert data.count(PHOTOSHOP_APP13_HEADER) == 1
+    assert b"First." not in data and b">old<" not in data
+    segments = list(image_metadata._iter_jpeg_header_segments(io.BytesIO(data), lambda code, prefix: code == 0xED))
+    irb = image_metadata._parse_irb_resources(next(p for c, p in segments if c == 0xED)[len(PHOTOSHOP_APP13_HEADER):])
+    assert [resource_id for resource_id, _, _ in irb] == [0x03ED, image_metadata.IPTC_IRB_RESOURCE_ID]
+    assert _probe(path)["tagging_version"] == "model@v2"
+    assert _jpeg_scan(data) == original_scan
+
+
+def test_oversized_xmp_is_refused_and_the_file_left_alone(tmp_path):
+    path = _jpeg(str(tmp_path / "photo.jpg"))
+    original = open(path, "rb").read()
+    error = write_embedded_tags(path, ["#tag"], "x" * (MAX_JPEG_SEGMENT_PAYLOAD + 1), "model@v1")
+    assert error is not None and "too large" in error
+    assert open(path, "rb").read() == original
+    assert [name for name in os.listdir(tmp_path)] == ["photo.jpg"]  # no temporary file left behind
+
+
+def test_iptc_values_are_truncated_on_utf8_boundaries():
+    block = image_metadata.build_iptc_block(["#" + "琉" * 30], "説" * 1000)
+    keyword = block[block.index(b"\x1c\x02\x19") + 5:block.index(b"\x1c\x02\x78")]
+    assert len(keyword) <= IPTC_KEYWORD_MAX_BYTES and keyword.decode("utf-8") == "琉" * 21
+    (caption_length,) = struct.unpack(">H", block[block.index(b"\x1c\x02\x78") + 3:][:2])
+    assert caption_length <= image_metadata.IPTC_CAPTION_MAX_BYTES
+
+
+def test_png_tags_round_trip_ahead_of_a_large_icc_profile(tmp_path):
+    path = _png(str(tmp_path / "scan.png"))
+    original = open(path, "rb").read()
+    assert write_embedded_tags(path, ["#shuri_castle"], "Gate.", "model@v1") is None
+    assert write_embedded_tags(path, ["#shuri_castle", "#night"], "Gate at night.", "model@v2") is None
+    data = open(path, "rb").read()
+    assert data.count(image_metadata.PNG_XMP_KEYWORD) == 1
+    assert data.index(b"iTXt") < data.index(b"iCCP")
+    assert len(data) > PROBE_BYTES
+    assert _probe(path) == {"tagging_version": "model@v2", "keywords": ["#shuri_castle", "#night"],
+                            "description": "Gate at night."}
+    assert _png_from_idat(data) == _png_from_idat(original)
+    assert Image.open(path).tobytes() == Image.open(io.BytesIO(original)).tobytes()
+
+
+def test_unsupported_and_corrupt_files_are_reported_not_rewritten(tmp_path):
+    gif = tmp_path / "anim.gif"
+    Image.new("P", (4, 4)).save(gif, "GIF")
+    assert "Unsupported format" in write_embedded_tags(str(gif), ["#a"], None, "v1")
+    truncated = tmp_path / "cut.jpg"
+    truncated.write_bytes(open(_jpeg(str(tmp_path / "whole.jpg")), "rb").read()[:40])
+    before = truncated.read_bytes()
+    assert write_embedded_tags(str(truncated), ["#a"], None, "v1") is not None
+    assert truncated.read_bytes() == before
+    assert read_embedded_tags_from_header(b"not an image") is None
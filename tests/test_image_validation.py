@@ -0,0 +1,98 @@
+# test_image_validation.py
+import numpy as np
+import pytest
+from PIL import Image
+
+import image_validation
+from image_validation import ImageValidationError, estimate_decoded_bytes, validate_and_normalize
+
+
+def _gradient(width=40, height=20):
+    x = np.linspace(0, 255, width, dtype=np.uint8)
+    y = np.linspace(0, 255, height, dtype=np.uint8)[:, None]
+    return Image.fromarray(np.dstack([np.broadcast_to(x, (height, width)), np.broadcast_to(y, (height, width)),
+                                      np.full((height, width), 128, np.uint8)]))
+
+
+@pytest.fixture(autouse=True)
+def restore_pil_limit(monkeypatch):
+    # validate_and_normalize sets PIL's global bomb limit; keep it from leaking between tests.
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", Image.MAX_IMAGE_PIXELS)
+
+
+def test_rejects_empty_and_truncated_files(tmp_path):
+    empty = tmp_path / "empty.jpg"
+    empty.write_bytes(b"")
+    with pytest.raises(ImageValidationError, match="empty"):
+        validate_and_normalize(str(empty))
+
+    _gradient(400, 300).save(tmp_path / "full.jpg", quality=90)
+    data = (tmp_path / "full.jpg").read_bytes()
+    truncated = tmp_path / "truncated.jpg"
+    truncated.write_bytes(data[:len(data) // 2])
+    with pytest.raises(ImageValidationError, match="corrupt or truncated"):
+        validate_and_normalize(str(truncated))
+
+
+def test_rejects_unrecognized_content_whatever_the_extension(tmp_path):
+    fake = tmp_path / "photo.jpg"
+    fake.write_bytes(b"<html>not an image</html>")
+    with pytest.raises(ImageValidationError, match="not a recognized"):
+        validate_and_normalize(str(fake))
+
+
+def test_renames_a_file_whose_content_does_not_match_its_extension(tmp_path):
+    _gradient().save(tmp_path / "photo.jpg", format="PNG")
+    original = (tmp_path / "photo.jpg").read_bytes()
+    result = validate_and_normalize(str(tmp_path / "photo.jpg"))
+    assert (result["mime_type"], result["renamed"], result["converted_from"]) == ("image/png", True, None)
+    assert result["path"] == str(tmp_path / "photo.png")
+    assert (tmp_path / "photo.png").read_bytes() == original
+    assert not (tmp_path / "photo.jpg").exists()
+
+
+def test_rejects_decompression_bombs(tmp_path, monkeypatch):
+    monkeypatch.setattr(image_validation, "MAX_IMAGE_PIXELS", 100)
+    _gradient(40, 20).save(tmp_path / "bomb.png")  # 800 pixels, more than twice the limit
+    with pytest.raises(ImageValidationError, match="too large"):
+        validate_and_normalize(str(tmp_path / "bomb.png"))
+
+
+def test_applies_exif_orientation(tmp_path):
+    exif = Image.Exif()
+    exif[0x0112] = 6  # stored sideways: rotate 90 degrees clockwise to display
+    _gradient(40, 20).save(tmp_path / "sideways.jpg", quality=95, exif=exif.tobytes())
+    result = validate_and_normalize(str(tmp_path / "sideways.jpg"))
+    assert result["orientation_applied"] and (result["width"], result["height"]) == (20, 40)
+    with Image.open(result["path"]) as img:
+        assert img.size == (20, 40)
+        assert img.getexif().get(0x0112) == 1
+
+
+@pytest.mark.parametrize("pil_format, name", [("TIFF", "scan.tif"), ("BMP", "scan.bmp")])
+def test_converts_formats_vertex_rejects_to_png(tmp_path, pil_format, name):
+    image = _gradient()
+    image.save(tmp_path / name, format=pil_format)
+    result = validate_and_normalize(str(tmp_path / name))
+    assert (result["mime_type"], result["converted_from"]) == ("image/png", pil_format)
+    assert result["path"] == str(tmp_path / "scan.png") and not (tmp_path / name).exists()
+    with Image.open(result["path"]) as img:
+        assert img.format == "PNG"
+        assert np.array_equal(np.asarray(img.convert("RGB")), np.asarray(image))
+
+
+@pytest.mark.parametrize("pil_format, name, mime_type", [("TIFF", "pages.tif", "image/tiff"), ("GIF", "pages.gif", "image/gif")])
+def test_multi_page_files_are_kept_as_uploaded(tmp_path, pil_format, name, mime_type):
+    pages = [_gradient().rotate(angle) for angle in (0, 90, 180)]
+    pages[0].save(tmp_path / name, format=pil_format, save_all=True, append_images=pages[1:])
+    original = (tmp_path / name).read_bytes()
+    result = validate_and_normalize(str(tmp_path / name))
+    assert (result["mime_type"], result["pages"], result["converted_from"], result["renamed"]) == (mime_type, 3, None, False)
+    assert (tmp_path / name).read_bytes() == original
+
+
+def test_estimates_decoded_size_from_the_header(tmp_path):
+    _gradient(40, 20).save(tmp_path / "photo.jpg")
+    assert estimate_decoded_bytes(str(tmp_path / "photo.jpg")) == 2 * 40 * 20 * 3
+    (tmp_path / "doc.pdf").write_bytes(b"%PDF-1.7\n" + b"\x00" * 100)
+    assert estimate_decoded_bytes(str(tmp_path / "doc.pdf")) == 0
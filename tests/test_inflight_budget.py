@@ -0,0 +1,114 @@
+# test_inflight_budget.py
+import asyncio
+
+import pytest
+
+from inflight_budget import BudgetExhaustedError, InflightBytesBudget
+
+
+async def _settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_waits_until_a_release_makes_room():
+    async def scenario():
+        budget = InflightBytesBudget(100, wait_timeout_seconds=5)
+        await budget.acquire(70)
+        waiter = asyncio.create_task(budget.acquire(50))
+        await _settle()
+        assert not waiter.done() and budget.waiting == 1
+        await budget.acquire(30)  # fits beside the first reservation, so it doesn't wait
+        await budget.release(70)
+        await asyncio.wait_for(waiter, 1)
+        return budget.snapshot()
+
+    snapshot = asyncio.run(scenario())
+    assert (snapshot["current_bytes"], snapshot["peak_bytes"], snapshot["admitted"], snapshot["waiting_requests"]) == (80, 100, 3, 0)
+
+
+def test_times_out_with_retry_after():
+    async def scenario():
+        budget = InflightBytesBudget(100, wait_timeout_seconds=0.01, retry_after_seconds=7)
+        await budget.acquire(80)
+        with pytest.raises(BudgetExhaustedError) as error:
+            await budget.acquire(30)
+        return budget, error.value
+
+    budget, error = asyncio.run(scenario())
+    assert (error.requested, error.retry_after_seconds) == (30, 7)
+    assert (budget.rejected, budget.waiting, budget.current_bytes) == (1, 0, 80)
+
+
+def test_an_oversized_request_is_admitted_only_when_idle():
+    async def scenario():
+        budget = InflightBytesBudget(100, wait_timeout_seconds=5)
+        await budget.acquire(250)  # nothing in flight: admitted even though it exceeds the limit
+        small = asyncio.create_task(budget.acquire(10))
+        await _settle()
+        assert not small.done()
+        await budget.release(250)
+        await asyncio.wait_for(small, 1)
+        oversized = asyncio.create_task(budget.acquire(250))
+        await _settle()
+        assert not oversized.done()  # waits for the 10 bytes to drain
+        await budget.release(10)
+        await asyncio.wait_for(oversized, 1)
+        return budget.snapshot()
+
+    snapshot = asyncio.run(scenario())
+    assert (snapshot["current_bytes"], snapshot["peak_bytes"]) == (250, 250)
+
+
+def test_cancelled_requests_release_their_bytes_and_their_place():
+    async def scenario():
+        budget = InflightBytesBudget(100, wait_timeout_seconds=5)
+        holding = asyncio.Event()
+
+        async def upload(nbytes):
+            async with budget.reserve(nbytes):
+                holding.set()
+                await asyncio.sleep(60)
+
+        running = asyncio.create_task(upload(80))
+        await holding.wait()
+        waiting = asyncio.create_task(upload(50))
+        await _settle()
+        assert budget.waiting == 1
+
+        waiting.cancel()  # client went away while waiting for room
+        running.cancel()  # client went away mid-upload
+        await asyncio.gather(waiting, running, return_exceptions=True)
+        assert (budget.current_bytes, budget.waiting) == (0, 0)
+        await asyncio.wait_for(budget.acquire(100), 1)
+
+    asyncio.run(scenario())
+
+
+def test_videos_reserve_decoded_frames_not_file_size(tmp_path, monkeypatch):
+    import fastapi_server as server
+    import media_expansion
+    from storage_backends import LocalStorageBackend
+
+    storage = LocalStorageBackend(str(tmp_path))
+    with open(tmp_path / "clip.mp4", "wb") as f:  # sparse 2 GB mp4: only the header is written
+        f.write(b"\x00\x00\x00\x18ftypisom\x00\x00\x02\x00isomiso2")
+        f.truncate(2 * 1024 ** 3)
+    with open(tmp_path / "photo.jpg", "wb") as f:
+        f.write(b"\xff\xd8\xff\xe0" + b"\x00" * 996)
+    budget = InflightBytesBudget(256 * 1024 * 1024, wait_timeout_seconds=0.05)
+    monkeypatch.setattr(server, "storage", storage)
+    monkeypatch.setattr(server, "inflight_budget", budget)
+    monkeypatch.setattr(media_expansion, "MEDIA_EXPANSION_ENABLED", True)
+    reserved = []
+    monkeypatch.setattr(server, "run_extraction", lambda name, *args: reserved.append(budget.current_bytes) or {"filename": name})
+
+    async def scenario():
+        await budget.acquire(128 * 1024 * 1024)  # other requests hold half the budget
+        await server._coalesced_extraction("clip.mp4")
+        await server._coalesced_extraction("photo.jpg")
+
+    asyncio.run(scenario())
+    held = 128 * 1024 * 1024
+    assert reserved == [held + media_expansion.reservation_bytes(), held + int(1000 * server.EXTRACTION_MEMORY_FACTOR)]
+    assert budget.rejected == 0
@@ -0,0 +1,91 @@
+# test_keyword_normalizer.py
+import json
+
+from keyword_normalizer import KeywordNormalizer, PhraseAutomaton, tokenize
+
+VOCABULARY = {
+    "#okinawa": ["okinawan", "okinawa prefecture"],
+    "#shuri_castle": ["shuri castle", "shurijo", "shuri-jo"],
+    "#naha": ["naha city"],
+    "#ryukyu": ["ryūkyū", "ryukyu kingdom"],
+}
+
+
+def test_tokenize_splits_separators_and_camel_case():
+    assert tokenize("#ShuriCastleAtNight") == ("shuri", "castle", "at", "night")
+    assert tokenize("#shuri-jo") == ("shuri", "jo")
+    assert tokenize("#NAHA_city") == ("naha", "city")
+    assert tokenize("#ＲＹＵＫＹＵ") == ("ryukyu",)  # NFKC folds full-width letters
+
+
+def test_aliases_map_onto_the_canonical_tag():
+    normalizer = KeywordNormalizer(VOCABULARY)
+    assert normalizer.normalize_keyword("#Okinawan") == "#okinawa"
+    assert normalizer.normalize_keyword("#ShuriCastle") == "#shuri_castle"
+    assert normalizer.normalize_keyword("#shuri-jo") == "#shuri_castle"
+    assert normalizer.normalize_keyword("#Ryūkyū") == "#ryukyu"
+    assert normalizer.normalize_keyword("#Sunset") == "#sunset"
+    assert normalizer.normalize_keywords(["#Okinawa", "#okinawan", "#OKINAWA"]) == ["#okinawa"]
+
+
+def test_compound_tags_add_the_vocabulary_terms_they_contain():
+    normalizer = KeywordNormalizer(VOCABULARY)
+    assert normalizer.normalize_keywords(["#ShuriCastleAtNight", "#sunset"]) == \
+        ["#shuricastleatnight", "#shuri_castle", "#sunset"]
+    assert normalizer.normalize_keywords(["#ShuriCastleAtNight"], expand=False) == ["#shuricastleatnight"]
+    assert normalizer.find_terms("A night view of Shuri Castle above Naha City") == ["#shuri_castle", "#naha"]
+
+
+def test_a_limit_drops_expanded_terms_before_given_keywords():
+    normalizer = KeywordNormalizer(VOCABULARY)
+    given = ["#ShuriCastleAtNight", "#NahaCityLights"] + [f"#tag{i}" for i in range(22)]
+    keywords = normalizer.normalize_keywords(given, limit=25)
+    assert len(keywords) == 25
+    assert keywords[:3] == ["#shuricastleatnight", "#shuri_castle", "#nahacitylights"]
+    assert "#naha" not in keywords and keywords[-1] == "#tag21"
+    # A term that is also given as a keyword of its own is never dropped as an expansion.
+    assert normalizer.normalize_keywords(["#ShuriCastleAtNight", "#a", "#ShuriCastle"], limit=2) == \
+        ["#shuricastleatnight", "#shuri_castle"]
+    # Over the limit with given keywords alone: the first ones are kept.
+    assert normalizer.normalize_keywords([f"#tag{i}" for i in range(30)], limit=25)[-1] == "#tag24"
+
+
+def test_hashtags_are_found_in_model_output():
+    normalizer = KeywordNormalizer(VOCABULARY)
+    text = "#Okinawa, #shuri-jo; #ryūkyū・kingdom #b&w (#Naha.) 「#夕日」、#sunset..."
+    assert normalizer.find_hashtags(text) == ["#Okinawa", "#shuri-jo", "#ryūkyū・kingdom", "#b&w", "#Naha", "#夕日", "#sunset"]
+    assert normalizer.extract_keywords(text) == \
+        ["#okinawa", "#shuri_castle", "#ryūkyū・kingdom", "#ryukyu", "#b&w", "#naha", "#夕日", "#sunset"]
+
+
+def test_keyword_strings_are_renormalized():
+    normalizer = KeywordNormalizer(VOCABULARY)
+    assert normalizer.normalize_keyword_string("#Okinawa, #okinawan ,#Naha City") == "#okinawa, #naha"
+
+
+def test_phrase_automaton_prefers_leftmost_longest_matches():
+    automaton = PhraseAutomaton({("shuri",): "#shuri", ("shuri", "castle"): "#shuri_castle", ("castle", "park"): "#park"})
+    assert automaton.find(("shuri", "castle", "park")) == [(0, 2, "#shuri_castle")]
+    assert automaton.find(("old", "castle", "park", "shuri")) == [(1, 3, "#park"), (3, 4, "#shuri")]
+
+
+def test_vocabulary_file_is_loaded_on_first_use(tmp_path):
+    path = tmp_path / "vocabulary.json"
+    path.write_text(json.dumps(VOCABULARY), encoding="utf-8")
+    normalizer = KeywordNormalizer(path=str(path))
+    assert normalizer.vocabulary_size == 0
+    assert normalizer.normalize_keyword("#Naha City") == "#naha"
+    assert normalizer.vocabulary_size == len(VOCABULARY)
+
+
+def test_missing_or_broken_vocabulary_only_folds(tmp_path):
+    assert KeywordNormalizer(path=str(tmp_path / "missing.json")).normalize_keyword("#Okinawan") == "#okinawan"
+    broken = tmp_path / "broken.json"
+    broken.write_text("{not json", encoding="utf-8")
+    assert KeywordNormalizer(path=str(broken)).normalize_keyword("#ShuriCastle") == "#shuricastle"
+
+
+def test_shipped_vocabulary_loads():
+    normalizer = KeywordNormalizer()
+    assert normalizer.normalize_keyword("#ShuriJo") == "#shuri_castle"
+    assert normalizer.vocabulary_size > 0
@@ -0,0 +1,57 @@
+# test_media_expansion.py
+import io
+
+import numpy as np
+from PIL import Image
+
+import media_expansion
+from media_expansion import merge_descriptions, merge_keywords, select_representative
+
+
+def _pattern(seed):
+    return np.random.default_rng(seed).random((32, 32), dtype=np.float32)
+
+
+def test_drops_blank_and_duplicate_frames():
+    blank = np.zeros((32, 32), dtype=np.float32)
+    scene = _pattern(1)
+    near_duplicate = np.clip(scene + 0.01, 0, 1)
+    selection = select_representative([blank, scene, near_duplicate, _pattern(2)], max_frames=8)
+    assert selection["indices"] == [1, 3]
+    assert (selection["dropped_blank"], selection["dropped_duplicate"], selection["dropped_over_limit"]) == (1, 1, 0)
+
+
+def test_keeps_the_most_distinct_frames_when_over_the_limit():
+    base = _pattern(1)
+    slightly_different = np.clip(base + 0.1, 0, 1)
+    very_different = 1.0 - base
+    selection = select_representative([base, slightly_different, very_different], max_frames=2)
+    assert selection["indices"] == [0, 2]
+    assert selection["dropped_over_limit"] == 1
+
+
+def test_all_blank_asset_still_gets_one_frame():
+    blank = np.zeros((32, 32), dtype=np.float32)
+    selection = select_representative([blank, blank])
+    assert selection["indices"] == [0]
+
+
+def test_expand_multi_page_tiff(tmp_path):
+    pages = [Image.fromarray((_pattern(seed) * 255).astype(np.uint8)).resize((200, 100)).convert("RGB") for seed in (1, 1, 2)]
+    path = tmp_path / "scan.tif"
+    pages[0].save(path, save_all=True, append_images=pages[1:])
+    assert media_expansion.needs_expansion(str(path), "image/tiff")
+    expansion = media_expansion.expand(str(path), "image/tiff")
+    assert expansion["candidates"] == 3
+    assert [frame["label"] for frame in expansion["frames"]] == ["page 1", "page 3"]
+    assert Image.open(io.BytesIO(expansion["frames"][0]["jpeg"])).format == "JPEG"
+
+
+def test_merge_keywords_ranks_by_frame_count():
+    merged = merge_keywords([["#sea", "#boat"], ["#boat", "#boat", "#sky"], ["#sky", "#boat"]])
+    assert merged == ["#boat", "#sky", "#sea"]
+
+
+def test_merge_descriptions_labels_and_dedupes():
+    merged = merge_descriptions([("page 1", "A harbour."), ("page 2", "A harbour."), ("page 3", "A castle.")])
+    assert merged == "[page 1] A harbour. [page 3] A castle."
@@ -0,0 +1,129 @@
+# test_request_coalescing.py
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import request_coalescing
+from request_coalescing import IdempotencyCache, SingleFlight
+
+
+class ExtractionFailed(Exception):
+    pass
+
+
+async def _settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_concurrent_calls_for_a_key_share_one_run():
+    async def scenario():
+        flight = SingleFlight("extract")
+        release = asyncio.Event()
+        runs = []
+
+        async def work(key):
+            runs.append(key)
+            await release.wait()
+            return f"result for {key}"
+
+        calls = [asyncio.create_task(flight.do(key, lambda key=key: work(key))) for key in ("a.jpg", "a.jpg", "a.jpg", "b.jpg")]
+        await _settle()
+        release.set()
+        results = await asyncio.gather(*calls)
+        again = await flight.do("a.jpg", lambda: work("a.jpg"))  # forgotten once finished
+        return flight, runs, results, again
+
+    flight, runs, results, again = asyncio.run(scenario())
+    assert runs == ["a.jpg", "b.jpg", "a.jpg"]
+    assert results == [("result for a.jpg", False), ("result for a.jpg", True), ("result for a.jpg", True),
+                       ("result for b.jpg", False)]
+    assert again == ("result for a.jpg", False)
+    assert flight.snapshot() == {"in_flight": 0, "leaders": 3, "coalesced_followers": 2}
+
+
+def test_an_exception_reaches_every_caller():
+    async def scenario():
+        flight = SingleFlight("extract")
+        release = asyncio.Event()
+
+        async def work():
+            await release.wait()
+            raise ExtractionFailed("quota")
+
+        calls = [asyncio.create_task(flight.do("a.jpg", work)) for _ in range(3)]
+        await _settle()
+        release.set()
+        return await asyncio.gather(*calls, return_exceptions=True), flight
+
+    errors, flight = asyncio.run(scenario())
+    assert [type(e) for e in errors] == [ExtractionFailed] * 3
+    assert len({id(e) for e in errors}) == 1
+    assert flight.snapshot()["in_flight"] == 0
+
+
+def test_a_cancelled_caller_does_not_cancel_the_shared_work():
+    async def scenario():
+        flight = SingleFlight("extract")
+        release = asyncio.Event()
+        finished = []
+
+        async def work():
+            await release.wait()
+            finished.append(True)
+            return "tags"
+
+        leader = asyncio.create_task(flight.do("a.jpg", work))
+        await _settle()
+        follower = asyncio.create_task(flight.do("a.jpg", work))
+        await _settle()
+        leader.cancel()  # the caller that started the work disconnects
+        await asyncio.gather(leader, return_exceptions=True)
+        release.set()
+        return leader, await follower, finished
+
+    leader, followed, finished = asyncio.run(scenario())
+    assert leader.cancelled()
+    assert followed == ("tags", True)
+    assert finished == [True]
+
+
+# --- IdempotencyCache ---
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(request_coalescing, "time", SimpleNamespace(monotonic=fake))
+    return fake
+
+
+def test_entries_expire_after_the_ttl(clock):
+    cache = IdempotencyCache(ttl_seconds=60, max_entries=10)
+    cache.put("key-1", {"status": "success"})
+    clock.now += 59
+    assert cache.get("key-1") == {"status": "success"}
+    clock.now += 1
+    assert cache.get("key-1") is None
+    assert cache.snapshot()["entries"] == 0
+    cache.put("key-1", {"status": "retried"})  # storing again restarts the TTL
+    assert cache.get("key-1") == {"status": "retried"}
+
+
+def test_the_least_recently_used_entry_is_evicted(clock):
+    cache = IdempotencyCache(ttl_seconds=60, max_entries=2)
+    cache.put("key-1", {"n": 1})
+    cache.put("key-2", {"n": 2})
+    assert cache.get("key-1") == {"n": 1}  # key-2 is now the least recently used
+    cache.put("key-3", {"n": 3})
+    assert cache.get("key-2") is None
+    assert (cache.get("key-1"), cache.get("key-3")) == ({"n": 1}, {"n": 3})
+    assert cache.snapshot() == {"entries": 2, "hits": 3, "stores": 3, "ttl_seconds": 60}
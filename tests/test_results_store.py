@@ -0,0 +1,118 @@
+# test_results_store.py
+import asyncio
+import json
+
+import pytest
+from fastapi import HTTPException
+
+import fastapi_server
+import keyword_normalizer
+import results_store
+from keyword_normalizer import KeywordNormalizer
+from results_store import ResultsStore, normalize_date_bound
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    store = ResultsStore(str(tmp_path / "results.sqlite3"))
+    # Written around midnight UTC, which is already the next day in Japan.
+    for filename, updated_at, keywords in [
+        ("a.jpg", "2025-05-31T23:30:00.000000Z", ["#naha"]),
+        ("b.jpg", "2025-06-01T00:00:00.000000Z", ["#naha", "#eisa"]),
+        ("c.jpg", "2025-06-01T14:59:59.999999Z", ["#eisa"]),
+        ("d.jpg", "2025-06-01T23:59:59.999999Z", ["#shuri_castle"]),
+        ("e.jpg", "2025-06-02T00:00:00.000000Z", ["#naha"]),
+    ]:
+        monkeypatch.setattr(results_store, "_now", lambda updated_at=updated_at: updated_at)
+        store.upsert(filename, keywords, f"{filename} description", "model", "v1")
+    return store
+
+
+def _filenames(pages):
+    return [row["filename"] for page in pages for row in page]
+
+
+def test_date_bounds_are_parsed_and_normalized_to_utc():
+    assert normalize_date_bound("2025-06-01") == "2025-06-01T00:00:00.000000Z"
+    assert normalize_date_bound("2025-06-01", upper=True) == "2025-06-02T00:00:00.000000Z"
+    assert normalize_date_bound("2025-06-01T09:00:00+09:00") == "2025-06-01T00:00:00.000000Z"
+    assert normalize_date_bound("2025-06-01T09:00:00Z", upper=True) == "2025-06-01T09:00:00.000000Z"
+    assert normalize_date_bound("2025-06-01 09:00") == "2025-06-01T09:00:00.000000Z"  # naive means UTC
+    with pytest.raises(ValueError):
+        normalize_date_bound("June 1st")
+
+
+def test_a_bare_date_range_covers_whole_utc_days(store):
+    assert _filenames(store.iter_pages(date_from="2025-06-01", date_to="2025-06-01")) == ["b.jpg", "c.jpg", "d.jpg"]
+    assert _filenames(store.iter_pages(date_from="2025-06-02")) == ["e.jpg"]
+    assert _filenames(store.iter_pages(date_to="2025-05-31")) == ["a.jpg"]
+
+
+def test_datetime_bounds_compare_in_utc_whatever_the_offset(store):
+    # 2025-06-01 00:00 to 24:00 in Japan is 2025-05-31T15:00Z to 2025-06-01T15:00Z (exclusive).
+    japan_day = store.iter_pages(date_from="2025-06-01T00:00:00+09:00", date_to="2025-06-02T00:00:00+09:00")
+    assert _filenames(japan_day) == ["a.jpg", "b.jpg", "c.jpg"]
+    assert _filenames(store.iter_pages(date_from="2025-06-01T23:59:59.999999Z")) == ["d.jpg", "e.jpg"]
+    assert _filenames(store.iter_pages(date_to="2025-06-01T00:00:00Z")) == ["a.jpg"]
+
+
+def test_dates_combine_with_the_keyword_filter(store):
+    assert _filenames(store.iter_pages(date_from="2025-06-01", keyword="#naha")) == ["b.jpg", "e.jpg"]
+
+
+def test_pages_follow_the_change_cursor_and_resume_after_it(store):
+    pages = list(store.iter_pages(page_size=2))
+    assert [[row["filename"] for row in page] for page in pages] == [["a.jpg", "b.jpg"], ["c.jpg", "d.jpg"], ["e.jpg"]]
+    assert [row["cursor"] for page in pages for row in page] == [1, 2, 3, 4, 5]
+
+    snapshot = store.current_cursor()
+    store.upsert("b.jpg", ["#okinawa"], "Re-extracted.", "model", "v2")
+    store.upsert("f.jpg", ["#okinawa"], "New.", "model", "v2")
+    # The pinned snapshot doesn't see later writes; the next incremental export gets only them.
+    assert _filenames(store.iter_pages(until_cursor=snapshot, page_size=2)) == ["a.jpg", "c.jpg", "d.jpg", "e.jpg"]
+    changed = list(store.iter_pages(since_cursor=snapshot, page_size=1))
+    assert [(row["filename"], row["cursor"]) for page in changed for row in page] == [("b.jpg", 6), ("f.jpg", 7)]
+    assert list(store.iter_pages(since_cursor=store.current_cursor())) == []
+    assert _filenames(store.iter_pages(keyword="#naha")) == ["a.jpg", "e.jpg"]
+
+
+def test_export_rejects_unparseable_dates_with_422():
+    with pytest.raises(HTTPException) as error:
+        fastapi_server._parse_export_date("2025-13-01", "date_from")
+    assert error.value.status_code == 422
+    assert fastapi_server._parse_export_date("2025-06-01", "date_to", upper=True) == "2025-06-02T00:00:00.000000Z"
+
+
+def _export(**params):
+    async def collect():
+        response = await fastapi_server.export_results(export_format="jsonl", source="results", since=params.get("since"),
+                                                       date_from=None, date_to=None, keyword=params.get("keyword"))
+        return response, b"".join([chunk async for chunk in response.body_iterator])
+
+    response, body = asyncio.run(collect())
+    return int(response.headers["X-Export-Cursor"]), body.decode("utf-8").splitlines()
+
+
+def test_renormalize_rewrites_stored_results_and_exports_see_it(store, monkeypatch):
+    # Results were tagged before the vocabulary learned that "okinawan" means #okinawa.
+    store.upsert("f.jpg", ["#okinawan", "#naha"], "Naha at dusk.", "model", "v1")
+    store.upsert("g.jpg", ["#okinawa", "#Okinawan"], "Coastline.", "model", "v1")
+    normalizer = KeywordNormalizer({})
+    monkeypatch.setattr(normalizer, "load_vocabulary_file", lambda: normalizer.load_vocabulary({"#okinawa": ["okinawan"]}))
+    monkeypatch.setattr(keyword_normalizer, "normalizer", normalizer)
+    monkeypatch.setattr(fastapi_server, "results_store", store)
+    monkeypatch.setattr(fastapi_server, "sheets_service", None)
+    before, _ = _export()
+
+    dry_run = asyncio.run(fastapi_server.renormalize_keywords(dry_run=True))
+    assert dry_run["results_store"]["rows_changed"] == 2 and store.current_cursor() == before
+    stats = asyncio.run(fastapi_server.renormalize_keywords(dry_run=False))["results_store"]
+    assert (stats["rows_scanned"], stats["rows_changed"], stats["keywords_before"], stats["keywords_after"]) == (7, 2, 10, 9)
+
+    cursor, changed = _export(since=before)
+    assert cursor == before + 2
+    assert [(row["filename"], row["keywords"]) for row in map(json.loads, changed)] == [("f.jpg", "#okinawa, #naha"),
+                                                                                       ("g.jpg", "#okinawa")]
+    _, tagged = _export(keyword="#okinawan")  # the filter normalizes too, and the keyword index was rebuilt
+    assert sorted(json.loads(line)["filename"] for line in tagged) == ["f.jpg", "g.jpg"]
+    assert list(store.iter_pages(keyword="#okinawan")) == []  # the old spelling is gone from the index
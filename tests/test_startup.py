@@ -0,0 +1,54 @@
+# test_startup.py
+import os
+import sys
+import json
+import subprocess
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+# Runs in a fresh interpreter: records every socket connection and every Sheets/GCS client
+# built while fastapi_server is imported. Vertex AI is only checked for being imported or
+# initialized, since importing its SDK to instrument it would itself be the cost under test.
+_CHILD_CODE = r"""
+import json, socket, sys
+attempts = []
+
+def _record(kind, original):
+    def wrapper(*args, **kwargs):
+        attempts.append(kind)
+        return original(*args, **kwargs)
+    return wrapper
+
+socket.socket.connect = _record("socket.connect", socket.socket.connect)
+socket.socket.connect_ex = _record("socket.connect_ex", socket.socket.connect_ex)
+socket.create_connection = _record("socket.create_connection", socket.create_connection)
+socket.getaddrinfo = _record("socket.getaddrinfo", socket.getaddrinfo)
+try:
+    from googleapiclient import discovery
+    discovery.build = _record("sheets.build", discovery.build)
+except ImportError:
+    pass
+try:
+    from google.cloud import storage
+    storage.Client.__init__ = _record("gcs.Client", storage.Client.__init__)
+except ImportError:
+    pass
+
+import fastapi_server
+import gemini_keyword_extractor
+print("STARTUP_RESULT " + json.dumps({
+    "attempts": attempts,
+    "vertexai_imported": "vertexai" in sys.modules,
+    "vertex_initialized": gemini_keyword_extractor._VERTEX_AI_INITIALIZED,
+    "clients": [name for name in ("sheets_service", "storage", "results_store", "usage_ledger", "embedding_backend")
+                if getattr(fastapi_server, name) is not None],
+}))
+"""
+
+
+def test_importing_the_server_opens_no_connections_and_builds_no_clients():
+    completed = subprocess.run([sys.executable, "-c", _CHILD_CODE], cwd=SRC_DIR, capture_output=True, text=True, timeout=120)
+    assert completed.returncode == 0, completed.stderr
+    line = next(line for line in completed.stdout.splitlines() if line.startswith("STARTUP_RESULT "))
+    result = json.loads(line[len("STARTUP_RESULT "):])
+    assert result == {"attempts": [], "vertexai_imported": False, "vertex_initialized": False, "clients": []}
@@ -0,0 +1,220 @@
+# test_storage_backends.py
+import os
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import storage_backends
+from storage_backends import GCSStorageBackend, LocalStorageBackend
+
+exceptions = pytest.importorskip("google.api_core.exceptions")
+
+
+def _stage(storage, name, data):
+    path = storage.staging_path(name)
+    with open(path, "wb") as f:
+        f.write(data)
+    return path
+
+
+def test_staged_upload_is_hidden_until_committed(tmp_path):
+    storage = LocalStorageBackend(str(tmp_path))
+    staged = _stage(storage, "photo.jpg", b"jpeg bytes")
+    assert not storage.exists("photo.jpg")
+    assert storage.commit_staged(staged, "photo.jpg") == "photo.jpg"
+    assert storage.exists("photo.jpg")
+    assert not os.path.exists(staged)
+
+
+def test_commit_never_overwrites_an_existing_file(tmp_path):
+    storage = LocalStorageBackend(str(tmp_path))
+    storage.commit_staged(_stage(storage, "photo.jpg", b"first"), "photo.jpg")
+    assert storage.commit_staged(_stage(storage, "photo.jpg", b"second"), "photo.jpg") == "photo_1.jpg"
+    assert storage.read_header("photo.jpg", 100) == b"first"
+    assert storage.read_header("photo_1.jpg", 100) == b"second"
+
+
+def test_concurrent_uploads_of_one_name_get_distinct_files(tmp_path):
+    storage = LocalStorageBackend(str(tmp_path))
+
+    def upload(i):
+        return storage.commit_staged(_stage(storage, "race.png", f"upload {i}".encode()), "race.png")
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        names = list(pool.map(upload, range(8)))
+    assert len(set(names)) == 8
+    assert sorted(storage.read_header(name, 100) for name in names) == sorted(f"upload {i}".encode() for i in range(8))
+
+
+def test_discarded_upload_leaves_nothing_behind(tmp_path):
+    storage = LocalStorageBackend(str(tmp_path))
+    staged = _stage(storage, "bad.jpg", b"not an image")
+    storage.discard_staged(staged)
+    assert not storage.exists("bad.jpg")
+    assert os.listdir(storage.staging_directory) == []
+
+
+# --- GCS backend against an in-memory bucket (injected through client=) ---
+
+class FakeBlob:
+    """The subset of google.cloud.storage.Blob the backend uses, with generation preconditions enforced."""
+
+    def __init__(self, bucket, name, generation=None):
+        self.bucket = bucket
+        self.name = name
+        self.generation = generation
+        self.content_type = None
+
+    def _check(self, if_generation_match):
+        current = self.bucket.objects.get(self.name)
+        if if_generation_match is not None and (current["generation"] if current else 0) != if_generation_match:
+            raise exceptions.PreconditionFailed(f"{self.name}: generation does not match {if_generation_match}")
+
+    def _store(self, data, if_generation_match):
+        with self.bucket.lock:
+            self._check(if_generation_match)
+            self.bucket.generations += 1
+            self.bucket.objects[self.name] = {"data": data, "generation": self.bucket.generations}
+
+    @property
+    def size(self):
+        return len(self.bucket.objects[self.name]["data"])
+
+    @property
+    def md5_hash(self):
+        return hashlib.md5(self.bucket.objects[self.name]["data"]).hexdigest()
+
+    def exists(self):
+        return self.name in self.bucket.objects
+
+    def upload_from_filename(self, path, if_generation_match=None):
+        with open(path, "rb") as f:
+            self._store(f.read(), if_generation_match)
+
+    def compose(self, sources, if_generation_match=None):
+        self._store(b"".join(self.bucket.objects[source.name]["data"] for source in sources), if_generation_match)
+
+    def download_to_filename(self, path, if_generation_match=None):
+        with self.bucket.lock:
+            self._check(if_generation_match)
+            data = self.bucket.objects[self.name]["data"]
+        with open(path, "wb") as f:
+            f.write(data)
+
+    def download_as_bytes(self, start=0, end=None):
+        return self.bucket.objects[self.name]["data"][start:None if end is None else end + 1]
+
+    def delete(self):
+        del self.bucket.objects[self.name]
+
+    def generate_signed_url(self, version, expiration, method):
+        return f"https://signed.example/{self.bucket.name}/{self.name}?v={version}&ttl={int(expiration.total_seconds())}&m={method}"
+
+
+class FakeBucket:
+    def __init__(self, name):
+        self.name = name
+        self.objects = {}
+        self.generations = 0
+        self.lock = threading.Lock()
+
+    def blob(self, name):
+        return FakeBlob(self, name)
+
+    def get_blob(self, name):
+        current = self.objects.get(name)
+        return FakeBlob(self, name, current["generation"]) if current else None
+
+    def put(self, name, data):
+        self.blob(name)._store(data, None)
+
+
+class FakeClient:
+    def __init__(self):
+        self.buckets = {}
+
+    def bucket(self, name):
+        return self.buckets.setdefault(name, FakeBucket(name))
+
+
+@pytest.fixture
+def gcs(tmp_path, monkeypatch):
+    monkeypatch.delenv("STORAGE_EMULATOR_HOST", raising=False)
+    client = FakeClient()
+    return GCSStorageBackend("photos", client=client, staging_directory=str(tmp_path / "staging")), client.bucket("photos")
+
+
+def test_gcs_commit_is_create_only_under_concurrency(gcs):
+    storage, bucket = gcs
+    bucket.put("race.png", b"already there")
+
+    def upload(i):
+        return storage.commit_staged(_stage(storage, "race.png", f"upload {i}".encode()), "race.png")
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        names = list(pool.map(upload, range(8)))
+    assert len(set(names)) == 8 and "race.png" not in names
+    assert bucket.objects["race.png"]["data"] == b"already there"
+    assert sorted(bucket.objects[name]["data"] for name in names) == sorted(f"upload {i}".encode() for i in range(8))
+    assert os.listdir(storage.staging_directory) == []
+
+
+def test_gcs_large_upload_composes_with_the_precondition(gcs, monkeypatch):
+    storage, bucket = gcs
+    from google.cloud.storage import transfer_manager
+    monkeypatch.setattr(storage_backends, "GCS_PARALLEL_UPLOAD_THRESHOLD_BYTES", 1)
+    monkeypatch.setattr(transfer_manager, "upload_chunks_concurrently",
+                        lambda path, blob, **kwargs: blob.upload_from_filename(path))
+    bucket.put("scan.tif", b"first")
+    assert storage.commit_staged(_stage(storage, "scan.tif", b"second"), "scan.tif") == "scan_1.tif"
+    assert bucket.objects["scan.tif"]["data"] == b"first"
+    assert set(bucket.objects) == {"scan.tif", "scan_1.tif"}  # the private part object is gone
+
+
+def test_gcs_local_copy_writes_back_only_the_downloaded_generation(gcs):
+    storage, bucket = gcs
+    bucket.put("photo.jpg", b"original")
+
+    with storage.local_copy("photo.jpg", writeback=True) as path:
+        with open(path, "ab") as f:
+            f.write(b" + tags")
+    assert bucket.objects["photo.jpg"]["data"] == b"original + tags"
+
+    with storage.local_copy("photo.jpg", writeback=True) as path:
+        bucket.put("photo.jpg", b"rewritten by someone else")
+        with open(path, "ab") as f:
+            f.write(b" + stale tags")
+    assert bucket.objects["photo.jpg"]["data"] == b"rewritten by someone else"
+    assert os.listdir(storage.staging_directory) == []
+
+
+def test_gcs_unchanged_local_copy_is_not_uploaded(gcs):
+    storage, bucket = gcs
+    bucket.put("photo.jpg", b"original")
+    generation = bucket.objects["photo.jpg"]["generation"]
+    with storage.local_copy("photo.jpg", writeback=True) as path:
+        assert open(path, "rb").read() == b"original"
+    assert bucket.objects["photo.jpg"]["generation"] == generation
+
+
+def test_gcs_header_reads_and_content_hash(gcs):
+    storage, bucket = gcs
+    bucket.put("photo.jpg", b"0123456789")
+    assert storage.read_header("photo.jpg", 4) == b"0123"
+    assert storage.size("photo.jpg") == 10
+    assert storage.content_hash("photo.jpg") == hashlib.md5(b"0123456789").hexdigest()
+    with pytest.raises(FileNotFoundError):
+        storage.content_hash("missing.jpg")
+
+
+def test_gcs_signed_urls(tmp_path, monkeypatch):
+    monkeypatch.delenv("STORAGE_EMULATOR_HOST", raising=False)
+    storage = GCSStorageBackend("photos", client=FakeClient(), staging_directory=str(tmp_path / "staging"))
+    assert storage.signed_url("a b.jpg") == \
+        f"https://signed.example/photos/a b.jpg?v=v4&ttl={storage_backends.SIGNED_URL_TTL_SECONDS}&m=GET"
+
+    monkeypatch.setenv("STORAGE_EMULATOR_HOST", "http://localhost:4443/")
+    emulated = GCSStorageBackend("photos", client=FakeClient(), staging_directory=str(tmp_path / "staging"))
+    assert emulated.signed_url("a b.jpg") == "http://localhost:4443/download/storage/v1/b/photos/o/a%20b.jpg?alt=media"
@@ -0,0 +1,100 @@
+# test_structured_logging.py
+import sys
+import json
+import queue
+import logging
+
+import pytest
+
+import structured_logging
+from structured_logging import JsonFormatter, Lazy, RequestContextFilter, _DeferredQueueHandler, truncate
+
+
+def _record(level=logging.INFO, msg="Saved %s.", args=("photo.jpg",), exc_info=None, **extra):
+    record = logging.LogRecord("omi.test", level, __file__, 1, msg, args, exc_info)
+    record.__dict__.update(extra)
+    return record
+
+
+@pytest.fixture
+def logger():
+    """An unregistered logger feeding only a queue handler (pytest's capture handlers would format every record)."""
+    handler = _DeferredQueueHandler(queue.Queue(10))
+    handler.addFilter(RequestContextFilter(debug_sample_rate=0.5))
+    test_logger = logging.Logger("omi.test", logging.DEBUG)
+    test_logger.addHandler(handler)
+    return test_logger, handler
+
+
+def test_json_lines_carry_request_id_extras_and_exceptions():
+    token = structured_logging.set_request_id("req-42")
+    try:
+        record = _record(batch_id="b-1", bytes=2048)
+        RequestContextFilter().filter(record)
+    finally:
+        structured_logging.reset_request_id(token)
+    entry = json.loads(JsonFormatter().format(record))
+    assert (entry["level"], entry["logger"], entry["request_id"], entry["message"]) == ("INFO", "omi.test", "req-42", "Saved photo.jpg.")
+    assert (entry["batch_id"], entry["bytes"]) == ("b-1", 2048)
+    assert entry["ts"].endswith("Z") and "exc_info" not in entry
+
+    try:
+        raise KeyError("missing")
+    except KeyError:
+        failed = _record(level=logging.ERROR, msg="Failed.", args=(), exc_info=sys.exc_info())
+    entry = json.loads(JsonFormatter().format(failed))
+    assert entry["request_id"] is None
+    assert "KeyError: 'missing'" in entry["exc_info"]
+
+
+def test_debug_sampling_is_all_or_nothing_per_request_id():
+    log_filter = RequestContextFilter(debug_sample_rate=0.5)
+    kept = {}
+    for n in range(200):
+        request_id = f"req-{n}"
+        token = structured_logging.set_request_id(request_id)
+        try:
+            decisions = {log_filter.filter(_record(level=logging.DEBUG)) for _ in range(3)}
+            assert log_filter.filter(_record(level=logging.INFO))  # never sampled out
+        finally:
+            structured_logging.reset_request_id(token)
+        assert len(decisions) == 1  # the same answer for every line of a request
+        kept[request_id] = decisions.pop()
+    assert 60 < sum(kept.values()) < 140
+    # Deterministic: a fresh filter makes the same choice for the same request ID.
+    again = RequestContextFilter(debug_sample_rate=0.5)
+    token = structured_logging.set_request_id("req-7")
+    try:
+        assert again.filter(_record(level=logging.DEBUG)) == kept["req-7"]
+    finally:
+        structured_logging.reset_request_id(token)
+
+
+def test_lazy_arguments_are_not_built_unless_the_line_is_written(logger):
+    test_logger, handler = logger
+    built = []
+
+    def expensive():
+        built.append(1)
+        return "x" * 1000
+
+    info_logger = logging.Logger("omi.test.info", logging.INFO)
+    info_logger.addHandler(handler)
+    info_logger.debug("Raw response: %s", Lazy(expensive))  # level disabled
+    handler.filters[0].debug_sample_rate = 0.0
+    test_logger.debug("Raw response: %s", truncate(Lazy(expensive), 10))  # sampled out
+    handler.filters[0].debug_sample_rate = 1.0
+    test_logger.debug("Raw response: %s", truncate(Lazy(expensive), 10))  # enqueued, not yet formatted
+    assert built == [] and handler.queue.qsize() == 1
+
+    record = handler.queue.get_nowait()
+    assert record.getMessage() == "Raw response: " + "x" * 10 + "... (1000 chars)"
+    assert built == [1]
+
+
+def test_a_full_queue_drops_and_counts_instead_of_blocking(logger):
+    test_logger, handler = logger
+    for n in range(15):
+        test_logger.warning("Line %s", n)
+    assert (handler.queue.qsize(), handler.dropped) == (10, 5)
+    assert [handler.queue.get_nowait().getMessage() for _ in range(10)] == [f"Line {n}" for n in range(10)]
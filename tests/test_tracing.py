@@ -0,0 +1,154 @@
+# test_tracing.py
+import asyncio
+import contextvars
+import threading
+
+import pytest
+
+import tracing
+from tracing import SamplingProfiler, SlowRequestStore, Trace, span, trace_request
+
+
+@pytest.fixture(autouse=True)
+def isolated_tracing(monkeypatch):
+    monkeypatch.setattr(tracing, "TRACING_ENABLED", True)
+    monkeypatch.setattr(tracing, "_exporter", None)
+    monkeypatch.setattr(tracing, "slow_requests", SlowRequestStore())
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def __call__(self):
+        return self.now
+
+
+def _trace(name, duration_ms):
+    trace = Trace(name)
+    trace.add({"span_id": "root", "parent_id": None, "name": name, "start_ns": 0, "duration_ms": duration_ms,
+               "attributes": {}, "error": None})
+    return trace
+
+
+def test_keeps_the_slowest_of_each_window():
+    clock = FakeClock()
+    store = SlowRequestStore(capacity=2, window_seconds=60, windows=3, clock=clock)
+    for duration in (5, 50, 20):
+        store.offer(_trace("POST /extract", duration))
+    clock.now += 60
+    store.offer(_trace("GET /photos", 1))
+    assert [e["duration_ms"] for e in store.slowest()] == [50, 20, 1]
+    assert [e["duration_ms"] for e in store.slowest(limit=1)] == [50]
+    assert [e["duration_ms"] for e in store.slowest(name="GET /photos")] == [1]
+    assert [e["duration_ms"] for e in store.slowest(within_seconds=30)] == [1]
+
+
+def test_a_slow_start_up_ages_out_so_recent_requests_show():
+    clock = FakeClock()
+    store = SlowRequestStore(capacity=2, window_seconds=60, windows=3, clock=clock)
+    for _ in range(5):
+        store.offer(_trace("POST /extract", 30_000))  # cold start
+    clock.now += 3 * 60
+    store.offer(_trace("POST /extract", 800))
+    assert [e["duration_ms"] for e in store.slowest()] == [800]
+    clock.now += 3 * 60
+    assert store.slowest() == []
+
+
+def test_the_slowest_replace_faster_ones_once_a_window_is_full():
+    clock = FakeClock()
+    store = SlowRequestStore(capacity=3, window_seconds=60, windows=2, clock=clock)
+    for duration in (10, 40, 30, 5, 60, 20):
+        store.offer(_trace("POST /extract", duration))
+    assert [e["duration_ms"] for e in store.slowest()] == [60, 40, 30]
+    clock.now += 60
+    store.offer(_trace("POST /extract", 35))
+    assert [e["duration_ms"] for e in store.slowest(limit=2)] == [60, 40]
+    clock.now += 60  # the first window is now two windows old
+    assert [e["duration_ms"] for e in store.slowest()] == [35]
+
+
+def test_spans_nest_and_record_errors():
+    with trace_request("GET /photos", "req-1") as trace:
+        with span("outer", stage=1):
+            with span("inner") as attributes:
+                attributes["rows"] = 3
+        with pytest.raises(ValueError):
+            with span("failing"):
+                raise ValueError("boom")
+    spans = {s["name"]: s for s in trace.to_dict()["spans"]}
+    assert spans["GET /photos"]["parent_id"] is None
+    assert spans["outer"]["parent_id"] == spans["GET /photos"]["span_id"]
+    assert spans["inner"]["parent_id"] == spans["outer"]["span_id"]
+    assert (spans["outer"]["attributes"], spans["inner"]["attributes"]) == ({"stage": 1}, {"rows": 3})
+    assert (spans["failing"]["parent_id"], spans["failing"]["error"]) == (spans["GET /photos"]["span_id"], "ValueError")
+    assert [e["request_id"] for e in tracing.slow_requests.slowest()] == ["req-1"]
+
+
+def test_spans_outside_a_request_are_no_ops():
+    with span("startup") as attributes:
+        attributes["ok"] = True
+    assert tracing._current_trace.get() is None and tracing.slow_requests.slowest() == []
+
+
+def test_the_trace_follows_the_request_into_to_thread_workers():
+    def read_file():
+        with span("storage.read", backend="local"):
+            tracing.set_attribute("filename", "photo.jpg")
+            return threading.get_ident()
+
+    async def handler():
+        with trace_request("POST /extract") as trace:
+            with span("extraction"):
+                worker = await asyncio.to_thread(read_file)
+        return trace, worker
+
+    trace, worker = asyncio.run(handler())
+    spans = {s["name"]: s for s in trace.to_dict()["spans"]}
+    assert worker != threading.get_ident()
+    assert spans["storage.read"]["parent_id"] == spans["extraction"]["span_id"]
+    assert trace.to_dict()["attributes"]["filename"] == "photo.jpg"
+    assert trace.active_thread_ids() == []
+
+
+def test_the_profiler_samples_only_threads_inside_the_trace_spans():
+    stop = threading.Event()
+    started = threading.Barrier(4)
+
+    def spin():
+        while not stop.is_set():
+            sum(range(100))
+
+    def traced_work():
+        with span("work"):
+            started.wait()
+            spin()
+
+    def untraced_work():
+        with span("earlier_work"):
+            pass
+        started.wait()  # a pooled worker that has moved on from this request
+        spin()
+
+    def other_request_work():
+        with trace_request("GET /other"):
+            started.wait()
+            spin()
+
+    with trace_request("POST /extract") as trace:
+        threads = [threading.Thread(target=contextvars.copy_context().run, args=(target,))
+                   for target in (traced_work, untraced_work)]
+        threads.append(threading.Thread(target=other_request_work))
+        with SamplingProfiler(trace, interval=0.002) as profiler:
+            for thread in threads:
+                thread.start()
+            started.wait()
+            stop.wait(0.2)
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+    folded = profiler.result()["folded_stacks"]
+    assert profiler.samples > 0 and "traced_work" in folded
+    assert "untraced_work" not in folded and "other_request_work" not in folded
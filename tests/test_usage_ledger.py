@@ -0,0 +1,123 @@
+# test_usage_ledger.py
+import json
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+import fastapi_server
+import gemini_keyword_extractor
+import usage_ledger
+from storage_backends import LocalStorageBackend
+from usage_ledger import UsageLedger
+
+
+@pytest.fixture
+def ledger(tmp_path, monkeypatch):
+    for budget in ("DAILY_TOKEN_BUDGET", "DAILY_COST_BUDGET_USD", "DAILY_CALL_BUDGET"):
+        monkeypatch.setattr(usage_ledger, budget, 0)
+    monkeypatch.setattr(usage_ledger, "_today", lambda: "2025-06-01")
+    return UsageLedger(str(tmp_path / "usage.sqlite3"))
+
+
+def test_usage_adds_up_per_day_and_batch(ledger, monkeypatch):
+    ledger.record(1000, 200, 600, 0.002, 1.5, batch_id="batch-1", calls=2)
+    ledger.record(500, 100, 300, 0.001, 0.5, batch_id="batch-1")
+    ledger.record(0, 0, 0, 0.0001, 0.2)  # e.g. an image embedding, outside any batch
+    monkeypatch.setattr(usage_ledger, "_today", lambda: "2025-06-02")
+    ledger.record(100, 10, 60, 0.0002, 0.3, batch_id="batch-1")
+
+    day = ledger.daily_totals("2025-06-01")
+    assert (day["calls"], day["input_tokens"], day["output_tokens"], day["total_tokens"]) == (4, 1500, 300, 1800)
+    assert (day["prompt_token_share"], day["estimated_cost_usd"], day["avg_latency_seconds"]) == (0.6, 0.0031, 0.55)
+    batch = ledger.batch_totals("batch-1")
+    assert (batch["calls"], batch["input_tokens"], batch["batch_id"]) == (4, 1600, "batch-1")
+    assert [d["day"] for d in ledger.recent_days()] == ["2025-06-02", "2025-06-01"]
+    assert ledger.daily_totals()["calls"] == 1
+    assert ledger.daily_totals("2025-05-31")["avg_latency_seconds"] is None
+
+
+@pytest.mark.parametrize("budget, limit, reason", [
+    ("DAILY_TOKEN_BUDGET", 1200, "Daily token budget of 1200 exhausted."),
+    ("DAILY_COST_BUDGET_USD", 2.0, "Daily cost budget of $2.00 exhausted."),
+    ("DAILY_CALL_BUDGET", 2, "Daily call budget of 2 exhausted."),
+])
+def test_each_budget_is_exhausted_by_todays_usage_only(ledger, monkeypatch, budget, limit, reason):
+    monkeypatch.setattr(usage_ledger, budget, limit)
+    ledger.record(600, 100, 0, 1.0, 1.0)
+    assert ledger.budget_exhausted_reason() is None
+    ledger.record(600, 100, 0, 1.0, 1.0)
+    assert ledger.budget_exhausted_reason() == reason
+    assert ledger.budgets()["exhausted_reason"] == reason
+    monkeypatch.setattr(usage_ledger, "_today", lambda: "2025-06-02")
+    assert ledger.budget_exhausted_reason() is None
+
+
+def test_budgets_are_off_by_default(ledger):
+    ledger.record(10**9, 10**9, 0, 10**6, 1.0, calls=10**6)
+    assert ledger.budget_exhausted_reason() is None
+    budgets = ledger.budgets()
+    assert (budgets["daily_token_budget"], budgets["daily_cost_budget_usd"], budgets["daily_call_budget"]) == (None, None, None)
+    assert 1 <= budgets["seconds_until_reset"] <= 86400
+
+
+def test_deferred_extractions_come_back_in_order(ledger):
+    first = ledger.defer("a.jpg", "batch-1")
+    ledger.defer("b.jpg")
+    assert ledger.deferred_count() == 2
+    assert (ledger.pop_deferred()["id"], ledger.pop_deferred()["batch_id"]) == (first, None)
+    assert ledger.pop_deferred() is None and ledger.deferred_count() == 0
+
+
+# --- Budget handling in the server ---
+
+@pytest.fixture
+def server(ledger, tmp_path, monkeypatch):
+    storage = LocalStorageBackend(str(tmp_path / "uploads"))
+    with open(storage.path("photo.png"), "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n" + b"\x00" * 64)
+    monkeypatch.setattr(fastapi_server, "storage", storage)
+    monkeypatch.setattr(fastapi_server, "usage_ledger", ledger)
+    monkeypatch.setattr(fastapi_server, "SKIP_ALREADY_TAGGED", False)
+    monkeypatch.setattr(gemini_keyword_extractor, "_VERTEX_AI_INITIALIZED", True)
+    monkeypatch.setattr(usage_ledger, "DAILY_CALL_BUDGET", 1)
+    ledger.record(100, 10, 0, 0.001, 1.0)
+    return fastapi_server
+
+
+def test_reject_mode_answers_429_with_retry_after(server, monkeypatch):
+    monkeypatch.setattr(usage_ledger, "BUDGET_EXHAUSTED_ACTION", "reject")
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(server.trigger_keyword_extraction("photo.png", x_batch_id="batch-1", idempotency_key=None))
+    assert error.value.status_code == 429
+    assert error.value.detail == "Daily call budget of 1 exhausted."
+    assert int(error.value.headers["Retry-After"]) >= 1
+    assert server.usage_ledger.deferred_count() == 0
+
+
+def test_queue_mode_defers_and_the_drain_runs_it_once_the_budget_resets(server, monkeypatch):
+    monkeypatch.setattr(usage_ledger, "BUDGET_EXHAUSTED_ACTION", "queue")
+    response = asyncio.run(server.trigger_keyword_extraction("photo.png", x_batch_id="batch-1", idempotency_key=None))
+    body = json.loads(response.body)
+    assert (response.status_code, body["status"], body["filename"]) == (202, "queued", "photo.png")
+    assert server.usage_ledger.deferred_count() == 1
+
+    extracted = []
+    monkeypatch.setattr(server, "DEFERRED_POLL_SECONDS", 0)
+    monkeypatch.setattr(server, "run_extraction", lambda filename, batch_id: extracted.append((filename, batch_id)) or {"status": "success"})
+
+    async def drain():
+        task = asyncio.create_task(server._drain_deferred_extractions())
+        await asyncio.sleep(0.05)
+        assert extracted == []  # still exhausted: nothing runs
+        monkeypatch.setattr(usage_ledger, "_today", lambda: "2025-06-02")
+        for _ in range(100):
+            if extracted:
+                break
+            await asyncio.sleep(0.01)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    asyncio.run(drain())
+    assert extracted == [("photo.png", "batch-1")]
+    assert server.usage_ledger.deferred_count() == 0